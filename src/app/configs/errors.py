@@ -63,6 +63,20 @@ class Error(Enum):
         ),
         "status_code": 404
     }
+    RELEASE_RECS_NOT_FOUND = {
+        "code": "ReleaseRecsNotFound",
+        "message": (
+            "No release recommendations for the user with username '{username}'."
+        ),
+        "status_code": 404
+    }
+    SIMILAR_USERS_NOT_FOUND = {
+        "code": "SimilarUsersNotFound",
+        "message": (
+            "No users with ratings like the ones of the user with username '{username}'."
+        ),
+        "status_code": 404
+    }
     NO_FRIEND_RECS_FOUND = {
         "code": "NoFriendRecsFound",
         "message": "No friend recommendations found for user '{username}' in genre '{genre}'",
@@ -116,6 +130,37 @@ class Error(Enum):
         "message": "Missing required query parameter '{parameter}'.",
         "status_code": 400,
     }
+    INVALID_QUERY_PARAMETER = {
+        "code": "InvalidQueryParameter",
+        "message": "Invalid value '{value}' for query parameter '{parameter}'.",
+        "status_code": 400,
+    }
+    BATCH_TOO_LARGE = {
+        "code": "BatchTooLarge",
+        "message": "A batch may have at most {maximum} requests.",
+        "status_code": 422,
+    }
+    INVALID_BATCH_REQUEST = {
+        "code": "InvalidBatchRequest",
+        "message": "Invalid request at position {index} of the batch: {reason}.",
+        "status_code": 422,
+    }
+    BATCH_TIMEOUT = {
+        "code": "BatchTimeout",
+        "message": (
+            "The request did not start within the {seconds} seconds of the batch "
+            "and was not run."
+        ),
+        "status_code": 504,
+    }
+    BATCH_REQUEST_PENDING = {
+        "code": "BatchRequestPending",
+        "message": (
+            "The request was still running after the {seconds} seconds of the batch; "
+            "it may still complete."
+        ),
+        "status_code": 202,
+    }
     INVALID_REC_METHOD = {
         "code": "InvalidRecMethod",
         "message": "Invalid recommendation method '{method}'.",
@@ -144,6 +189,22 @@ class Error(Enum):
         "status_code": 404
     }
 
+    GRAPH_NOT_AVAILABLE = {
+        "code": "GraphNotAvailable",
+        "message": "Graph recommendations are not available.",
+        "status_code": 503,
+    }
+    CHARTS_NOT_AVAILABLE = {
+        "code": "ChartsNotAvailable",
+        "message": "The charts are being built; try again shortly.",
+        "status_code": 503,
+    }
+    EMBEDDINGS_NOT_AVAILABLE = {
+        "code": "EmbeddingsNotAvailable",
+        "message": "Recommendations by embeddings are not available.",
+        "status_code": 503,
+    }
+
     @property
     def code(self) -> str:
         """Get the error code."""
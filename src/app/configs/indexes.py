@@ -0,0 +1,105 @@
+"""
+Declarative spec of the indexes and constraints both databases must have.
+
+Apply it with `python manage.py indexes --apply`.
+"""
+
+MONGODB_INDEXES = [
+    # Every /users/<username> route and the friend list updates
+    {
+        "collection": "users",
+        "name": "username",
+        "keys": [("username", 1)],
+        "unique": True,
+    },
+    # The friends merged into a feed on read, out of the few flagged users
+    {
+        "collection": "users",
+        "name": "fanout_on_read_friends",
+        "keys": [("friends", 1)],
+        "partial": {"fanout_on_read": True},
+    },
+    # Reconciliation and analytics lookups of who rated a release
+    {
+        "collection": "users",
+        "name": "ratings_id",
+        "keys": [("ratings.id", 1)],
+    },
+    # Reconciliation and analytics lookups of who follows an artist
+    {
+        "collection": "users",
+        "name": "follows_id",
+        "keys": [("follows.id", 1)],
+    },
+    # The users changed since the previous incremental export
+    {
+        "collection": "users",
+        "name": "users_updated_at",
+        "keys": [("updated_at", 1)],
+    },
+    # get_release, rate_release and every other lookup by release ID
+    {
+        "collection": "artists",
+        "name": "releases_id",
+        "keys": [("releases.id", 1)],
+        "unique": True,
+    },
+    # The $pull of a user's ratings in delete_user
+    {
+        "collection": "artists",
+        "name": "releases_ratings_username",
+        "keys": [("releases.ratings.username", 1)],
+    },
+    # The artists changed since the previous incremental export
+    {
+        "collection": "artists",
+        "name": "artists_updated_at",
+        "keys": [("updated_at", 1)],
+    },
+    # The pages of /genres/<name>/artists?sort=popularity
+    {
+        "collection": "artists",
+        "name": "genres_popularity",
+        "keys": [("genres", 1), ("popularity", -1), ("_id", 1)],
+    },
+    # The pages of /genres/<name>/artists?sort=followers
+    {
+        "collection": "artists",
+        "name": "genres_qt_followers",
+        "keys": [("genres", 1), ("qt_followers", -1), ("_id", 1)],
+    },
+]
+
+NEO4J_SCHEMA = [
+    {
+        "kind": "constraint",
+        "name": "artist_id",
+        "label": "Artist",
+        "property": "id",
+    },
+    {
+        "kind": "constraint",
+        "name": "genre_name",
+        "label": "Genre",
+        "property": "name",
+    },
+    {
+        "kind": "constraint",
+        "name": "release_id",
+        "label": "Release",
+        "property": "id",
+    },
+    {
+        "kind": "constraint",
+        "name": "user_username",
+        "label": "User",
+        "property": "username",
+    },
+    # ORDER BY a.popularity in the artist recommendations
+    {
+        "kind": "index",
+        "name": "artist_popularity",
+        "label": "Artist",
+        "property": "popularity",
+    },
+]
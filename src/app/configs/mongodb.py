@@ -1,22 +1,130 @@
 """
 Singleton for the connection to MongoDB
+
+The client is only created on first access of `client` or `db`, and it is
+discarded in forked children, so every worker process of a pre-forking server
+opens its own connection pool.
 """
 import os
+import threading
 import dotenv
 from pymongo import MongoClient
+from pymongo.database import Database
+from pymongo.read_preferences import Primary, SecondaryPreferred
 from pymongo.server_api import ServerApi
+from configs import routing
 
 dotenv.load_dotenv()
 
-client = MongoClient(
+URI = os.getenv(
+    "MONGODB_URI",
     (f"mongodb+srv://{os.getenv('MONGODB_USERNAME')}:{os.getenv('MONGODB_PASSWORD')}"
     "@projeto-bd.9scqvyv.mongodb.net/"
     "?retryWrites=true&w=majority&appName=projeto-bd"),
-    server_api = ServerApi(
-        version = "1",
-        strict = True,
-        deprecation_errors = True
-    )
 )
+DATABASE = os.getenv("MONGODB_DATABASE", "music_catalog")
+
+MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "50"))
+MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000"))
+SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "30000"))
+
+READ_FROM_SECONDARIES = os.getenv("MONGODB_READ_FROM_SECONDARIES", "true").lower() == "true"
+# MongoDB rejects a max staleness below 90 seconds
+MAX_STALENESS_SECONDS = max(int(os.getenv("MONGODB_MAX_STALENESS_SECONDS", "90")), 90)
+
+_lock = threading.Lock()
+_client: MongoClient | None = None
+_unversioned_client: MongoClient | None = None
+
+def get_client() -> MongoClient:
+    """
+    Get the client of the current process, creating it on first use.
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = MongoClient(
+                    URI,
+                    server_api = ServerApi(
+                        version = "1",
+                        strict = True,
+                        deprecation_errors = True
+                    ),
+                    maxPoolSize = MAX_POOL_SIZE,
+                    minPoolSize = MIN_POOL_SIZE,
+                    connectTimeoutMS = CONNECT_TIMEOUT_MS,
+                    serverSelectionTimeoutMS = SERVER_SELECTION_TIMEOUT_MS,
+                    socketTimeoutMS = SOCKET_TIMEOUT_MS,
+                    connect = False,
+                )
+    return _client
+
+def get_unversioned_client() -> MongoClient:
+    """
+    Get a small client without the Stable API, for diagnostic commands such as
+    `explain` that the strict API rejects.
+    """
+    global _unversioned_client
+    if _unversioned_client is None:
+        with _lock:
+            if _unversioned_client is None:
+                _unversioned_client = MongoClient(
+                    URI,
+                    maxPoolSize = 2,
+                    connectTimeoutMS = CONNECT_TIMEOUT_MS,
+                    serverSelectionTimeoutMS = SERVER_SELECTION_TIMEOUT_MS,
+                    connect = False,
+                )
+    return _unversioned_client
+
+def get_db() -> Database:
+    """
+    Get the music catalog database of the current process, reading from the
+    primary.
+    """
+    return get_client().get_database(DATABASE, read_preference = Primary())
+
+def get_read_db() -> Database:
+    """
+    Get the music catalog database of the current process, reading from a
+    secondary no more than `MAX_STALENESS_SECONDS` behind when there is one.
+    """
+    return get_client().get_database(
+        DATABASE,
+        read_preference = SecondaryPreferred(max_staleness = MAX_STALENESS_SECONDS),
+    )
+
+def close():
+    """
+    Close the clients of the current process, if they were ever created.
+    """
+    global _client, _unversioned_client
+    with _lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+        if _unversioned_client is not None:
+            _unversioned_client.close()
+            _unversioned_client = None
+
+def _reset_after_fork():
+    # The parent's sockets and monitor threads are unusable in the child, so
+    # the inherited client is dropped without closing it.
+    global _client, _unversioned_client, _lock
+    _client = None
+    _unversioned_client = None
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child = _reset_after_fork)
 
-db = client["music_catalog"]
+def __getattr__(name: str):
+    if name == "client":
+        return get_client()
+    if name == "db":
+        if READ_FROM_SECONDARIES and routing.current.get().mongodb_secondary:
+            return get_read_db()
+        return get_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,18 +1,154 @@
 """
 Singleton for the connection to Neo4j
+
+The driver is only created on first access of `driver`, and it is discarded in
+forked children, so every worker process of a pre-forking server opens its own
+connection pool.
 """
 import os
+import threading
+import time
 import dotenv
-from neo4j import GraphDatabase
+from neo4j import Bookmarks, Driver, EagerResult, GraphDatabase, RoutingControl
+from neo4j.api import ResultSummary
+from configs import routing
 
 dotenv.load_dotenv()
 
-driver = GraphDatabase.driver(
-    "neo4j+s://10ab7e50.databases.neo4j.io",
-    auth = (
-        os.getenv("NEO4J_USERNAME"),
-        os.getenv("NEO4J_PASSWORD"),
-    ),
-)
+URI = os.getenv("NEO4J_URI", "neo4j+s://10ab7e50.databases.neo4j.io")
+
+MAX_POOL_SIZE = int(os.getenv("NEO4J_MAX_POOL_SIZE", "50"))
+CONNECTION_TIMEOUT = float(os.getenv("NEO4J_CONNECTION_TIMEOUT", "5"))
+ACQUISITION_TIMEOUT = float(os.getenv("NEO4J_ACQUISITION_TIMEOUT", "30"))
+MAX_CONNECTION_LIFETIME = float(os.getenv("NEO4J_MAX_CONNECTION_LIFETIME", "3600"))
+
+READ_FROM_REPLICAS = os.getenv("NEO4J_READ_FROM_REPLICAS", "true").lower() == "true"
+
+_lock = threading.Lock()
+_driver: Driver | None = None
+
+class QueryListener:
+    """
+    Base class for listeners of the queries run through `execute_query`.
+    """
+    def started(self, name: str, query: str, parameters: dict):
+        """Called before the query is sent."""
+
+    def succeeded(
+        self,
+        name: str,
+        query: str,
+        parameters: dict,
+        summary: ResultSummary,
+        duration: float,
+    ):
+        """Called after the result was fully consumed."""
+
+    def failed(
+        self,
+        name: str,
+        query: str,
+        parameters: dict,
+        error: Exception,
+        duration: float,
+    ):
+        """Called when the query raised an error."""
+
+_listeners: list[QueryListener] = []
+
+def register(listener: QueryListener):
+    """
+    Register a listener for every query run through `execute_query`.
+    """
+    _listeners.append(listener)
+
+def get_driver() -> Driver:
+    """
+    Get the driver of the current process, creating it on first use.
+    """
+    global _driver
+    if _driver is None:
+        with _lock:
+            if _driver is None:
+                _driver = GraphDatabase.driver(
+                    URI,
+                    auth = (
+                        os.getenv("NEO4J_USERNAME"),
+                        os.getenv("NEO4J_PASSWORD"),
+                    ),
+                    max_connection_pool_size = MAX_POOL_SIZE,
+                    connection_timeout = CONNECTION_TIMEOUT,
+                    connection_acquisition_timeout = ACQUISITION_TIMEOUT,
+                    max_connection_lifetime = MAX_CONNECTION_LIFETIME,
+                )
+    return _driver
+
+def execute_query(name: str, query: str, **kwargs) -> EagerResult:
+    """
+    Run a query with the driver of the current process, reporting it to the
+    registered listeners under a stable name.
+
+    Unless `routing_` is given, read-only requests send the query to a read
+    replica, which first catches up with the bookmarks of the request.
+    """
+    request_routing = routing.current.get()
+    if READ_FROM_REPLICAS and request_routing.neo4j_read and "routing_" not in kwargs:
+        kwargs["routing_"] = RoutingControl.READ
+        if request_routing.neo4j_bookmarks:
+            kwargs["bookmark_manager_"] = GraphDatabase.bookmark_manager(
+                initial_bookmarks = Bookmarks.from_raw_values(request_routing.neo4j_bookmarks),
+            )
+
+    parameters = {
+        key: value
+        for key, value in kwargs.items()
+        if not key.endswith("_")
+    }
+    for listener in _listeners:
+        listener.started(name, query, parameters)
+
+    start = time.perf_counter()
+    try:
+        result = get_driver().execute_query(query, **kwargs)
+    except Exception as e:
+        duration = time.perf_counter() - start
+        for listener in _listeners:
+            listener.failed(name, query, parameters, e, duration)
+        raise
+
+    duration = time.perf_counter() - start
+    for listener in _listeners:
+        listener.succeeded(name, query, parameters, result.summary, duration)
+
+    return result
+
+def get_bookmarks() -> tuple:
+    """
+    Get the bookmarks of the latest queries run through `execute_query` by
+    the current process.
+    """
+    return tuple(get_driver().execute_query_bookmark_manager.get_bookmarks())
+
+def close():
+    """
+    Close the driver of the current process, if it was ever created.
+    """
+    global _driver
+    with _lock:
+        if _driver is not None:
+            _driver.close()
+            _driver = None
+
+def _reset_after_fork():
+    # The parent's connections are unusable in the child, so the inherited
+    # driver is dropped without closing it.
+    global _driver, _lock
+    _driver = None
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child = _reset_after_fork)
 
-driver.verify_connectivity()
+def __getattr__(name: str):
+    if name == "driver":
+        return get_driver()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,65 @@
+"""
+Singleton for the optional connection to Redis
+
+Redis is only used when `REDIS_URL` is set, to share state between worker
+processes. The client is created on first use and discarded in forked
+children, like the database clients.
+"""
+import os
+import threading
+import dotenv
+from redis import Redis
+
+dotenv.load_dotenv()
+
+URL = os.getenv("REDIS_URL")
+ENABLED = bool(URL)
+
+MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+
+_lock = threading.Lock()
+_client: Redis | None = None
+
+def get_client() -> Redis:
+    """
+    Get the client of the current process, creating it on first use.
+    """
+    global _client
+    if not ENABLED:
+        raise RuntimeError("REDIS_URL is not set")
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = Redis.from_url(
+                    URL,
+                    max_connections = MAX_CONNECTIONS,
+                    socket_timeout = SOCKET_TIMEOUT,
+                    socket_connect_timeout = SOCKET_TIMEOUT,
+                    decode_responses = True,
+                )
+    return _client
+
+def close():
+    """
+    Close the client of the current process, if it was ever created.
+    """
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+def _reset_after_fork():
+    # The parent's sockets are unusable in the child, so the inherited client
+    # is dropped without closing it.
+    global _client, _lock
+    _client = None
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child = _reset_after_fork)
+
+def __getattr__(name: str):
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,27 @@
+"""
+Per-request routing of the queries between primaries and replicas.
+
+The request hooks in `utils.consistency` set the routing of the current
+request, and the database modules read it for every query.
+"""
+import contextvars
+from dataclasses import dataclass
+
+@dataclass(frozen = True)
+class Routing:
+    """
+    Where the queries of a request may go.
+    """
+    # Whether MongoDB reads may go to a secondary
+    mongodb_secondary: bool = False
+    # Whether Neo4j queries may go to a read replica
+    neo4j_read: bool = False
+    # Bookmarks the Neo4j replica must have caught up with before reading
+    neo4j_bookmarks: tuple = ()
+
+PRIMARY = Routing()
+
+current: contextvars.ContextVar[Routing] = contextvars.ContextVar(
+    "routing",
+    default = PRIMARY,
+)
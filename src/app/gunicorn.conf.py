@@ -0,0 +1,77 @@
+"""
+Gunicorn configuration for running the API in production.
+
+Run from `src/app` with `gunicorn -c gunicorn.conf.py main:app`. Database
+clients are created lazily, so each forked worker opens its own pools on its
+first request, and closes them when it exits.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "gthread"
+threads = int(os.getenv("WORKER_THREADS", "4"))
+backlog = int(os.getenv("BACKLOG", "2048"))
+
+timeout = int(os.getenv("WORKER_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+
+# Importing the app once in the master shares its pages with the workers. It
+# is safe because no database client exists until a request needs one.
+preload_app = os.getenv("PRELOAD_APP", "true").lower() == "true"
+
+accesslog = os.getenv("ACCESS_LOG", "-")
+errorlog = "-"
+
+def on_starting(server):
+    """
+    Clear the samples left in the metrics directory by a previous run.
+    """
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+def post_worker_init(worker):
+    """
+    Start warming up the worker's pools in the background, and export the
+    worker's pool size.
+    """
+    from utils import metrics, warmup
+
+    metrics.start_worker()
+    warmup.start()
+
+def worker_exit(server, worker):
+    """
+    Write the worker's pending follower counts and close its connection pools
+    once it has drained its requests.
+    """
+    from configs import mongodb, neo4j, redis
+    from utils import counters
+
+    try:
+        counters.flush()
+    except Exception as e: # pylint: disable=broad-exception-caught
+        # The journal or the Redis hash keeps the counts for a later flush
+        server.log.warning("Worker %s could not flush its follower counts: %s", worker.pid, e)
+
+    mongodb.close()
+    neo4j.close()
+    redis.close()
+    server.log.info("Worker %s closed its database connections", worker.pid)
+
+def child_exit(server, worker):
+    """
+    Drop the live gauges of a dead worker from the aggregated metrics.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,22 +1,39 @@
 """
 Server for the music catalog API
 """
+import logging
+import os
 from flask import Flask
-from configs import mongodb, neo4j
-from routes import artists, releases, users, recs
+from configs import mongodb, neo4j, redis
+from routes import artists, releases, users, recs, charts, genres, health, batch
+from utils import consistency, counters, metrics, slowlog, tracing, warmup
+
+logging.basicConfig(level = os.getenv("LOG_LEVEL", "INFO"))
 
 app = Flask("Music Catalog API")
 app.json.sort_keys = False
 app.url_map.strict_slashes = False
 
+metrics.install(app)
+tracing.install(app)
+slowlog.install()
+consistency.install(app)
+
 
 app.register_blueprint(artists.bp, url_prefix = "/v1/artists")
 app.register_blueprint(releases.bp, url_prefix = "/v1/releases")
 app.register_blueprint(users.bp, url_prefix = "/v1/users")
 app.register_blueprint(recs.bp, url_prefix = "/v1/recs")
+app.register_blueprint(charts.bp, url_prefix = "/v1/charts")
+app.register_blueprint(genres.bp, url_prefix = "/v1/genres")
+app.register_blueprint(batch.bp, url_prefix = "/v1/batch")
+app.register_blueprint(health.bp)
 
 if __name__=="__main__":
+    warmup.start()
     app.run(debug = True)
 
-    mongodb.client.close()
-    neo4j.driver.close()
+    counters.flush()
+    mongodb.close()
+    neo4j.close()
+    redis.close()
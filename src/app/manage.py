@@ -0,0 +1,290 @@
+"""
+Maintenance commands for the music catalog API.
+
+Usage (from src/app): python manage.py <command> [options]
+"""
+import argparse
+import json
+from collections import Counter
+from configs import mongodb, neo4j, redis
+from utils import (
+    catalog,
+    charts,
+    counters,
+    embeddings,
+    export,
+    filters,
+    genres,
+    indexes,
+    pagerank,
+    reconcile,
+    similar,
+)
+
+def run_indexes(args):
+    """
+    Compare the databases against the index spec, optionally applying it.
+    """
+    entries = indexes.diff()
+    for entry in entries:
+        print(f"{entry['status']:>8}  {indexes.describe(entry)}")
+
+    if args.apply:
+        created = indexes.apply(entries)
+        print(f"Created {len(created)} index(es) and constraint(s)")
+
+def run_charts(args):
+    """
+    Rebuild the artist and release charts from MongoDB.
+    """
+    if not charts.rebuild():
+        print("The charts are already being rebuilt")
+        return
+    print(f"Rebuilt the charts (minimum of {charts.MIN_RATINGS} ratings per release)")
+
+def run_genres(args):
+    """
+    Copy artist popularity from Neo4j and rebuild the list of genres.
+    """
+    print(f"Updated the popularity of {genres.backfill_popularity()} artist(s)")
+    print(f"Rebuilt the list of {genres.rebuild()} genre(s)")
+
+def run_filters(args):
+    """
+    Make every worker rebuild its existence filters, e.g. after an ingestion.
+    """
+    if not redis.ENABLED:
+        print("REDIS_URL is not set; the workers rebuild every FILTER_REBUILD_SECONDS")
+        return
+    filters.request_rebuild()
+    print("Asked every worker to rebuild its existence filters")
+
+def run_counters(args):
+    """
+    Write the pending follower counts of stopped workers to MongoDB.
+    """
+    if redis.ENABLED:
+        counters.flush()
+        print("Wrote the pending follower counts in Redis")
+    else:
+        counters.recover()
+        print(f"Wrote the follower count journals of stopped workers in {counters.JOURNAL_DIR}")
+
+def run_reconcile(args):
+    """
+    Find, and optionally repair, what MongoDB and Neo4j disagree on.
+    """
+    totals = Counter()
+    output = open(args.output, "w", encoding = "utf-8") if args.output else None
+
+    def on_found(found):
+        for item in found:
+            totals[item["kind"]] += 1
+            if output is not None:
+                output.write(json.dumps(item) + "\n")
+            elif totals[item["kind"]] <= args.show:
+                print(json.dumps(item))
+
+    try:
+        options = {
+            "repair": args.repair,
+            "chunk_size": args.chunk_size,
+            "workers": args.workers,
+        }
+        if args.only in (None, "users"):
+            reconcile.check_users(on_found, **options)
+        if args.only in (None, "followers"):
+            reconcile.check_followers(on_found, **options)
+    finally:
+        if output is not None:
+            output.close()
+
+    for kind, total in sorted(totals.items()):
+        print(f"{total:>8}  {kind}")
+    action = "Repaired" if args.repair else "Found"
+    print(f"{action} {sum(totals.values())} discrepancy(ies)")
+
+def run_export(args):
+    """
+    Export the catalog, the users and the graph edges as columnar files.
+    """
+    manifest = export.export(
+        args.output,
+        incremental = args.incremental,
+        chunk_size = args.chunk_size,
+    )
+    for name, table in manifest["tables"].items():
+        print(f"{table['rows']:>10}  {name}")
+    print(f"Wrote a {manifest['mode']} export up to {manifest['until']} to {args.output}")
+
+def run_catalog(args):
+    """
+    Compile the artists, releases and tracks into the catalog snapshot file.
+    """
+    if not args.output:
+        print("Set CATALOG_SNAPSHOT or pass --output")
+        return
+    counts = catalog.build(args.output)
+    print(
+        f"Wrote {counts['artists']} artists, {counts['releases']} releases "
+        f"and {counts['tracks']} tracks to {args.output}"
+    )
+
+def run_similar(args):
+    """
+    Recompute the similar artists of every artist, or of those whose followers changed.
+    """
+    counts = similar.rebuild(incremental = args.incremental)
+    print(
+        f"Computed the similar artists of {counts['computed']} artist(s), "
+        f"{counts['updated']} changed"
+    )
+
+def run_graph(args):
+    """
+    Read the graph from Neo4j into a new snapshot for the graph recommendations.
+    """
+    if not args.output:
+        print("Set GRAPH_SNAPSHOT or pass --output")
+        return
+    counts = pagerank.build(args.output)
+    print(
+        f"Wrote {counts['users']} users, {counts['artists']} artists, "
+        f"{counts['releases']} releases, "
+        f"{counts['genres']} genres and {counts['edges']} edges to {args.output}"
+    )
+
+def run_embeddings(args):
+    """
+    Train the user and release embeddings into a new snapshot, or refresh the
+    users whose ratings changed.
+    """
+    if not args.output:
+        print("Set EMBEDDINGS_SNAPSHOT or pass --output")
+        return
+    meta = embeddings.train(args.output, incremental = args.incremental)
+    print(
+        f"Wrote a {meta['mode']} build of {meta['users']} users and {meta['releases']} releases "
+        f"in {meta['dimensions']} dimensions up to {meta['until']} to {args.output}"
+    )
+
+def main():
+    """
+    Parse the command line and run the command.
+    """
+    parser = argparse.ArgumentParser(description = __doc__.strip().split("\n", maxsplit = 1)[0])
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    indexes_parser = commands.add_parser("indexes", help = run_indexes.__doc__.strip())
+    indexes_parser.add_argument("--apply", action = "store_true", help = "create what is missing")
+    indexes_parser.set_defaults(run = run_indexes)
+
+    charts_parser = commands.add_parser("charts", help = run_charts.__doc__.strip())
+    charts_parser.set_defaults(run = run_charts)
+
+    genres_parser = commands.add_parser("genres", help = run_genres.__doc__.strip())
+    genres_parser.set_defaults(run = run_genres)
+
+    filters_parser = commands.add_parser("filters", help = run_filters.__doc__.strip())
+    filters_parser.set_defaults(run = run_filters)
+
+    counters_parser = commands.add_parser("counters", help = run_counters.__doc__.strip())
+    counters_parser.set_defaults(run = run_counters)
+
+    reconcile_parser = commands.add_parser("reconcile", help = run_reconcile.__doc__.strip())
+    reconcile_parser.add_argument(
+        "--repair",
+        action = "store_true",
+        help = "make Neo4j and the counts match MongoDB",
+    )
+    reconcile_parser.add_argument(
+        "--only",
+        choices = ["users", "followers"],
+        help = "check only one part",
+    )
+    reconcile_parser.add_argument(
+        "--chunk-size",
+        type = int,
+        default = reconcile.CHUNK_SIZE,
+        help = "users or artists per chunk",
+    )
+    reconcile_parser.add_argument(
+        "--workers",
+        type = int,
+        default = 4,
+        help = "chunks checked in parallel",
+    )
+    reconcile_parser.add_argument(
+        "--output",
+        help = "write every discrepancy to this JSON Lines file",
+    )
+    reconcile_parser.add_argument(
+        "--show",
+        type = int,
+        default = 5,
+        help = "discrepancies printed per kind, without --output",
+    )
+    reconcile_parser.set_defaults(run = run_reconcile)
+
+    export_parser = commands.add_parser("export", help = run_export.__doc__.strip())
+    export_parser.add_argument("--output", required = True, help = "directory of the exports")
+    export_parser.add_argument(
+        "--incremental",
+        action = "store_true",
+        help = "only what changed since the last export",
+    )
+    export_parser.add_argument(
+        "--chunk-size",
+        type = int,
+        default = export.CHUNK_SIZE,
+        help = "rows per file",
+    )
+    export_parser.set_defaults(run = run_export)
+
+    catalog_parser = commands.add_parser("catalog", help = run_catalog.__doc__.strip())
+    catalog_parser.add_argument(
+        "--output",
+        default = catalog.PATH,
+        help = "snapshot file (default: CATALOG_SNAPSHOT)",
+    )
+    catalog_parser.set_defaults(run = run_catalog)
+
+    similar_parser = commands.add_parser("similar", help = run_similar.__doc__.strip())
+    similar_parser.add_argument(
+        "--incremental",
+        action = "store_true",
+        help = "only the artists queued by follows and unfollows",
+    )
+    similar_parser.set_defaults(run = run_similar)
+
+    graph_parser = commands.add_parser("graph", help = run_graph.__doc__.strip())
+    graph_parser.add_argument(
+        "--output",
+        default = pagerank.PATH,
+        help = "snapshot directory (default: GRAPH_SNAPSHOT)",
+    )
+    graph_parser.set_defaults(run = run_graph)
+
+    embeddings_parser = commands.add_parser("embeddings", help = run_embeddings.__doc__.strip())
+    embeddings_parser.add_argument(
+        "--output",
+        default = embeddings.PATH,
+        help = "snapshot directory (default: EMBEDDINGS_SNAPSHOT)",
+    )
+    embeddings_parser.add_argument(
+        "--incremental",
+        action = "store_true",
+        help = "only the users changed since the current build",
+    )
+    embeddings_parser.set_defaults(run = run_embeddings)
+
+    args = parser.parse_args()
+    try:
+        args.run(args)
+    finally:
+        mongodb.close()
+        neo4j.close()
+        redis.close()
+
+if __name__ == "__main__":
+    main()
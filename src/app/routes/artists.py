@@ -1,92 +1,132 @@
 """
 Module for the 'artists/' route.
 """
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request
 from configs import mongodb
 from configs.errors import Error
+from utils import catalog, counters, filters, helper, similar, singleflight
 
 bp = Blueprint("artists", __name__)
 
-@bp.route("/<artist_id>", methods = ["GET"])
-def get_artist(artist_id):
-    """
-    Endpoint for getting the artist resource by artist ID.
-    """
-    artist_cursor = mongodb.db.artists.aggregate([
-        {
-            "$match": {
-                "_id": artist_id
-            }
-        },
-        {
-            "$addFields": {
-                "allRatings": {
-                    "$reduce": {
-                        "input": "$releases",
-                        "initialValue": [],
-                        "in": {
-                            "$concatArrays": [
-                                "$$value",
-                                "$$this.ratings"
-                            ]
-                        }
-                    }
+ARTIST_FIELDS = ("id", "name", "genres", "bio", "qt_followers", "average_rating")
+ARTIST_EMBEDDED = ("releases",)
+# Fields of get_artist that change between ingestions
+ARTIST_STATS = {"qt_followers", "average_rating"}
+
+# The $project expression of each field of get_artist
+ARTIST_PROJECTION = {
+    "id": "$_id",
+    "name": True,
+    "genres": True,
+    "bio": True,
+    "qt_followers": True,
+    "average_rating": {
+        "$avg": {
+            "$reduce": {
+                "input": "$releases.ratings",
+                "initialValue": [],
+                "in": {
+                    "$concatArrays": ["$$value", "$$this.rating"],
                 },
-                "mappedReleases": {
-                    "$map": {
-                        "input": "$releases",
-                        "as": "release",
-                        "in": {
-                            "id": "$$release.id",
-                            "name": "$$release.name",
-                            "release_year": {
-                                "$year": {
-                                    "$dateFromString": {
-                                        "dateString": "$$release.release_date"
-                                    }
-                                }
-                            }
+            },
+        },
+    },
+    "releases": {
+        "$map": {
+            "input": "$releases",
+            "as": "release",
+            "in": {
+                "id": "$$release.id",
+                "name": "$$release.name",
+                "release_year": {
+                    "$year": {
+                        "$dateFromString": {
+                            "dateString": "$$release.release_date"
                         }
                     }
                 }
             }
+        }
+    },
+}
+
+def _find_artist(name: str, artist_id: str, fields: set) -> dict | None:
+    # Reads only the selected fields, computing nothing else.
+    pipeline = [
+        {
+            "$match": {
+                "_id": artist_id,
+            },
         },
         {
             "$project": {
                 "_id": False,
-                "id": "$_id",
-                "name": True,
-                "genres": True,
-                "bio": True,
-                "qt_followers": True,
-                "average_rating": {
-                    "$cond": {
-                        "if": {
-                            "$gt": [{"$size": "$allRatings"}, 0],
-                        },
-                        "then": {
-                            "$avg": "$allRatings.rating"
-                        },
-                        "else": None
-                    }
+                **{
+                    field: expression
+                    for field, expression in ARTIST_PROJECTION.items()
+                    if field in fields
                 },
-                "releases": "$mappedReleases"
-            }
-        }
-    ])
+            },
+        },
+    ]
+    artists_retrieved = singleflight.do(
+        name,
+        f"{artist_id}:{','.join(sorted(fields))}",
+        lambda: tuple(mongodb.db.artists.aggregate(pipeline)),
+    )
+    # The result may be shared with other requests, so it is copied
+    return dict(artists_retrieved[0]) if artists_retrieved else None
+
+@bp.route("/<artist_id>", methods = ["GET"])
+def get_artist(artist_id):
+    """
+    Endpoint for getting the artist resource by artist ID.
+    """
+    fields, invalid = helper.parse_fields(ARTIST_FIELDS, ARTIST_EMBEDDED, ARTIST_EMBEDDED)
+    if invalid:
+        return Error.INVALID_QUERY_PARAMETER.get_response(
+            parameter = invalid,
+            value = request.args[invalid],
+        )
+    fields.add("id")
 
-    artists_retrieved = tuple(artist_cursor)
-    if not artists_retrieved:
+    if not filters.might_exist("artist", artist_id):
         return Error.ARTIST_NOT_FOUND.get_response(id = artist_id)
 
-    return jsonify(artists_retrieved[0]), 200
+    snapshot = catalog.get()
+    artist = snapshot.artist(artist_id) if snapshot is not None else None
+    if artist is not None:
+        artist = {field: value for field, value in artist.items() if field in fields}
+        if fields & ARTIST_STATS:
+            stats = _find_artist("artists.get_artist_stats", artist_id, fields & ARTIST_STATS)
+            if stats is None:
+                return Error.ARTIST_NOT_FOUND.get_response(id = artist_id)
+            artist.update(stats)
+    else:
+        artist = _find_artist("artists.get_artist", artist_id, fields)
+        if artist is None:
+            return Error.ARTIST_NOT_FOUND.get_response(id = artist_id)
+
+    if "qt_followers" in fields:
+        pending = counters.pending_followers([artist_id]).get(artist_id, 0)
+        artist["qt_followers"] = artist.get("qt_followers", 0) + pending
+
+    return jsonify(artist), 200
 
 @bp.route("/<artist_id>/tracks", methods = ["GET"])
 def get_artist_tracks(artist_id):
     """
     Endpoint for getting all tracks from an artist in alphabetical order.
     """
-    tracks_cursor = mongodb.db.artists.aggregate([
+    if not filters.might_exist("artist", artist_id):
+        return Error.ARTIST_NOT_FOUND.get_response(id = artist_id)
+
+    snapshot = catalog.get()
+    tracks = snapshot.artist_tracks(artist_id) if snapshot is not None else None
+    if tracks is not None:
+        return jsonify(tracks), 200
+
+    pipeline = [
         {
             "$match": {
                 "_id": artist_id,
@@ -141,10 +181,57 @@ def get_artist_tracks(artist_id):
                 },
             },
         },
-    ])
+    ]
 
-    tracks_results = tuple(tracks_cursor)
+    tracks_results = singleflight.do(
+        "artists.get_artist_tracks",
+        artist_id,
+        lambda: tuple(mongodb.db.artists.aggregate(pipeline)),
+    )
     if not tracks_results:
         return Error.ARTIST_NOT_FOUND.get_response(id = artist_id)
 
     return jsonify(tracks_results[0]), 200
+
+@bp.route("/<artist_id>/similar", methods = ["GET"])
+def get_similar_artists(artist_id):
+    """
+    Endpoint for getting the artists most similar to an artist, by shared
+    genres and followers, from the most similar.
+    """
+    limit = helper.parse_limit(maximum = similar.K)
+    if limit is None:
+        return Error.INVALID_QUERY_PARAMETER.get_response(
+            parameter = "limit",
+            value = request.args.get("limit"),
+        )
+
+    if not filters.might_exist("artist", artist_id):
+        return Error.ARTIST_NOT_FOUND.get_response(id = artist_id)
+
+    artist = singleflight.do(
+        "artists.get_similar_artists",
+        f"{artist_id}:{limit}",
+        lambda: mongodb.db.artists.find_one(
+            {
+                "_id": artist_id,
+            },
+            {
+                "_id": True,
+                "name": True,
+                "similar": {
+                    "$slice": limit,
+                },
+            },
+        ),
+    )
+    if artist is None:
+        return Error.ARTIST_NOT_FOUND.get_response(id = artist_id)
+
+    return jsonify({
+        "artist": {
+            "id": artist["_id"],
+            "name": artist.get("name"),
+        },
+        "items": artist.get("similar", []),
+    }), 200
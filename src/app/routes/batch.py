@@ -0,0 +1,152 @@
+"""
+Module for the 'batch/' route.
+
+A batch carries several requests to the other routes, which run concurrently
+on a pool of the batch's own. Each one goes through the whole app, with its
+hooks and the headers of the batch, as if it had been sent alone.
+"""
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+import os
+from urllib.parse import urlsplit
+from flask import Blueprint, Flask, current_app, jsonify, request
+from werkzeug.test import EnvironBuilder
+from configs.errors import Error
+from utils import consistency
+
+bp = Blueprint("batch", __name__)
+
+MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "20"))
+TIMEOUT_SECONDS = float(os.getenv("BATCH_TIMEOUT_SECONDS", "10"))
+WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+
+METHODS = ("GET", "POST", "PATCH", "DELETE")
+# Headers of the batch that every request of it carries
+FORWARDED_HEADERS = (consistency.TOKEN_HEADER, "X-Admin-Token")
+
+def _validate(sub_request) -> str | None:
+    # The reason a request of the batch is invalid, if it is.
+    if not isinstance(sub_request, dict):
+        return "not an object"
+    if sub_request.get("method", "GET") not in METHODS:
+        return f"method must be one of {', '.join(METHODS)}"
+    path = sub_request.get("path")
+    if not isinstance(path, str) or not path.startswith("/"):
+        return "path must start with '/'"
+    if urlsplit(path).path.rstrip("/") == request.path.rstrip("/"):
+        return "batches cannot be nested"
+    return None
+
+def _dispatch(app: Flask, environ: dict) -> dict:
+    # Runs a request through the app as its WSGI entry point would.
+    context = app.request_context(environ)
+    error = None
+    try:
+        try:
+            context.push()
+            response = app.full_dispatch_request()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            error = e
+            response = app.make_response(app.handle_exception(e))
+        result = {
+            "status": response.status_code,
+            "body": response.get_json(silent = True),
+        }
+        # The token of a write, for the caller to read its own writes
+        token = response.headers.get(consistency.TOKEN_HEADER)
+        if token is not None:
+            result["headers"] = {
+                consistency.TOKEN_HEADER: token,
+            }
+        return result
+    finally:
+        context.pop(error)
+
+@bp.route("/", methods = ["POST"])
+def run_batch():
+    """
+    Endpoint for running several requests concurrently, answering each of
+    them in the order they were sent.
+    """
+    body = request.get_json(silent = True)
+    if not isinstance(body, dict) or not isinstance(body.get("requests"), list):
+        return Error.PROPERTY_NOT_PROVIDED.get_response(property = "requests")
+    sub_requests = body["requests"]
+    if len(sub_requests) > MAX_REQUESTS:
+        return Error.BATCH_TOO_LARGE.get_response(maximum = MAX_REQUESTS)
+    for index, sub_request in enumerate(sub_requests):
+        reason = _validate(sub_request)
+        if reason is not None:
+            return Error.INVALID_BATCH_REQUEST.get_response(index = index, reason = reason)
+
+    app = current_app._get_current_object() # pylint: disable=protected-access
+    headers = {
+        header: request.headers[header]
+        for header in FORWARDED_HEADERS
+        if header in request.headers
+    }
+    # A pool per batch: requests still running after the timeout keep their
+    # threads, but never take the ones of later batches
+    pool = ThreadPoolExecutor(
+        max_workers = max(min(WORKERS, len(sub_requests)), 1),
+        thread_name_prefix = "batch",
+    )
+    try:
+        return _run(app, pool, sub_requests, headers)
+    finally:
+        # Requests that have not started are dropped; running ones finish
+        pool.shutdown(wait = False, cancel_futures = True)
+
+def _run(app: Flask, pool: ThreadPoolExecutor, sub_requests: list, headers: dict):
+    # Runs the requests of a batch on its pool, and gets the batch response.
+
+    # Identical reads run once and share their response
+    futures = []
+    reads = {}
+    for sub_request in sub_requests:
+        method = sub_request.get("method", "GET")
+        if method == "GET" and sub_request["path"] in reads:
+            futures.append(reads[sub_request["path"]])
+            continue
+
+        builder = EnvironBuilder(
+            path = sub_request["path"],
+            base_url = request.host_url,
+            method = method,
+            headers = headers,
+            json = sub_request.get("body"),
+            environ_overrides = {
+                "REMOTE_ADDR": request.remote_addr,
+            },
+        )
+        try:
+            environ = builder.get_environ()
+        finally:
+            builder.close()
+
+        future = pool.submit(_dispatch, app, environ)
+        if method == "GET":
+            reads[sub_request["path"]] = future
+        futures.append(future)
+
+    # The timeout only bounds how long the batch waits: a request that has
+    # started cannot be stopped, and finishes in the background
+    _, pending = concurrent.futures.wait(set(futures), timeout = TIMEOUT_SECONDS)
+    responses = []
+    for future in futures:
+        if future in pending:
+            if future.cancel():
+                error = Error.BATCH_TIMEOUT
+            else:
+                # Its writes may still be applied, so it is not reported as
+                # failed
+                error = Error.BATCH_REQUEST_PENDING
+            response, status = error.get_response(seconds = TIMEOUT_SECONDS)
+            responses.append({
+                "status": status,
+                "body": response.get_json(),
+            })
+        else:
+            responses.append(future.result())
+
+    return jsonify({"responses": responses}), 200
@@ -0,0 +1,125 @@
+"""
+Module for the 'charts/' route.
+"""
+from flask import Blueprint, jsonify, request
+from configs import mongodb
+from configs.errors import Error
+from utils import charts, helper
+
+bp = Blueprint("charts", __name__)
+
+@bp.route("/artists", methods = ["GET"])
+def get_artists_chart():
+    """
+    Endpoint for getting the most followed artists, optionally of a genre.
+    """
+    genre = request.args.get("genre", type = str)
+    limit = helper.parse_limit()
+    if limit is None:
+        return Error.INVALID_QUERY_PARAMETER.get_response(
+            parameter = "limit",
+            value = request.args.get("limit"),
+        )
+    if genre is not None and not helper.exists("genre", genre):
+        return Error.GENRE_NOT_FOUND.get_response(genre = genre)
+
+    try:
+        top = charts.top_artists(genre, limit)
+    except LookupError:
+        return Error.CHARTS_NOT_AVAILABLE.get_response()
+    names = {
+        artist["_id"]: artist["name"]
+        for artist in mongodb.db.artists.find(
+            {
+                "_id": {
+                    "$in": [artist_id for artist_id, _ in top],
+                },
+            },
+            {
+                "name": True,
+            },
+        )
+    }
+
+    return jsonify({
+        "genre": genre,
+        "items": [
+            {
+                "rank": rank,
+                "id": artist_id,
+                "name": names.get(artist_id),
+                "qt_followers": followers,
+            }
+            for rank, (artist_id, followers) in enumerate(top, start = 1)
+        ],
+    }), 200
+
+@bp.route("/releases", methods = ["GET"])
+def get_releases_chart():
+    """
+    Endpoint for getting the highest rated releases, optionally of a genre.
+    """
+    genre = request.args.get("genre", type = str)
+    limit = helper.parse_limit()
+    if limit is None:
+        return Error.INVALID_QUERY_PARAMETER.get_response(
+            parameter = "limit",
+            value = request.args.get("limit"),
+        )
+    if genre is not None and not helper.exists("genre", genre):
+        return Error.GENRE_NOT_FOUND.get_response(genre = genre)
+
+    try:
+        top = charts.top_releases(genre, limit)
+    except LookupError:
+        return Error.CHARTS_NOT_AVAILABLE.get_response()
+    release_ids = [release_id for release_id, _, _ in top]
+    releases = {
+        release["id"]: release
+        for release in mongodb.db.artists.aggregate([
+            {
+                "$match": {
+                    "releases.id": {
+                        "$in": release_ids,
+                    },
+                },
+            },
+            {
+                "$unwind": "$releases",
+            },
+            {
+                "$match": {
+                    "releases.id": {
+                        "$in": release_ids,
+                    },
+                },
+            },
+            {
+                "$project": {
+                    "_id": False,
+                    "id": "$releases.id",
+                    "name": "$releases.name",
+                    "artist": {
+                        "id": "$_id",
+                        "name": "$name",
+                    },
+                },
+            },
+        ])
+    }
+
+    return jsonify({
+        "genre": genre,
+        "min_ratings": charts.MIN_RATINGS,
+        "items": [
+            {
+                "rank": rank,
+                "id": release_id,
+                "name": releases.get(release_id, {}).get("name"),
+                "artist": releases.get(release_id, {}).get("artist"),
+                "rating_average": round(average, 2),
+                "qt_ratings": count,
+            }
+            for rank, (release_id, average, count) in enumerate(top, start = 1)
+        ],
+    }), 200
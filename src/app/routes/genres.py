@@ -0,0 +1,134 @@
+"""
+Module for the 'genres/' route.
+"""
+from flask import Blueprint, jsonify, request
+from configs import mongodb
+from configs.errors import Error
+from utils import counters, helper
+
+bp = Blueprint("genres", __name__)
+
+# Value of `sort` -> artist field, each backed by an index with `genres`
+SORT_FIELDS = {
+    "popularity": "popularity",
+    "followers": "qt_followers",
+}
+
+@bp.route("/", methods = ["GET"])
+def get_genres():
+    """
+    Endpoint for listing the genres in alphabetical order.
+    """
+    limit = helper.parse_limit(default = 50, maximum = 500)
+    if limit is None:
+        return Error.INVALID_QUERY_PARAMETER.get_response(
+            parameter = "limit",
+            value = request.args.get("limit"),
+        )
+
+    query = {}
+    cursor = request.args.get("cursor", type = str)
+    if cursor is not None:
+        values = helper.decode_cursor(cursor)
+        if not values:
+            return Error.INVALID_QUERY_PARAMETER.get_response(parameter = "cursor", value = cursor)
+        query["_id"] = {
+            "$gt": values[0],
+        }
+
+    genres = list(
+        mongodb.db.genres.find(query)
+        .sort("_id", 1)
+        .limit(limit + 1)
+    )
+    next_cursor = None
+    if len(genres) > limit:
+        genres = genres[:limit]
+        next_cursor = helper.encode_cursor(genres[-1]["_id"])
+
+    return jsonify({
+        "items": [
+            {
+                "name": genre["_id"],
+                "qt_artists": genre["qt_artists"],
+            }
+            for genre in genres
+        ],
+        "next_cursor": next_cursor,
+    }), 200
+
+@bp.route("/<name>/artists", methods = ["GET"])
+def get_genre_artists(name):
+    """
+    Endpoint for listing the artists of a genre by popularity or followers.
+    """
+    sort = request.args.get("sort", "popularity", type = str)
+    if sort not in SORT_FIELDS:
+        return Error.INVALID_QUERY_PARAMETER.get_response(parameter = "sort", value = sort)
+    field = SORT_FIELDS[sort]
+
+    limit = helper.parse_limit()
+    if limit is None:
+        return Error.INVALID_QUERY_PARAMETER.get_response(
+            parameter = "limit",
+            value = request.args.get("limit"),
+        )
+
+    query = {
+        "genres": name,
+    }
+    cursor = request.args.get("cursor", type = str)
+    if cursor is not None:
+        values = helper.decode_cursor(cursor)
+        if not values or len(values) != 2:
+            return Error.INVALID_QUERY_PARAMETER.get_response(parameter = "cursor", value = cursor)
+        # Resume right after the last artist of the previous page
+        query["$or"] = [
+            {
+                field: {
+                    "$lt": values[0],
+                },
+            },
+            {
+                field: values[0],
+                "_id": {
+                    "$gt": values[1],
+                },
+            },
+        ]
+
+    artists = list(
+        mongodb.db.artists.find(
+            query,
+            {
+                "name": True,
+                "popularity": True,
+                "qt_followers": True,
+            },
+        )
+        .sort([(field, -1), ("_id", 1)])
+        .limit(limit + 1)
+    )
+    if not artists and cursor is None and not helper.exists("genre", name):
+        return Error.GENRE_NOT_FOUND.get_response(genre = name)
+
+    next_cursor = None
+    if len(artists) > limit:
+        artists = artists[:limit]
+        next_cursor = helper.encode_cursor(artists[-1].get(field), artists[-1]["_id"])
+    pending = counters.pending_followers([artist["_id"] for artist in artists])
+
+    return jsonify({
+        "genre": name,
+        "sort": sort,
+        "items": [
+            {
+                "id": artist["_id"],
+                "name": artist["name"],
+                "popularity": artist.get("popularity"),
+                "qt_followers": artist.get("qt_followers", 0) + pending.get(artist["_id"], 0),
+            }
+            for artist in artists
+        ],
+        "next_cursor": next_cursor,
+    }), 200
@@ -0,0 +1,40 @@
+"""
+Module for the operational routes (health checks and metrics).
+"""
+from flask import Blueprint, Response, jsonify
+from utils import filters, metrics, warmup
+
+bp = Blueprint("health", __name__)
+
+@bp.route("/healthz", methods = ["GET"])
+def get_liveness():
+    """
+    Endpoint for checking if the process is alive, without touching the databases.
+    """
+    return jsonify({"status": "ok"}), 200
+
+@bp.route("/readyz", methods = ["GET"])
+def get_readiness():
+    """
+    Endpoint for checking if both databases are reachable and the pools are warm.
+    """
+    checks = warmup.ping()
+    startup = warmup.report()
+    ready = startup["warm"] and all(check["ok"] for check in checks.values())
+
+    response = {
+        "status": "ready" if ready else "not_ready",
+        "checks": checks,
+        "startup": startup,
+        "filters": filters.report(),
+    }
+
+    return jsonify(response), 200 if ready else 503
+
+@bp.route("/metrics", methods = ["GET"])
+def get_metrics():
+    """
+    Endpoint for scraping the Prometheus metrics.
+    """
+    body, content_type = metrics.render()
+    return Response(body, content_type = content_type), 200
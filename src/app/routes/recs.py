@@ -1,146 +1,257 @@
 """
 Module for the 'recs/' route.
 """
+import json
 import random
 from flask import Blueprint, jsonify, request
 from configs import mongodb, neo4j
 from configs.errors import Error
-from utils import helper
+from utils import embeddings, filters, helper, loaders, pagerank, singleflight
 
 bp = Blueprint("recs", __name__)
 
-@bp.route("/<username>/artists", methods = ["GET"])
-def get_artist_recs_by_genre(username):
+FAVORITE_GENRE_QUERY = """
+MATCH (:User {username: $username})-[:FOLLOWS]->(a:Artist)-[:BELONGS_TO]->(g:Genre)
+WITH g.name AS genre, count(DISTINCT a) AS follows_count
+ORDER BY follows_count DESC
+LIMIT 1
+RETURN genre
+"""
+
+ARTISTS_BY_GENRE_QUERY = """
+MATCH (a:Artist)-[:BELONGS_TO]->(g:Genre {name: $genre})
+WHERE NOT EXISTS {
+    MATCH (u:User {username: $username})-[:FOLLOWS]->(a)
+}
+ORDER BY a.popularity DESC
+LIMIT 10
+RETURN a.id AS id
+"""
+
+FRIENDS_TOP_RATINGS_QUERY = """
+MATCH (u:User {username: $username})-[:FRIENDS_WITH]-(friend:User)-[r:RATED]->(rel:Release)
+WHERE r.rating >= 6
+RETURN friend.username AS friend_username, rel.id AS release_id, r.rating AS rating
+ORDER BY r.rating DESC
+LIMIT 10
+"""
+
+USERS_BY_GENRE_QUERY = """
+MATCH (u:User)-[:FOLLOWS]->(a:Artist)-[:BELONGS_TO]->(g:Genre {name: $genre})
+WHERE NOT EXISTS {
+    MATCH (:User {username: $username})-[:FRIENDS_WITH]-(u)
+}
+WITH u, count(a) AS follows_count
+ORDER BY follows_count DESC
+LIMIT 10
+RETURN u.username AS recommended_user
+"""
+
+USER_TOP_RATINGS_QUERY = """
+MATCH (u:User {username: $username})-[r:RATED]->(rel:Release)
+WHERE r.rating >= 6
+RETURN rel.id AS release_id, r.rating AS rating
+ORDER BY r.rating DESC
+"""
+
+RELEASE_TOP_RATERS_QUERY = """
+MATCH (u:User)-[r:RATED]->(rel:Release)
+WHERE rel.id = $release_id
+AND r.rating >= 6
+AND NOT EXISTS {
+    MATCH (:User {username: $username})-[:FRIENDS_WITH]-(u)
+}
+AND u.username <> $username
+RETURN u.username AS username, r.rating AS rating
+ORDER BY r.rating DESC
+LIMIT 10
+"""
+
+ARTIST_REC_METHODS = ("genre", "graph")
+RELEASE_REC_METHODS = ("friends", "graph")
+
+# Queries whose plans are compiled ahead of time by the warm-up
+QUERIES = (
+    FAVORITE_GENRE_QUERY,
+    ARTISTS_BY_GENRE_QUERY,
+    FRIENDS_TOP_RATINGS_QUERY,
+    USERS_BY_GENRE_QUERY,
+    USER_TOP_RATINGS_QUERY,
+    RELEASE_TOP_RATERS_QUERY,
+)
+
+def candidates(name: str, query: str, **parameters) -> list:
     """
-    Endpoint for getting artist recommendations by genre.
+    Run a candidate query, sharing the records between identical concurrent
+    calls.
     """
-    if not helper.exists("user", username):
-        return Error.USER_NOT_FOUND.get_response(username = username)
+    return singleflight.do(
+        name,
+        json.dumps(parameters, sort_keys = True),
+        lambda: [
+            record.data()
+            for record in neo4j.execute_query(name, query, **parameters).records
+        ],
+    )
 
-    genre_result = neo4j.driver.execute_query(
-        """
-        MATCH (:User {username: $username})-[:FOLLOWS]->(a:Artist)-[:BELONGS_TO]->(g:Genre)
-        WITH g.name AS genre, count(DISTINCT a) AS follows_count
-        ORDER BY follows_count DESC
-        LIMIT 1
-        RETURN genre
-        """,
+def recommend_artist(username: str) -> tuple:
+    """
+    Recommend an artist of the user's favorite genre, returning the response
+    and None, or None and the error response.
+    """
+    genre_result = candidates(
+        "recs.favorite_genre",
+        FAVORITE_GENRE_QUERY,
         username=username,
     )
 
-    if not genre_result.records:
-        return Error.NO_GENRE_DATA_FOUND.get_response(username=username)
+    if not genre_result:
+        return None, Error.NO_GENRE_DATA_FOUND.get_response(username=username)
 
-    most_common_genre = genre_result.records[0]["genre"]
+    most_common_genre = genre_result[0]["genre"]
 
-    records, _, _ = neo4j.driver.execute_query(
-        """
-        MATCH (a:Artist)-[:BELONGS_TO]->(g:Genre {name: $genre})
-        WHERE NOT EXISTS {
-            MATCH (u:User {username: $username})-[:FOLLOWS]->(a)
-        }
-        ORDER BY a.popularity DESC
-        LIMIT 10
-        RETURN a.id AS id
-        """,
+    records = candidates(
+        "recs.artists_by_genre",
+        ARTISTS_BY_GENRE_QUERY,
         genre=most_common_genre,
         username=username,
     )
     if not records:
-        return Error.ARTIST_RECS_NOT_FOUND.get_response(
+        return None, Error.ARTIST_RECS_NOT_FOUND.get_response(
+            username=username,
+            genre=most_common_genre,
+        )
+
+    # Artists removed since the graph was written are skipped
+    artists = loaders.load_many("artist", [record["id"] for record in records])
+    available = [artist for artist in artists.values() if artist]
+    if not available:
+        return None, Error.ARTIST_RECS_NOT_FOUND.get_response(
             username=username,
             genre=most_common_genre,
         )
 
-    selected_artist_id = random.choice(records)["id"]
+    artist = random.choice(available)
+
+    response = {
+        "artist": {
+            "id": artist["id"],
+            "name": artist["name"],
+            "bio": artist["bio"],
+        },
+        "by": {
+            "genre": most_common_genre,
+        }
+    }
+
+    return response, None
+
+def _graph_recommendation(username: str, kind: str) -> tuple:
+    # One of the best ranked artists or releases for the user, with its score,
+    # leaving out the ones followed or rated since the graph snapshot.
+    try:
+        ranked = pagerank.recommend(username)
+    except LookupError:
+        return None, Error.GRAPH_NOT_AVAILABLE.get_response()
 
-    artist = mongodb.db.artists.find_one(
+    field = "follows" if kind == "artists" else "ratings"
+    user = mongodb.db.users.find_one(
         {
-            "_id": selected_artist_id,
+            "username": username,
         },
         {
             "_id": False,
-            "id": "$_id",
-            "name": True,
-            "bio": True,
-        }
+            f"{field}.id": True,
+        },
     )
+    known = {entry["id"] for entry in (user or {}).get(field) or []}
+    unseen = [item for item in (ranked or {}).get(kind, []) if item["id"] not in known]
+    if not unseen:
+        if kind == "artists":
+            return None, Error.ARTIST_RECS_NOT_FOUND.get_response(username = username)
+        return None, Error.RELEASE_RECS_NOT_FOUND.get_response(username = username)
+    return random.choice(unseen), None
+
+def recommend_artist_by_graph(username: str) -> tuple:
+    """
+    Recommend an artist by personalized PageRank from the user, returning the
+    response and None, or None and the error response.
+    """
+    selected, error = _graph_recommendation(username, "artists")
+    if error:
+        return None, error
+
+    artist = loaders.load("artist", selected["id"])
+    if not artist:
+        return None, Error.ARTIST_RECS_NOT_FOUND.get_response(username = username)
 
     response = {
         "artist": {
             "id": artist["id"],
             "name": artist["name"],
-            "bio": artist["bio"],
+            "bio": artist.get("bio"),
         },
         "by": {
-            "genre": most_common_genre,
+            "score": selected["score"],
         }
     }
 
-    return jsonify(response), 200
+    return response, None
 
-@bp.route("/<username>/releases/friends", methods = ["GET"])
-def get_release_recs_by_friends(username):
+@bp.route("/<username>/artists", methods = ["GET"])
+def get_artist_recs_by_genre(username):
     """
-    Endpoint for getting release recommendations by friends' positive reviews.
+    Endpoint for getting artist recommendations by genre, or by the whole
+    graph with `by=graph`.
     """
+    by = request.args.get("by", "genre", type = str)
+    if by not in ARTIST_REC_METHODS:
+        return Error.INVALID_REC_METHOD.get_response(method = by)
+
     if not helper.exists("user", username):
-        return Error.USER_NOT_FOUND.get_response(username=username)
+        return Error.USER_NOT_FOUND.get_response(username = username)
 
-    friends_rating = neo4j.driver.execute_query(
-        """
-        MATCH (u:User {username: $username})-[:FRIENDS_WITH]-(friend:User)-[r:RATED]->(rel:Release)
-        WHERE r.rating >= 6
-        RETURN friend.username AS friend_username, rel.id AS release_id, r.rating AS rating
-        ORDER BY r.rating DESC
-        LIMIT 10
-        """,
+    if by == "graph":
+        response, error = recommend_artist_by_graph(username)
+    else:
+        response, error = recommend_artist(username)
+    if error:
+        return error
+
+    return jsonify(response), 200
+
+def recommend_release(username: str) -> tuple:
+    """
+    Recommend a release rated highly by a friend of the user, returning the
+    response and None, or None and the error response.
+    """
+    friends_rating = candidates(
+        "recs.friends_top_ratings",
+        FRIENDS_TOP_RATINGS_QUERY,
         username = username
     )
 
     results = []
-    for record in friends_rating.records:
+    for record in friends_rating:
         results.append({
             "friend_username": record["friend_username"],
             "release_id": record["release_id"],
             "rating": record["rating"]
         })
     if not results:
-        return Error.NO_FRIENDS_RATINGS_FOUND.get_response()
+        return None, Error.NO_FRIENDS_RATINGS_FOUND.get_response()
 
     result = random.choice(results)
 
-    release_cursor = mongodb.db.artists.aggregate([
-        {
-            "$match": {
-                "releases.id": result["release_id"],
-            },
-        },
-        {
-            "$unwind": "$releases",
-        },
-        {
-            "$match": {
-                "releases.id": result["release_id"],
-            },
-        },
-        {
-            "$project": {
-                "_id": False,
-                "id": "$releases.id",
-                "name": "$releases.name",
-                "artist": "$name",
-            },
-        },
-    ])
-
-    release_results = tuple(release_cursor)
+    release = loaders.load("release", result["release_id"])
+    if not release:
+        return None, Error.RELEASE_RECS_NOT_FOUND.get_response(username = username)
 
     response = {
         "release": {
-            "id": release_results[0]["id"],
-            "name": release_results[0]["name"],
-            "artist": release_results[0]["artist"]
+            "id": release["id"],
+            "name": release["name"],
+            "artist": release["artist"]
         },
         "by": {
             "username": result["friend_username"],
@@ -148,6 +259,149 @@ def get_release_recs_by_friends(username):
         }
     }
 
+    return response, None
+
+def recommend_release_by_graph(username: str) -> tuple:
+    """
+    Recommend a release by personalized PageRank from the user, returning the
+    response and None, or None and the error response.
+    """
+    selected, error = _graph_recommendation(username, "releases")
+    if error:
+        return None, error
+
+    release = loaders.load("release", selected["id"])
+    if not release:
+        return None, Error.RELEASE_RECS_NOT_FOUND.get_response(username = username)
+
+    response = {
+        "release": {
+            "id": release["id"],
+            "name": release["name"],
+            "artist": release["artist"]
+        },
+        "by": {
+            "score": selected["score"],
+        }
+    }
+
+    return response, None
+
+@bp.route("/<username>/releases", methods = ["GET"])
+@bp.route("/<username>/releases/friends", methods = ["GET"])
+def get_release_recs_by_friends(username):
+    """
+    Endpoint for getting release recommendations by friends' positive reviews,
+    or by the whole graph with `by=graph`.
+    """
+    by = request.args.get("by", "friends", type = str)
+    if by not in RELEASE_REC_METHODS:
+        return Error.INVALID_REC_METHOD.get_response(method = by)
+
+    if not helper.exists("user", username):
+        return Error.USER_NOT_FOUND.get_response(username=username)
+
+    if by == "graph":
+        response, error = recommend_release_by_graph(username)
+    else:
+        response, error = recommend_release(username)
+    if error:
+        return error
+
+    return jsonify(response), 200
+
+def _embedded_user(username: str) -> tuple:
+    # The embeddings snapshot and the user's current ratings, or the error
+    # response.
+    limit = helper.parse_limit()
+    if limit is None:
+        return None, None, None, Error.INVALID_QUERY_PARAMETER.get_response(
+            parameter = "limit",
+            value = request.args.get("limit"),
+        )
+
+    model = embeddings.get()
+    if model is None:
+        return None, None, None, Error.EMBEDDINGS_NOT_AVAILABLE.get_response()
+
+    user = None
+    if filters.might_exist("user", username):
+        user = mongodb.db.users.find_one(
+            {
+                "username": username,
+            },
+            {
+                "_id": False,
+                "ratings.id": True,
+                "ratings.rating": True,
+            },
+        )
+    if not user:
+        return None, None, None, Error.USER_NOT_FOUND.get_response(username = username)
+
+    return model, user.get("ratings") or [], limit, None
+
+@bp.route("/<username>/releases/for-you", methods = ["GET"])
+def get_release_recs_by_embeddings(username):
+    """
+    Endpoint for getting the releases with the highest ratings estimated for
+    the user by the embeddings, out of the ones not rated yet.
+    """
+    model, ratings, limit, error = _embedded_user(username)
+    if error:
+        return error
+
+    estimates = model.releases_for(ratings, limit)
+    if not estimates:
+        return Error.RELEASE_RECS_NOT_FOUND.get_response(username = username)
+
+    releases = loaders.load_many("release", [release_id for release_id, _ in estimates])
+
+    response = {
+        "username": username,
+        "releases": [
+            {
+                "id": release_id,
+                "name": releases[release_id]["name"],
+                "artist": releases[release_id]["artist"],
+                "score": round(score, 4),
+            }
+            for release_id, score in estimates
+            if releases[release_id]
+        ],
+    }
+
+    return jsonify(response), 200
+
+@bp.route("/<username>/users/like-you", methods = ["GET"])
+def get_user_recs_by_embeddings(username):
+    """
+    Endpoint for getting the users whose ratings look the most like the
+    user's, by the cosine similarity of their embeddings.
+    """
+    model, ratings, limit, error = _embedded_user(username)
+    if error:
+        return error
+
+    neighbours = model.users_like(username, ratings, limit)
+    if not neighbours:
+        return Error.SIMILAR_USERS_NOT_FOUND.get_response(username = username)
+
+    users = loaders.load_many("user", [neighbour for neighbour, _ in neighbours])
+
+    response = {
+        "username": username,
+        "users": [
+            {
+                "username": neighbour,
+                "name": users[neighbour]["name"],
+                "score": round(score, 4),
+            }
+            for neighbour, score in neighbours
+            if users[neighbour]
+        ],
+    }
+
     return jsonify(response), 200
 
 @bp.route("/<username>/friends", methods = ["GET"])
@@ -178,57 +432,34 @@ def get_friend_recs_by_genre(username):
     """
     Endpoint for getting friend recommendations by genre affinity.
     """
-    genre_result = neo4j.driver.execute_query(
-        """
-        MATCH (:User {username: $username})-[:FOLLOWS]->(a:Artist)-[:BELONGS_TO]->(g:Genre)
-        WITH g.name AS genre, count(DISTINCT a) AS follows_count
-        ORDER BY follows_count DESC
-        LIMIT 1
-        RETURN genre
-        """,
+    genre_result = candidates(
+        "recs.favorite_genre",
+        FAVORITE_GENRE_QUERY,
         username=username,
     )
 
-    if not genre_result.records:
+    if not genre_result:
         return Error.NO_GENRE_DATA_FOUND.get_response(username = username)
 
-    most_common_genre = genre_result.records[0]["genre"]
+    most_common_genre = genre_result[0]["genre"]
 
-    recs_result = neo4j.driver.execute_query(
-        """
-        MATCH (u:User)-[:FOLLOWS]->(a:Artist)-[:BELONGS_TO]->(g:Genre {name: $genre})
-        WHERE NOT EXISTS {
-            MATCH (:User {username: $username})-[:FRIENDS_WITH]-(u)
-        }
-        WITH u, count(a) AS follows_count
-        ORDER BY follows_count DESC
-        LIMIT 10
-        RETURN u.username AS recommended_user
-        """,
+    recs_result = candidates(
+        "recs.users_by_genre",
+        USERS_BY_GENRE_QUERY,
         genre=most_common_genre,
         username=username,
     )
 
-    if not recs_result.records:
+    if not recs_result:
         return Error.NO_FRIEND_RECS_FOUND.get_response(username=username, genre=most_common_genre)
 
-    selected_username = random.choice(recs_result.records)["recommended_user"]
+    # Users removed since the graph was written are skipped
+    users = loaders.load_many("user", [record["recommended_user"] for record in recs_result])
+    available = [user for user in users.values() if user]
+    if not available:
+        return Error.NO_FRIEND_RECS_FOUND.get_response(username=username, genre=most_common_genre)
 
-    user_details = mongodb.db.users.find_one(
-        {
-            "username": selected_username,
-        },
-        {
-            "_id": False,
-            "username": True,
-            "name": {
-                "$ifNull": ["$name", None],
-            },
-            "bio": {
-                "$ifNull": ["$bio", None],
-            },
-        }
-    )
+    user_details = random.choice(available)
 
     response = {
         "user": {
@@ -248,18 +479,14 @@ def get_friend_recs_by_reviews(username):
     Endpoint for getting friend recommendations by review similarity.
     """
     # Get user's highest rated releases
-    reviews = neo4j.driver.execute_query(
-        """
-        MATCH (u:User {username: $username})-[r:RATED]->(rel:Release)
-        WHERE r.rating >= 6
-        RETURN rel.id AS release_id, r.rating AS rating
-        ORDER BY r.rating DESC
-        """,
+    reviews = candidates(
+        "recs.user_top_ratings",
+        USER_TOP_RATINGS_QUERY,
         username = username
     )
 
     rated_releases = []
-    for record in reviews.records:
+    for record in reviews:
         rated_releases.append(record["release_id"])
 
     if not rated_releases:
@@ -267,77 +494,31 @@ def get_friend_recs_by_reviews(username):
 
     selected_release = random.choice(rated_releases)
 
-    rated_reviews = neo4j.driver.execute_query(
-        """
-        MATCH (u:User)-[r:RATED]->(rel:Release)
-        WHERE rel.id = $release_id
-        AND r.rating >= 6
-        AND NOT EXISTS {
-            MATCH (:User {username: $username})-[:FRIENDS_WITH]-(u)
-        }
-        AND u.username <> $username
-        RETURN u.username AS username, r.rating AS rating
-        ORDER BY r.rating DESC
-        LIMIT 10
-        """,
+    rated_reviews = candidates(
+        "recs.release_top_raters",
+        RELEASE_TOP_RATERS_QUERY,
         release_id=selected_release,
         username=username
     )
 
-    if not rated_reviews.records:
+    if not rated_reviews:
         return Error.NO_FRIEND_RECS_FOUND.get_response(
             username = username,
             release_id = selected_release,
         )
 
-    recommended_user = random.choice(rated_reviews.records)
+    recommended_user = random.choice(rated_reviews)
     selected_username = recommended_user["username"]
     friend_rating = recommended_user["rating"]
 
-    user_details = mongodb.db.users.find_one(
-        {
-            "username": selected_username,
-        },
-        {
-            "_id": False,
-            "username": True,
-            "name": {
-                "$ifNull": ["$name", None],
-            },
-            "bio": {
-                "$ifNull": ["$bio", None],
-            },
-        },
-    )
+    user_details = loaders.load("user", selected_username)
 
     if not user_details:
         return Error.USER_NOT_FOUND.get_response(username=selected_username)
 
-    release_cursor = mongodb.db.artists.aggregate([
-        {
-            "$match": {
-                "releases.id": selected_release,
-            },
-        },
-        {
-            "$unwind": "$releases",
-        },
-        {
-            "$match": {
-                "releases.id": selected_release,
-            },
-        },
-        {
-            "$project": {
-                "_id": False,
-                "id": "$releases.id",
-                "name": "$releases.name",
-                "artist": "$name",
-            },
-        },
-    ])
-
-    release_results = tuple(release_cursor)
+    release = loaders.load("release", selected_release)
+    if not release:
+        return Error.RELEASE_NOT_FOUND.get_response(id = selected_release)
 
     response = {
         "user": {
@@ -346,9 +527,9 @@ def get_friend_recs_by_reviews(username):
             "bio": user_details["bio"]
         },
         "by": {
-            "id": release_results[0]["id"],
-            "name": release_results[0]["name"],
-            "artist": release_results[0]["artist"],
+            "id": release["id"],
+            "name": release["name"],
+            "artist": release["artist"],
             "rating": friend_rating
         }
     }
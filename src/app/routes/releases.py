@@ -1,18 +1,36 @@
 """
 Module for the 'releases/' route.
 """
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request
 from configs import mongodb
 from configs.errors import Error
+from utils import catalog, filters, helper, singleflight
 
 bp = Blueprint("releases", __name__)
 
-@bp.route("/<release_id>", methods = ["GET"])
-def get_release(release_id):
-    """
-    Endpoint for getting the release resource by release ID.
-    """
-    release_cursor = mongodb.db.artists.aggregate([
+RELEASE_FIELDS = ("id", "name", "artist", "release_date", "rating_average")
+RELEASE_EMBEDDED = ("tracks",)
+# Fields of get_release that change between ingestions
+RELEASE_STATS = {"rating_average"}
+
+# The $project expression of each field of get_release, after the $unwind
+RELEASE_PROJECTION = {
+    "id": "$releases.id",
+    "name": "$releases.name",
+    "artist": {
+        "id": "$_id",
+        "name": "$name",
+    },
+    "release_date": "$releases.release_date",
+    "rating_average": {
+        "$avg": "$releases.ratings.rating",
+    },
+    "tracks": "$releases.tracks",
+}
+
+def _find_release(name: str, release_id: str, fields: set) -> dict | None:
+    # Reads only the selected fields, computing nothing else.
+    pipeline = [
         {
             "$match": {
                 "releases.id": release_id,
@@ -29,41 +47,63 @@ def get_release(release_id):
         {
             "$project": {
                 "_id": False,
-                "id": "$releases.id",
-                "name": "$releases.name",
-                "artist": {
-                    "id": "$_id",
-                    "name": "$name",
-                },
-                "release_date": "$releases.release_date",
-                "rating_average": {
-                    "$cond": {
-                        "if": {
-                            "$gt": [{"$size": "$releases.ratings"}, 0],
-                        },
-                        "then": {
-                            "$avg": "$releases.ratings.rating",
-                        },
-                        "else": None,
-                    },
+                **{
+                    field: expression
+                    for field, expression in RELEASE_PROJECTION.items()
+                    if field in fields
                 },
-                "tracks": "$releases.tracks",
             },
         },
-    ])
+    ]
+    release_results = singleflight.do(
+        name,
+        f"{release_id}:{','.join(sorted(fields))}",
+        lambda: tuple(mongodb.db.artists.aggregate(pipeline)),
+    )
+    # The result may be shared with other requests, so it is copied
+    return dict(release_results[0]) if release_results else None
 
-    release_results = tuple(release_cursor)
-    if not release_results:
+@bp.route("/<release_id>", methods = ["GET"])
+def get_release(release_id):
+    """
+    Endpoint for getting the release resource by release ID.
+    """
+    fields, invalid = helper.parse_fields(RELEASE_FIELDS, RELEASE_EMBEDDED, RELEASE_EMBEDDED)
+    if invalid:
+        return Error.INVALID_QUERY_PARAMETER.get_response(
+            parameter = invalid,
+            value = request.args[invalid],
+        )
+    fields.add("id")
+
+    if not filters.might_exist("release", release_id):
         return Error.RELEASE_NOT_FOUND.get_response(id = release_id)
 
-    return jsonify(release_results[0]), 200
+    snapshot = catalog.get()
+    release = snapshot.release(release_id) if snapshot is not None else None
+    if release is not None:
+        release = {field: value for field, value in release.items() if field in fields}
+        if fields & RELEASE_STATS:
+            stats = _find_release("releases.get_release_stats", release_id, fields & RELEASE_STATS)
+            if stats is None:
+                return Error.RELEASE_NOT_FOUND.get_response(id = release_id)
+            release.update(stats)
+    else:
+        release = _find_release("releases.get_release", release_id, fields)
+        if release is None:
+            return Error.RELEASE_NOT_FOUND.get_response(id = release_id)
+
+    return jsonify(release), 200
 
 @bp.route("/<release_id>/ratings", methods = ["GET"])
 def get_release_ratings(release_id):
     """
     Endpoint for getting all ratings for a specific release.
     """
-    release_cursor = mongodb.db.artists.aggregate([
+    if not filters.might_exist("release", release_id):
+        return Error.RELEASE_NOT_FOUND.get_response(id = release_id)
+
+    pipeline = [
         {
             "$match": {
                 "releases.id": release_id,
@@ -88,9 +128,13 @@ def get_release_ratings(release_id):
                 "items": "$releases.ratings",
             },
         },
-    ])
+    ]
 
-    release_results = tuple(release_cursor)
+    release_results = singleflight.do(
+        "releases.get_release_ratings",
+        release_id,
+        lambda: tuple(mongodb.db.artists.aggregate(pipeline)),
+    )
     if not release_results:
         return Error.RELEASE_NOT_FOUND.get_response(id = release_id)
 
@@ -3,17 +3,56 @@ Module for the 'users/' route.
 """
 import hashlib
 from flask import Blueprint, jsonify, request
+from pymongo import ReturnDocument
 from configs import mongodb, neo4j
 from configs.errors import Error
-from utils import helper
+from routes import recs
+from utils import charts, counters, feed, filters, helper, loaders, parallel, similar
 
 bp = Blueprint("users", __name__)
 
+USER_FIELDS = ("username", "name", "bio", "qt_friends", "qt_ratings", "qt_follows")
+USER_EMBEDDED = ("friends", "ratings", "follows")
+
+# The $project expression of each field of get_user
+USER_PROJECTION = {
+    "username": True,
+    "name": {
+        "$ifNull": ["$name", None],
+    },
+    "bio": {
+        "$ifNull": ["$bio", None],
+    },
+    "qt_friends": {
+        "$size": "$friends",
+    },
+    "qt_ratings": {
+        "$size": "$ratings",
+    },
+    "qt_follows": {
+        "$size": "$follows",
+    },
+    "friends": True,
+    "ratings": True,
+    "follows": True,
+}
+
 @bp.route("/<username>", methods = ["GET"])
 def get_user(username):
     """
     Endpoint for getting the user resource by username.
     """
+    fields, invalid = helper.parse_fields(USER_FIELDS, USER_EMBEDDED)
+    if invalid:
+        return Error.INVALID_QUERY_PARAMETER.get_response(
+            parameter = invalid,
+            value = request.args[invalid],
+        )
+    fields.add("username")
+
+    if not filters.might_exist("user", username):
+        return Error.USER_NOT_FOUND.get_response(username = username)
+
     user_cursor = mongodb.db.users.aggregate([
         {
             "$match": {
@@ -23,21 +62,10 @@ def get_user(username):
         {
             "$project": {
                 "_id": False,
-                "username": True,
-                "name": {
-                    "$ifNull": ["$name", None],
-                },
-                "bio": {
-                    "$ifNull": ["$bio", None],
-                },
-                "qt_friends": {
-                    "$size": "$friends",
-                },
-                "qt_ratings": {
-                    "$size": "$ratings",
-                },
-                "qt_follows": {
-                    "$size": "$follows",
+                **{
+                    field: expression
+                    for field, expression in USER_PROJECTION.items()
+                    if field in fields
                 },
             },
         },
@@ -54,6 +82,9 @@ def get_user_friends(username):
     """
     Endpoint for getting all friends of a user.
     """
+    if not filters.might_exist("user", username):
+        return Error.USER_NOT_FOUND.get_response(username = username)
+
     user_cursor = mongodb.db.users.aggregate([
         {
             "$match": {
@@ -80,6 +111,9 @@ def get_user_ratings(username):
     """
     Endpoint for getting all ratings of a user.
     """
+    if not filters.might_exist("user", username):
+        return Error.USER_NOT_FOUND.get_response(username = username)
+
     user_cursor = mongodb.db.users.aggregate([
         {
             "$match": {
@@ -106,6 +140,9 @@ def get_user_follows(username):
     """
     Endpoint for getting all artists followed by a user.
     """
+    if not filters.might_exist("user", username):
+        return Error.USER_NOT_FOUND.get_response(username = username)
+
     user_cursor = mongodb.db.users.aggregate([
         {
             "$match": {
@@ -127,6 +164,107 @@ def get_user_follows(username):
 
     return jsonify(user_results[0]), 200
 
+@bp.route("/<username>/feed", methods = ["GET"])
+def get_user_feed(username):
+    """
+    Endpoint for getting the latest ratings and follows of a user's friends.
+    """
+    limit = helper.parse_limit(default = 20)
+    if limit is None:
+        return Error.INVALID_QUERY_PARAMETER.get_response(
+            parameter = "limit",
+            value = request.args.get("limit"),
+        )
+
+    before = None
+    cursor = request.args.get("cursor", type = str)
+    if cursor is not None:
+        before = helper.decode_cursor(cursor)
+        # A sort key of the feed: a timestamp, then a username, type and ID
+        if (
+            not before
+            or len(before) != 4
+            or isinstance(before[0], bool)
+            or not isinstance(before[0], (int, float))
+            or not all(isinstance(value, str) for value in before[1:])
+        ):
+            return Error.INVALID_QUERY_PARAMETER.get_response(parameter = "cursor", value = cursor)
+        before = tuple(before)
+
+    if not helper.exists("user", username):
+        return Error.USER_NOT_FOUND.get_response(username = username)
+
+    events, next_key = feed.read(username, before, limit)
+
+    return jsonify({
+        "username": username,
+        "items": events,
+        "next_cursor": helper.encode_cursor(*next_key) if next_key else None,
+    }), 200
+
+DASHBOARD_SECTIONS = ("friends", "ratings", "follows")
+
+@bp.route("/<username>/dashboard", methods = ["GET"])
+def get_user_dashboard(username):
+    """
+    Endpoint for getting the profile, the latest friends, ratings and follows
+    and the recommendations of a user in one response, read concurrently.
+    """
+    limits = {}
+    for section in DASHBOARD_SECTIONS:
+        limits[section] = helper.parse_limit(parameter = f"{section}_limit")
+        if limits[section] is None:
+            return Error.INVALID_QUERY_PARAMETER.get_response(
+                parameter = f"{section}_limit",
+                value = request.args.get(f"{section}_limit"),
+            )
+
+    if not filters.might_exist("user", username):
+        return Error.USER_NOT_FOUND.get_response(username = username)
+
+    def profile():
+        # Also the existence check: the recommendations of a user that does
+        # not exist are discarded
+        return mongodb.db.users.find_one(
+            {
+                "username": username,
+            },
+            {
+                "_id": False,
+                **{field: USER_PROJECTION[field] for field in USER_FIELDS},
+                **{
+                    section: {
+                        "$slice": -limits[section],
+                    }
+                    for section in DASHBOARD_SECTIONS
+                },
+            },
+        )
+
+    def recommendation(recommend):
+        response, error = recommend(username)
+        return response if error is None else None
+
+    results = parallel.run(
+        {
+            "profile": profile,
+            "artist_recommendation": lambda: recommendation(recs.recommend_artist),
+            "release_recommendation": lambda: recommendation(recs.recommend_release),
+        },
+        required = ("profile",),
+    )
+    user = results.pop("profile")
+    if user is None:
+        return Error.USER_NOT_FOUND.get_response(username = username)
+
+    return jsonify({
+        **user,
+        "recommendations": {
+            "artist": results["artist_recommendation"],
+            "release": results["release_recommendation"],
+        },
+    }), 200
+
 @bp.route("/", methods = ["POST"])
 def register_user():
     """
@@ -156,10 +294,13 @@ def register_user():
     user["friends"] = []
     user["ratings"] = []
     user["follows"] = []
+    user["updated_at"] = feed.now()
 
     mongodb.db.users.insert_one(user)
+    filters.add("user", username)
 
-    neo4j.driver.execute_query(
+    neo4j.execute_query(
+        "users.create_user",
         """
         MERGE (u:User {username: $username})
         """,
@@ -192,6 +333,9 @@ def delete_user(username):
                 "username": friend,
             },
             {
+                "$currentDate": {
+                    "updated_at": True,
+                },
                 "$pull": {
                     "friends": username,
                 },
@@ -199,30 +343,32 @@ def delete_user(username):
         )
 
     for rating in user["ratings"]:
-        mongodb.db.artists.update_one(
+        artist = mongodb.db.artists.find_one_and_update(
             {
                 "releases.id": rating["id"],
             },
             {
+                "$currentDate": {
+                    "updated_at": True,
+                },
                 "$pull": {
                     "releases.$.ratings": {
                         "username": username,
                     },
                 },
             },
-        )
-
-    for follow in user["follows"]:
-        mongodb.db.artists.update_one(
             {
-                "_id": follow["id"],
-            },
-            {
-                "$inc": {
-                    "qt_followers": -1,
-                },
+                "genres": True,
             },
         )
+        if artist:
+            charts.rate(rating["id"], artist.get("genres"), rating["rating"], -1)
+
+    for follow in user["follows"]:
+        artist = counters.incr_followers(follow["id"], -1, {"genres": True})
+        if artist:
+            charts.follow(follow["id"], artist.get("genres"), -1)
+    similar.mark(follow["id"] for follow in user["follows"])
 
     mongodb.db.users.delete_one(
         {
@@ -230,7 +376,10 @@ def delete_user(username):
         },
     )
 
-    neo4j.driver.execute_query(
+    feed.remove_user(username, user["friends"])
+
+    neo4j.execute_query(
+        "users.delete_user",
         """
         MATCH (u:User {username: $username})
         DETACH DELETE u
@@ -274,7 +423,11 @@ def update_user(username):
     if not update_ops and not unset_ops:
         return Error.NO_VALID_FIELDS.get_response()
 
-    update_doc = {}
+    update_doc = {
+        "$currentDate": {
+            "updated_at": True,
+        },
+    }
     if update_ops:
         update_doc["$set"] = update_ops
     if unset_ops:
@@ -306,56 +459,39 @@ def rate_release(username):
     if not helper.exists("user", username):
         return Error.USER_NOT_FOUND.get_response(username = username)
 
-    release_cursor = mongodb.db.artists.aggregate([
-        {
-            "$match": {
-                "releases.id": release_id,
-            },
-        },
-        {
-            "$unwind": "$releases",
-        },
-        {
-            "$match": {
-                "releases.id": release_id,
-            },
-        },
-        {
-            "$project": {
-                "_id": False,
-                "id": "$releases.id",
-                "artist": "$name",
-                "name": "$releases.name",
-            }
-        }
-    ])
-
-    release_results = tuple(release_cursor)
-    if not release_results:
+    release = loaders.load("release", release_id)
+    if not release:
         return Error.RELEASE_NOT_FOUND.get_response(id = release_id)
 
-    release: dict = release_results[0]
-
     if helper.exists("rating", username, release_id):
         return Error.RATING_ALREADY_EXISTS.get_response(
             username = username,
             release_id = release_id,
         )
 
-    mongodb.db.users.update_one(
+    user_rating = {
+        "id": release["id"],
+        "artist": release["artist"],
+        "name": release["name"],
+        "rating": rating,
+        "created_at": feed.now(),
+    }
+
+    user = mongodb.db.users.find_one_and_update(
         {
             "username": username,
         },
         {
+            "$currentDate": {
+                "updated_at": True,
+            },
             "$push": {
-                "ratings": {
-                    "id": release["id"],
-                    "artist": release["artist"],
-                    "name": release["name"],
-                    "rating": rating,
-                },
+                "ratings": user_rating,
             },
         },
+        {
+            "friends": True,
+        },
     )
 
     mongodb.db.artists.update_one(
@@ -363,27 +499,36 @@ def rate_release(username):
             "releases.id": release_id,
         },
         {
+            "$currentDate": {
+                "updated_at": True,
+            },
             "$push": {
                 "releases.$.ratings": {
                     "username": username,
-                    "rating": rating
+                    "rating": rating,
+                    "created_at": user_rating["created_at"],
                 }
             }
         }
     )
 
-    neo4j.driver.execute_query(
+    neo4j.execute_query(
+        "users.create_rating",
         """
         MATCH (r:Release {id: $release_id})
         MATCH (u:User {username: $username})
         MERGE (u)-[rel:RATED]->(r)
-        ON CREATE SET rel.rating = $rating
+        ON CREATE SET rel.rating = $rating, rel.created_at = $created_at
         """,
         release_id = release["id"],
         username = username,
         rating = rating,
+        created_at = user_rating["created_at"],
     )
 
+    charts.rate(release_id, release.get("genres"), rating, 1)
+    feed.publish((user or {}).get("friends") or [], feed.rating_event(username, user_rating))
+
     return jsonify(), 201
 
 @bp.route("/<username>/ratings/<release_id>", methods = ["DELETE"])
@@ -401,33 +546,51 @@ def unrate_release(username, release_id):
             username = username,
         )
 
-    mongodb.db.users.update_one(
+    user = mongodb.db.users.find_one_and_update(
         {
             "username": username,
         },
         {
+            "$currentDate": {
+                "updated_at": True,
+            },
             "$pull": {
                 "ratings": {
                     "id": release_id,
                 },
             },
         },
+        {
+            "friends": True,
+            "ratings": {
+                "$elemMatch": {
+                    "id": release_id,
+                },
+            },
+        },
     )
 
-    mongodb.db.artists.update_one(
+    artist = mongodb.db.artists.find_one_and_update(
         {
             "releases.id": release_id,
         },
         {
+            "$currentDate": {
+                "updated_at": True,
+            },
             "$pull": {
                 "releases.$.ratings": {
                     "username": username,
                 },
             },
         },
+        {
+            "genres": True,
+        },
     )
 
-    neo4j.driver.execute_query(
+    neo4j.execute_query(
+        "users.delete_rating",
         """
         MATCH (u:User {username: $username})-[r:RATED]->(rel:Release {id: $release_id})
         DELETE r
@@ -436,6 +599,11 @@ def unrate_release(username, release_id):
         release_id = release_id,
     )
 
+    if user and user.get("ratings") and artist:
+        charts.rate(release_id, artist.get("genres"), user["ratings"][0]["rating"], -1)
+    if user:
+        feed.retract(username, (user or {}).get("friends") or [], "rating", release_id)
+
     return jsonify(), 200
 
 @bp.route("/<username>/follows", methods = ["POST"])
@@ -451,15 +619,7 @@ def follow_artist(username):
     if not helper.exists("user", username):
         return Error.USER_NOT_FOUND.get_response(username = username)
 
-    artist = mongodb.db.artists.find_one(
-        {
-            "_id": artist_id,
-        },
-        {
-            "_id": True,
-            "name": True,
-        },
-    )
+    artist = loaders.load("artist", artist_id)
     if not artist:
         return Error.ARTIST_NOT_FOUND.get_response(id = artist_id)
 
@@ -469,41 +629,49 @@ def follow_artist(username):
             artist_id = artist_id,
         )
 
-    mongodb.db.users.update_one(
+    user_follow = {
+        "id": artist_id,
+        "name": artist["name"],
+        "created_at": feed.now(),
+    }
+
+    user = mongodb.db.users.find_one_and_update(
         {
             "username": username,
         },
         {
+            "$currentDate": {
+                "updated_at": True,
+            },
             "$push": {
-                "follows": {
-                    "id": artist_id,
-                    "name": artist["name"],
-                },
+                "follows": user_follow,
             },
         },
-    )
-
-    mongodb.db.artists.update_one(
-        {
-            "_id": artist_id,
-        },
         {
-            "$inc": {
-                "qt_followers": 1,
-            },
+            "friends": True,
+            "follows.id": True,
         },
     )
 
-    neo4j.driver.execute_query(
+    counters.incr_followers(artist_id, 1)
+    similar.mark([artist_id] + [follow["id"] for follow in (user or {}).get("follows") or []])
+
+    neo4j.execute_query(
+        "users.create_follow",
         """
         MATCH (u:User {username: $username})
         MATCH (a:Artist {id: $artist_id})
-        MERGE (u)-[:FOLLOWS]->(a)
+        MERGE (u)-[f:FOLLOWS]->(a)
+        ON CREATE SET f.created_at = $created_at
         """,
         artist_id = artist_id,
         username = username,
+        created_at = user_follow["created_at"],
     )
 
+    charts.follow(artist_id, artist.get("genres"), 1)
+    feed.publish((user or {}).get("friends") or [], feed.follow_event(username, user_follow))
+
     return jsonify(), 201
 
 @bp.route("/<username>/follows/<artist_id>", methods = ["DELETE"])
@@ -521,31 +689,31 @@ def unfollow_artist(username, artist_id):
             username = username,
         )
 
-    mongodb.db.users.update_one(
+    user = mongodb.db.users.find_one_and_update(
         {
             "username": username,
         },
         {
+            "$currentDate": {
+                "updated_at": True,
+            },
             "$pull": {
                 "follows": {
                     "id": artist_id,
                 },
             },
         },
-    )
-
-    mongodb.db.artists.update_one(
-        {
-            "_id": artist_id,
-        },
         {
-            "$inc": {
-                "qt_followers": -1,
-            },
+            "friends": True,
+            "follows.id": True,
         },
     )
 
-    neo4j.driver.execute_query(
+    artist = counters.incr_followers(artist_id, -1, {"genres": True})
+    similar.mark(follow["id"] for follow in (user or {}).get("follows") or [])
+
+    neo4j.execute_query(
+        "users.delete_follow",
         """
         MATCH (u:User {username: $username})-[f:FOLLOWS]->(a:Artist {id: $artist_id})
         DELETE f
@@ -554,6 +722,11 @@ def unfollow_artist(username, artist_id):
         artist_id = artist_id,
     )
 
+    # The artist may have been removed meanwhile
+    if artist:
+        charts.follow(artist_id, artist.get("genres"), -1)
+    feed.retract(username, (user or {}).get("friends") or [], "follow", artist_id)
+
     return jsonify(), 200
 
 @bp.route("/<username>/friends", methods = ["POST"])
@@ -566,6 +739,7 @@ def befriend_user(username):
         return Error.PROPERTY_NOT_PROVIDED.get_response(property = "username")
 
     friend_username = body["username"]
+    loaders.prime("user", username, friend_username)
     if not helper.exists("user", username):
         return Error.USER_NOT_FOUND.get_response(username = username)
     if not helper.exists("user", friend_username):
@@ -576,39 +750,77 @@ def befriend_user(username):
             username2 = friend_username,
         )
 
-    mongodb.db.users.update_one(
+    user = mongodb.db.users.find_one_and_update(
         {
             "username": username,
         },
         {
+            "$currentDate": {
+                "updated_at": True,
+            },
             "$push": {
                 "friends": friend_username,
             },
         },
+        {
+            "username": True,
+            "qt_friends": {
+                "$size": "$friends",
+            },
+            "ratings": {
+                "$slice": -feed.RECENT_PER_FRIEND,
+            },
+            "follows": {
+                "$slice": -feed.RECENT_PER_FRIEND,
+            },
+        },
+        return_document = ReturnDocument.AFTER,
     )
 
-    mongodb.db.users.update_one(
+    friend = mongodb.db.users.find_one_and_update(
         {
             "username": friend_username,
         },
         {
+            "$currentDate": {
+                "updated_at": True,
+            },
             "$push": {
                 "friends": username,
             },
         },
+        {
+            "username": True,
+            "qt_friends": {
+                "$size": "$friends",
+            },
+            "ratings": {
+                "$slice": -feed.RECENT_PER_FRIEND,
+            },
+            "follows": {
+                "$slice": -feed.RECENT_PER_FRIEND,
+            },
+        },
+        return_document = ReturnDocument.AFTER,
     )
 
-    neo4j.driver.execute_query(
+    neo4j.execute_query(
+        "users.create_friendship",
         """
         MATCH (u1:User {username: $username})
         MATCH (u2:User {username: $friend_username})
-        MERGE (u1)-[:FRIENDS_WITH]->(u2)
-        MERGE (u1)<-[:FRIENDS_WITH]-(u2)
+        MERGE (u1)-[f1:FRIENDS_WITH]->(u2)
+        ON CREATE SET f1.created_at = $created_at
+        MERGE (u1)<-[f2:FRIENDS_WITH]-(u2)
+        ON CREATE SET f2.created_at = $created_at
         """,
         username = username,
         friend_username = friend_username,
+        created_at = feed.now(),
     )
 
+    feed.befriend(user, friend)
+
     return jsonify(), 201
 
 @bp.route("/<username>/friends/<friend_username>", methods = ["DELETE"])
@@ -616,6 +828,7 @@ def unfriend_user(username, friend_username):
     """
     Endpoint for removing a friend.
     """
+    loaders.prime("user", username, friend_username)
     if not helper.exists("user", username):
         return Error.USER_NOT_FOUND.get_response(username = username)
     if not helper.exists("user", friend_username):
@@ -626,29 +839,30 @@ def unfriend_user(username, friend_username):
             username2 = friend_username,
         )
 
-    mongodb.db.users.update_one(
-        {
-            "username": username,
-        },
-        {
-            "$pull": {
-                "friends": friend_username,
+    for reader, author in ((username, friend_username), (friend_username, username)):
+        user = mongodb.db.users.find_one_and_update(
+            {
+                "username": reader,
             },
-        },
-    )
-
-    mongodb.db.users.update_one(
-        {
-            "username": friend_username,
-        },
-        {
-            "$pull": {
-                "friends": username,
+            {
+                "$currentDate": {
+                    "updated_at": True,
+                },
+                "$pull": {
+                    "friends": author,
+                },
             },
-        },
-    )
+            {
+                "qt_friends": {
+                    "$size": "$friends",
+                },
+            },
+            return_document = ReturnDocument.AFTER,
+        )
+        feed.set_friend_count(reader, user["qt_friends"])
 
-    neo4j.driver.execute_query(
+    neo4j.execute_query(
+        "users.delete_friendship",
         """
         MATCH (u1:User {username: $username1})-[f1:FRIENDS_WITH]->(u2:User {username: $username2})
         MATCH (u1)<-[f2:FRIENDS_WITH]-(u2)
@@ -658,4 +872,6 @@ def unfriend_user(username, friend_username):
         username2 = friend_username,
     )
 
+    feed.unfriend(username, friend_username)
+
     return jsonify(), 200
@@ -0,0 +1,379 @@
+"""
+Module for the read-only catalog snapshot served from memory-mapped files.
+
+Artists, releases and tracks only change on ingestion, so `python manage.py
+catalog` compiles them into one binary file, and with `CATALOG_SNAPSHOT` set
+every worker memory-maps it: the OS shares its pages between the workers, and
+a lookup is a binary search over fixed-width records that only decodes the
+strings it returns. Ratings and followers keep changing, so the routes still
+read those from MongoDB.
+
+The file is replaced atomically by a rename. Workers check it every
+`CATALOG_CHECK_SECONDS` and map the new one; requests already reading the old
+one keep it until they finish.
+
+Layout, little-endian: a header with the magic, the version, the build time
+and the offset and count of each section, then the sections. Strings are
+interned once in a pool and referenced by index (`NULL` for none).
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from configs import mongodb
+
+PATH = os.getenv("CATALOG_SNAPSHOT")
+CHECK_SECONDS = float(os.getenv("CATALOG_CHECK_SECONDS", "5"))
+
+MAGIC = b"CATALOG1"
+VERSION = 1
+NULL = 0xFFFFFFFF
+NULL_YEAR = -(2 ** 31)
+
+SECTIONS = ("string_offsets", "strings", "artists", "genres", "releases", "release_index", "tracks")
+HEADER = struct.Struct("<8sIId" + "QQ" * len(SECTIONS))
+STRING_OFFSET = struct.Struct("<Q")
+# ID, name, bio, first genre, genres, first release, releases
+ARTIST = struct.Struct("<7I")
+GENRE = struct.Struct("<I")
+# ID, name, release date, release year, artist, first track, tracks
+RELEASE = struct.Struct("<3Ii3I")
+RELEASE_INDEX = struct.Struct("<I")
+# Name, track number, duration
+TRACK = struct.Struct("<Iiq")
+
+def _track_order(item: tuple) -> tuple:
+    # Tracks without a name first, then by the bytes of the name, as MongoDB
+    # sorts them.
+    name = item[0]
+    return (name is not None, (name or "").encode("utf-8"))
+
+class Strings:
+    """
+    Pool of interned strings, numbered in order of first use.
+    """
+    def __init__(self):
+        self.index = {}
+        self.values = []
+
+    def add(self, value: str | None) -> int:
+        """Get the number of a string, adding it if new."""
+        if value is None:
+            return NULL
+        number = self.index.get(value)
+        if number is None:
+            number = self.index[value] = len(self.values)
+            self.values.append(value.encode("utf-8"))
+        return number
+
+def _load():
+    # The static fields of every artist, with the release years computed
+    # as get_artist computes them.
+    return mongodb.get_db().artists.aggregate([
+        {
+            "$project": {
+                "name": True,
+                "genres": True,
+                "bio": True,
+                "releases": {
+                    "$map": {
+                        "input": "$releases",
+                        "as": "release",
+                        "in": {
+                            "id": "$$release.id",
+                            "name": "$$release.name",
+                            "release_date": "$$release.release_date",
+                            "release_year": {
+                                "$year": {
+                                    "$dateFromString": {
+                                        "dateString": "$$release.release_date",
+                                        "onError": None,
+                                        "onNull": None,
+                                    },
+                                },
+                            },
+                            "tracks": "$$release.tracks",
+                        },
+                    },
+                },
+            },
+        },
+    ])
+
+def build(path: str) -> dict:
+    """
+    Compile the catalog into the file at `path`, replacing it atomically, and
+    get the number of artists, releases and tracks.
+    """
+    strings = Strings()
+    artists = []
+    genres = []
+    releases = []
+    tracks = []
+
+    for artist in sorted(_load(), key = lambda artist: artist["_id"].encode("utf-8")):
+        artist_genres = artist.get("genres") or []
+        artist_releases = artist.get("releases") or []
+        artists.append(ARTIST.pack(
+            strings.add(artist["_id"]),
+            strings.add(artist.get("name")),
+            strings.add(artist.get("bio")),
+            len(genres),
+            len(artist_genres),
+            len(releases),
+            len(artist_releases),
+        ))
+        genres.extend(GENRE.pack(strings.add(genre)) for genre in artist_genres)
+        for release in artist_releases:
+            release_tracks = release.get("tracks") or []
+            releases.append((
+                release["id"].encode("utf-8"),
+                RELEASE.pack(
+                    strings.add(release["id"]),
+                    strings.add(release.get("name")),
+                    strings.add(release.get("release_date")),
+                    NULL_YEAR if release.get("release_year") is None else release["release_year"],
+                    len(artists) - 1,
+                    len(tracks),
+                    len(release_tracks),
+                ),
+            ))
+            tracks.extend(
+                TRACK.pack(
+                    strings.add(track.get("name")),
+                    track.get("track_number") or 0,
+                    track.get("duration") or 0,
+                )
+                for track in release_tracks
+            )
+
+    release_index = sorted(range(len(releases)), key = lambda number: releases[number][0])
+    offsets = [0]
+    for value in strings.values:
+        offsets.append(offsets[-1] + len(value))
+
+    sections = {
+        "string_offsets": (
+            b"".join(STRING_OFFSET.pack(offset) for offset in offsets),
+            len(offsets),
+        ),
+        "strings": (b"".join(strings.values), len(strings.values)),
+        "artists": (b"".join(artists), len(artists)),
+        "genres": (b"".join(genres), len(genres)),
+        "releases": (b"".join(record for _, record in releases), len(releases)),
+        "release_index": (
+            b"".join(RELEASE_INDEX.pack(number) for number in release_index),
+            len(releases),
+        ),
+        "tracks": (b"".join(tracks), len(tracks)),
+    }
+
+    position = HEADER.size
+    table = []
+    for name in SECTIONS:
+        data, count = sections[name]
+        table.extend((position, count))
+        position += len(data)
+
+    with open(path + ".tmp", "wb") as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, VERSION, 0, time.time(), *table))
+        for name in SECTIONS:
+            snapshot_file.write(sections[name][0])
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(path + ".tmp", path)
+
+    return {
+        "artists": len(artists),
+        "releases": len(releases),
+        "tracks": len(tracks),
+    }
+
+class Catalog:
+    """
+    A memory-mapped catalog snapshot.
+    """
+    def __init__(self, path: str):
+        with open(path, "rb") as snapshot_file:
+            stat = os.fstat(snapshot_file.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns)
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, version, _, self.built_at, *table = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a catalog snapshot of version {VERSION}")
+        self.sections = {
+            name: (table[2 * i], table[2 * i + 1])
+            for i, name in enumerate(SECTIONS)
+        }
+
+    def _record(self, section: str, layout: struct.Struct, number: int) -> tuple:
+        return layout.unpack_from(self.map, self.sections[section][0] + number * layout.size)
+
+    def _bytes(self, number: int) -> bytes:
+        start, = self._record("string_offsets", STRING_OFFSET, number)
+        end, = self._record("string_offsets", STRING_OFFSET, number + 1)
+        base = self.sections["strings"][0]
+        return self.map[base + start:base + end]
+
+    def _string(self, number: int) -> str | None:
+        return None if number == NULL else self._bytes(number).decode("utf-8")
+
+    def _search(self, key: str, count: int, id_of) -> int | None:
+        # Binary search over records sorted by the UTF-8 bytes of their ID.
+        key = key.encode("utf-8")
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._bytes(id_of(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < count and self._bytes(id_of(low)) == key:
+            return low
+        return None
+
+    def _artist_number(self, artist_id: str) -> int | None:
+        return self._search(
+            artist_id,
+            self.sections["artists"][1],
+            lambda number: self._record("artists", ARTIST, number)[0],
+        )
+
+    def _releases(self, first: int, count: int):
+        for number in range(first, first + count):
+            yield self._record("releases", RELEASE, number)
+
+    def _tracks(self, first: int, count: int) -> list:
+        return [
+            {
+                "name": self._string(name),
+                "track_number": track_number,
+                "duration": duration,
+            }
+            for name, track_number, duration in (
+                self._record("tracks", TRACK, number)
+                for number in range(first, first + count)
+            )
+        ]
+
+    def artist(self, artist_id: str) -> dict | None:
+        """Get the static fields of an artist, as get_artist shows them."""
+        number = self._artist_number(artist_id)
+        if number is None:
+            return None
+        record = self._record("artists", ARTIST, number)
+        _, name, bio, first_genre, genres, first_release, releases = record
+
+        artist = {
+            "id": artist_id,
+            "name": self._string(name),
+            "genres": [
+                self._string(self._record("genres", GENRE, genre)[0])
+                for genre in range(first_genre, first_genre + genres)
+            ],
+            "releases": [
+                {
+                    "id": self._string(release_id),
+                    "name": self._string(release_name),
+                    "release_year": None if year == NULL_YEAR else year,
+                }
+                for release_id, release_name, _, year, *_ in self._releases(first_release, releases)
+            ],
+        }
+        if bio != NULL:
+            artist["bio"] = self._string(bio)
+        return artist
+
+    def artist_tracks(self, artist_id: str) -> dict | None:
+        """Get the tracks of an artist by name, as get_artist_tracks shows them."""
+        number = self._artist_number(artist_id)
+        if number is None:
+            return None
+        _, name, _, _, _, first_release, releases = self._record("artists", ARTIST, number)
+
+        items = {}
+        for release in self._releases(first_release, releases):
+            release_id, release_name, _, _, _, first_track, track_count = release
+            for track in self._tracks(first_track, track_count):
+                items.setdefault(track["name"], []).append({
+                    "id": self._string(release_id),
+                    "name": self._string(release_name),
+                })
+        if not items:
+            return None
+
+        return {
+            "artist": {
+                "id": artist_id,
+                "name": self._string(name),
+            },
+            "items": [
+                {
+                    "name": track_name,
+                    "releases": track_releases,
+                }
+                for track_name, track_releases in sorted(items.items(), key = _track_order)
+            ],
+        }
+
+    def release(self, release_id: str) -> dict | None:
+        """Get the static fields of a release, as get_release shows them."""
+        number = self._search(
+            release_id,
+            self.sections["releases"][1],
+            lambda position: self._record(
+                "releases",
+                RELEASE,
+                self._record("release_index", RELEASE_INDEX, position)[0],
+            )[0],
+        )
+        if number is None:
+            return None
+        number, = self._record("release_index", RELEASE_INDEX, number)
+        record = self._record("releases", RELEASE, number)
+        _, name, release_date, _, artist, first_track, tracks = record
+        artist_id, artist_name, *_ = self._record("artists", ARTIST, artist)
+
+        return {
+            "id": release_id,
+            "name": self._string(name),
+            "artist": {
+                "id": self._string(artist_id),
+                "name": self._string(artist_name),
+            },
+            "release_date": self._string(release_date),
+            "tracks": self._tracks(first_track, tracks),
+        }
+
+_lock = threading.Lock()
+_state = {
+    "catalog": None,
+    "checked_at": 0.0,
+}
+
+def get() -> Catalog | None:
+    """
+    Get the snapshot mapped by the current process, mapping the file again if
+    it was replaced, or None without `CATALOG_SNAPSHOT` or a readable file.
+    """
+    if not PATH:
+        return None
+    now = time.monotonic()
+    if now - _state["checked_at"] < CHECK_SECONDS:
+        return _state["catalog"]
+
+    with _lock:
+        if now - _state["checked_at"] < CHECK_SECONDS:
+            return _state["catalog"]
+        _state["checked_at"] = now
+        try:
+            stat = os.stat(PATH)
+            current = _state["catalog"]
+            if current is None or current.identity != (stat.st_ino, stat.st_mtime_ns):
+                # The old map is released once no request uses it anymore
+                _state["catalog"] = Catalog(PATH)
+        except (OSError, ValueError):
+            _state["catalog"] = None
+        return _state["catalog"]
@@ -0,0 +1,554 @@
+"""
+Module for the artist and release charts.
+
+The charts are kept sorted as the writes happen, so reading the top `k` never
+scans the catalog. With `REDIS_URL` set they are Redis sorted sets shared by
+every worker; otherwise each worker keeps them in memory and rebuilds them
+from MongoDB every `CHARTS_REFRESH_SECONDS`, in the background, to pick up
+the writes handled by the other workers.
+
+Artists are ranked by followers and releases by average rating, counting only
+releases with at least `CHARTS_MIN_RATINGS` ratings. Every chart also exists
+per genre, with the genres of the artist.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from redis.exceptions import WatchError
+from sortedcontainers import SortedList
+from configs import mongodb, redis
+from utils import counters
+
+logger = logging.getLogger(__name__)
+
+MIN_RATINGS = int(os.getenv("CHARTS_MIN_RATINGS", "5"))
+REFRESH_SECONDS = float(os.getenv("CHARTS_REFRESH_SECONDS", "300"))
+
+PREFIX = "charts"
+# Charts being built are written under this prefix, then renamed over the live ones
+STAGING_PREFIX = f"{PREFIX}:build"
+BUILT_KEY = f"{PREFIX}:built"
+BUILDING_KEY = f"{PREFIX}:building"
+# Artists and releases written while a build runs, read again for the new charts
+PENDING_KEY = f"{PREFIX}:pending"
+BUILD_SECONDS = 600
+REPLAY_BATCH = 1_000
+
+# Adds to the followers of an artist in every artist chart, and records the
+# artist while a build runs: KEYS = building flag, pending list and charts,
+# ARGV = artist ID, delta and record.
+FOLLOW_SCRIPT = """
+for i = 3, #KEYS do
+    redis.call("ZINCRBY", KEYS[i], ARGV[2], ARGV[1])
+end
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    redis.call("RPUSH", KEYS[2], ARGV[3])
+end
+"""
+
+# Updates the sum and count of ratings of a release, then its place in every
+# release chart, and records the release while a build runs: KEYS = building
+# flag, pending list, stats hash and charts, ARGV = release ID, rating delta,
+# count delta, minimum ratings and record.
+RATE_SCRIPT = """
+local sum = tonumber(redis.call("HINCRBYFLOAT", KEYS[3], ARGV[1] .. ":sum", ARGV[2]))
+local count = redis.call("HINCRBY", KEYS[3], ARGV[1] .. ":count", ARGV[3])
+for i = 4, #KEYS do
+    if count >= tonumber(ARGV[4]) then
+        redis.call("ZADD", KEYS[i], sum / count, ARGV[1])
+    else
+        redis.call("ZREM", KEYS[i], ARGV[1])
+    end
+end
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    redis.call("RPUSH", KEYS[2], ARGV[5])
+end
+return count
+"""
+
+def chart_key(kind: str, genre: str | None = None, prefix: str = PREFIX) -> str:
+    """
+    Get the name of a chart, overall or for a genre.
+    """
+    if genre is None:
+        return f"{prefix}:{kind}"
+    return f"{prefix}:{kind}:genre:{genre}"
+
+def _keys(kind: str, genres: list, prefix: str = PREFIX) -> list:
+    return [chart_key(kind, prefix = prefix)] + [chart_key(kind, genre, prefix) for genre in genres]
+
+def _stats_key(prefix: str = PREFIX) -> str:
+    return f"{prefix}:releases:stats"
+
+RELEASE_STATS_KEY = _stats_key()
+
+class SortedScores:
+    """
+    Members ordered by descending score, with ties broken by member.
+
+    Updates cost O(log n) on a sorted list; reading the top `k` is a slice.
+    """
+    def __init__(self):
+        self._entries = SortedList()
+        self._scores = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def set(self, member: str, score: float):
+        """Set the score of a member, adding it if needed."""
+        self.remove(member)
+        self._entries.add((-score, member))
+        self._scores[member] = score
+
+    def remove(self, member: str):
+        """Remove a member, if present."""
+        score = self._scores.pop(member, None)
+        if score is not None:
+            self._entries.remove((-score, member))
+
+    def incr(self, member: str, delta: float) -> float:
+        """Add to the score of a member, starting from zero."""
+        score = self._scores.get(member, 0) + delta
+        self.set(member, score)
+        return score
+
+    def top(self, k: int) -> list:
+        """Get the `k` members with the highest scores, with their scores."""
+        return [(member, -score) for score, member in self._entries[:k]]
+
+def _load(artist_ids: list | None = None, release_ids: list | None = None) -> tuple[dict, dict]:
+    # Reads the followers of the artists and the ratings of the releases,
+    # every one of them when the IDs are None.
+    artists = {}
+    if artist_ids is None or artist_ids:
+        pending = counters.pending_followers(artist_ids)
+        artists = {
+            artist["_id"]: (
+                artist.get("genres", []),
+                artist.get("qt_followers", 0) + pending.get(artist["_id"], 0),
+            )
+            for artist in mongodb.get_db().artists.find(
+                {} if artist_ids is None else {
+                    "_id": {
+                        "$in": artist_ids,
+                    },
+                },
+                {
+                    "genres": True,
+                    "qt_followers": True,
+                },
+            )
+        }
+
+    releases = {}
+    if release_ids is None or release_ids:
+        match = [] if release_ids is None else [
+            {
+                "$match": {
+                    "releases.id": {
+                        "$in": release_ids,
+                    },
+                },
+            },
+        ]
+        releases = {
+            release["id"]: (release["genres"], release["sum"], release["count"])
+            for release in mongodb.get_db().artists.aggregate([
+                *match,
+                {
+                    "$unwind": "$releases",
+                },
+                *match,
+                {
+                    "$project": {
+                        "_id": False,
+                        "id": "$releases.id",
+                        "genres": {
+                            "$ifNull": ["$genres", []],
+                        },
+                        "sum": {
+                            "$sum": "$releases.ratings.rating",
+                        },
+                        "count": {
+                            "$size": "$releases.ratings",
+                        },
+                    },
+                },
+            ])
+        }
+    return artists, releases
+
+def _touched() -> dict:
+    # The artists and releases written while a build runs.
+    return {
+        "artists": set(),
+        "releases": set(),
+    }
+
+_background_lock = threading.Lock()
+_background = {
+    "thread": None,
+}
+
+def _rebuild_logged():
+    try:
+        store.rebuild()
+    except Exception as e: # pylint: disable=broad-exception-caught
+        logger.warning("Could not rebuild the charts: %s", e)
+
+def _rebuild_in_background():
+    # One rebuild at a time per process; a forked process starts its own.
+    with _background_lock:
+        thread = _background["thread"]
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(target = _rebuild_logged, name = "charts-rebuild", daemon = True)
+        _background["thread"] = thread
+        thread.start()
+
+class _Charts:
+    # The charts and the rating stats of one build.
+    def __init__(self):
+        self.charts = {}
+        self.stats = {}
+
+    def chart(self, key: str) -> SortedScores:
+        chart = self.charts.get(key)
+        if chart is None:
+            chart = self.charts[key] = SortedScores()
+        return chart
+
+    def follow(self, artist_id: str, genres: list, delta: int):
+        for key in _keys("artists", genres):
+            self.chart(key).incr(artist_id, delta)
+
+    def rate(self, release_id: str, genres: list, rating_delta: float, count_delta: int):
+        stats = self.stats.get(release_id, (0, 0))
+        self.set_release(release_id, genres, stats[0] + rating_delta, stats[1] + count_delta)
+
+    def set_artist(self, artist_id: str, genres: list, followers: int):
+        for key in _keys("artists", genres):
+            self.chart(key).set(artist_id, followers)
+
+    def set_release(self, release_id: str, genres: list, rating_sum: float, count: int):
+        self.stats[release_id] = (rating_sum, count)
+        for key in _keys("releases", genres):
+            if count >= MIN_RATINGS:
+                self.chart(key).set(release_id, rating_sum / count)
+            else:
+                self.chart(key).remove(release_id)
+
+    def reload(self, touched: dict, artists: dict, releases: dict):
+        # Sets the touched artists and releases to their counts read again,
+        # dropping the ones that no longer exist.
+        for artist_id in touched["artists"]:
+            if artist_id in artists:
+                self.set_artist(artist_id, *artists[artist_id])
+            else:
+                for key, chart in self.charts.items():
+                    if key.startswith(chart_key("artists")):
+                        chart.remove(artist_id)
+        for release_id in touched["releases"]:
+            if release_id in releases:
+                self.set_release(release_id, *releases[release_id])
+            else:
+                self.stats.pop(release_id, None)
+                for key, chart in self.charts.items():
+                    if key.startswith(chart_key("releases")):
+                        chart.remove(release_id)
+
+class MemoryStore:
+    """
+    Charts of the current process.
+
+    Stale charts keep being served while a background thread rebuilds them.
+    The artists and releases written during the build are recorded and read
+    again from MongoDB once the scan ends, until a round finds none written
+    meanwhile, so the new charts count every write exactly once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = _Charts()
+        # Artists and releases written while a build runs, None when none does
+        self._touched = None
+        self._built_at = None
+
+    def follow(self, artist_id: str, genres: list, delta: int):
+        """Add to the followers of an artist."""
+        with self._lock:
+            self._current.follow(artist_id, genres, delta)
+            if self._touched is not None:
+                self._touched["artists"].add(artist_id)
+
+    def rate(self, release_id: str, genres: list, rating_delta: float, count_delta: int):
+        """Add to the sum and count of ratings of a release."""
+        with self._lock:
+            self._current.rate(release_id, genres, rating_delta, count_delta)
+            if self._touched is not None:
+                self._touched["releases"].add(release_id)
+
+    def rebuild(self) -> bool:
+        """
+        Replace the charts with the current counts in MongoDB, or return False
+        if a rebuild is already running.
+        """
+        with self._lock:
+            if self._touched is not None:
+                return False
+            self._touched = _touched()
+
+        try:
+            artists, releases = _load()
+            charts = _Charts()
+            for artist_id, (genres, followers) in artists.items():
+                charts.set_artist(artist_id, genres, followers)
+            for release_id, (genres, rating_sum, count) in releases.items():
+                charts.set_release(release_id, genres, rating_sum, count)
+
+            while True:
+                with self._lock:
+                    touched = self._touched
+                    if not touched["artists"] and not touched["releases"]:
+                        self._current = charts
+                        self._built_at = time.monotonic()
+                        return True
+                    self._touched = _touched()
+                charts.reload(touched, *_load(list(touched["artists"]), list(touched["releases"])))
+        finally:
+            with self._lock:
+                self._touched = None
+
+    def top(self, kind: str, genre: str | None, k: int) -> list:
+        """
+        Get the top `k` of a chart, with the scores. Raises LookupError until
+        the charts are first built.
+        """
+        if self._built_at is None or time.monotonic() - self._built_at > REFRESH_SECONDS:
+            _rebuild_in_background()
+        with self._lock:
+            if self._built_at is None:
+                raise LookupError("The charts are being built")
+            chart = self._current.charts.get(chart_key(kind, genre))
+            return chart.top(k) if chart is not None else []
+
+    def rating_counts(self, release_ids: list) -> list:
+        """Get the number of ratings of each release."""
+        with self._lock:
+            return [self._current.stats.get(release_id, (0, 0))[1] for release_id in release_ids]
+
+class RedisStore:
+    """
+    Charts shared by every worker, as Redis sorted sets.
+
+    A rebuild writes the new charts under `STAGING_PREFIX` while the live ones
+    keep being read and written. The artists and releases written meanwhile
+    are recorded and read again from MongoDB into the new charts, which are
+    renamed over the live ones in one transaction that fails, and is retried,
+    if more were recorded since.
+    """
+    def follow(self, artist_id: str, genres: list, delta: int):
+        """Add to the followers of an artist."""
+        # Registering only hashes the script; it is sent to Redis on first use
+        redis.get_client().register_script(FOLLOW_SCRIPT)(
+            keys = [BUILDING_KEY, PENDING_KEY] + _keys("artists", genres),
+            args = [artist_id, delta, json.dumps(["artist", artist_id])],
+        )
+
+    def rate(self, release_id: str, genres: list, rating_delta: float, count_delta: int):
+        """Add to the sum and count of ratings of a release."""
+        redis.get_client().register_script(RATE_SCRIPT)(
+            keys = [BUILDING_KEY, PENDING_KEY, RELEASE_STATS_KEY] + _keys("releases", genres),
+            args = [
+                release_id,
+                rating_delta,
+                count_delta,
+                MIN_RATINGS,
+                json.dumps(["release", release_id]),
+            ],
+        )
+
+    def _write(self, pipeline, staged: set, artists: dict, releases: dict):
+        # Sets artists and releases in the staged charts, adding the names of
+        # the charts written to `staged`.
+        for artist_id, (genres, followers) in artists.items():
+            for key in _keys("artists", genres, STAGING_PREFIX):
+                pipeline.zadd(key, {artist_id: followers})
+                staged.add(key)
+        for release_id, (genres, rating_sum, count) in releases.items():
+            pipeline.hset(_stats_key(STAGING_PREFIX), mapping = {
+                f"{release_id}:sum": rating_sum,
+                f"{release_id}:count": count,
+            })
+            for key in _keys("releases", genres, STAGING_PREFIX):
+                if count >= MIN_RATINGS:
+                    pipeline.zadd(key, {release_id: rating_sum / count})
+                    staged.add(key)
+                else:
+                    pipeline.zrem(key, release_id)
+
+    def _stage(self, client) -> set:
+        # Writes the charts from MongoDB under the staging prefix, and gets
+        # their names.
+        leftovers = list(client.scan_iter(match = f"{STAGING_PREFIX}:*", count = 1000))
+        if leftovers:
+            client.delete(*leftovers)
+
+        artists, releases = _load()
+        staged = {_stats_key(STAGING_PREFIX)}
+        with client.pipeline(transaction = False) as pipeline:
+            self._write(pipeline, staged, artists, releases)
+            pipeline.execute()
+        return staged
+
+    def _replay(self, client, staged: set):
+        # Reads the recorded artists and releases again into the staged
+        # charts, until none is left.
+        while True:
+            records = client.lpop(PENDING_KEY, REPLAY_BATCH)
+            if not records:
+                return
+            touched = _touched()
+            for record in records:
+                kind, member = json.loads(record)
+                touched[f"{kind}s"].add(member)
+            artists, releases = _load(list(touched["artists"]), list(touched["releases"]))
+
+            with client.pipeline(transaction = False) as pipeline:
+                self._write(pipeline, staged, artists, releases)
+                # The ones that no longer exist leave every staged chart
+                for artist_id in touched["artists"] - set(artists):
+                    for key in staged:
+                        if key.startswith(chart_key("artists", prefix = STAGING_PREFIX)):
+                            pipeline.zrem(key, artist_id)
+                for release_id in touched["releases"] - set(releases):
+                    pipeline.hdel(
+                        _stats_key(STAGING_PREFIX),
+                        f"{release_id}:sum",
+                        f"{release_id}:count",
+                    )
+                    for key in staged:
+                        if key.startswith(chart_key("releases", prefix = STAGING_PREFIX)):
+                            pipeline.zrem(key, release_id)
+                pipeline.execute()
+
+    def rebuild(self) -> bool:
+        """
+        Replace the charts with the current counts in MongoDB, or return False
+        if another process is rebuilding them.
+        """
+        client = redis.get_client()
+        if not client.set(BUILDING_KEY, os.getpid(), nx = True, ex = BUILD_SECONDS):
+            return False
+
+        try:
+            # Writes are recorded from here on, before the scan reads them
+            client.delete(PENDING_KEY)
+            staged = self._stage(client)
+            live = {
+                key
+                for pattern in (f"{PREFIX}:artists*", f"{PREFIX}:releases*")
+                for key in client.scan_iter(match = pattern, count = 1000)
+            }
+
+            while True:
+                self._replay(client, staged)
+                # Empty charts are never created, so only existing ones move
+                keys = sorted(staged)
+                with client.pipeline(transaction = False) as pipeline:
+                    for key in keys:
+                        pipeline.exists(key)
+                    names = {
+                        key: PREFIX + key[len(STAGING_PREFIX):]
+                        for key, exists in zip(keys, pipeline.execute())
+                        if exists
+                    }
+
+                with client.pipeline(transaction = True) as pipeline:
+                    try:
+                        pipeline.watch(PENDING_KEY)
+                        if pipeline.llen(PENDING_KEY):
+                            continue
+                        pipeline.multi()
+                        for key, name in names.items():
+                            pipeline.rename(key, name)
+                        # Live charts left empty by the build
+                        removed = live - set(names.values())
+                        if removed:
+                            pipeline.delete(*removed)
+                        pipeline.set(BUILT_KEY, time.time())
+                        pipeline.delete(BUILDING_KEY, PENDING_KEY)
+                        pipeline.execute()
+                        return True
+                    except WatchError:
+                        continue
+        finally:
+            client.delete(BUILDING_KEY)
+
+    def top(self, kind: str, genre: str | None, k: int) -> list:
+        """
+        Get the top `k` of a chart, with the scores. Raises LookupError until
+        the charts are first built.
+        """
+        client = redis.get_client()
+        if not client.exists(BUILT_KEY):
+            # The first worker to find the charts missing builds them
+            if not client.exists(BUILDING_KEY):
+                _rebuild_in_background()
+            raise LookupError("The charts are being built")
+        return client.zrevrange(chart_key(kind, genre), 0, k - 1, withscores = True)
+
+    def rating_counts(self, release_ids: list) -> list:
+        """Get the number of ratings of each release."""
+        if not release_ids:
+            return []
+        counts = redis.get_client().hmget(
+            RELEASE_STATS_KEY,
+            [f"{release_id}:count" for release_id in release_ids],
+        )
+        return [int(count or 0) for count in counts]
+
+store = RedisStore() if redis.ENABLED else MemoryStore()
+
+def follow(artist_id: str, genres: list, delta: int):
+    """
+    Record that an artist gained (`delta` = 1) or lost (-1) a follower.
+    """
+    store.follow(artist_id, genres or [], delta)
+
+def rate(release_id: str, genres: list, rating: float, delta: int):
+    """
+    Record that a release gained (`delta` = 1) or lost (-1) a rating.
+    """
+    store.rate(release_id, genres or [], rating * delta, delta)
+
+def rebuild() -> bool:
+    """
+    Rebuild every chart from MongoDB, or return False if a rebuild is already
+    running.
+    """
+    return store.rebuild()
+
+def top_artists(genre: str | None, limit: int) -> list:
+    """
+    Get the most followed artists, as (ID, followers) pairs. Raises
+    LookupError until the charts are first built.
+    """
+    return [
+        (artist_id, int(score))
+        for artist_id, score in store.top("artists", genre, limit)
+    ]
+
+def top_releases(genre: str | None, limit: int) -> list:
+    """
+    Get the highest rated releases, as (ID, average, number of ratings).
+    Raises LookupError until the charts are first built.
+    """
+    top = store.top("releases", genre, limit)
+    counts = store.rating_counts([release_id for release_id, _ in top])
+    return [
+        (release_id, score, count)
+        for (release_id, score), count in zip(top, counts)
+    ]
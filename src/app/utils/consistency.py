@@ -0,0 +1,78 @@
+"""
+Module for routing read-only requests to replicas with read-your-writes.
+
+Every successful write answers with an `X-Consistency-Token`. A client that
+sends it back on its next reads is guaranteed to see its own writes: MongoDB
+reads go to the primary while a secondary could still be behind it, and Neo4j
+replicas wait for the bookmarks of the write before answering. The token only
+carries Neo4j bookmarks when the request wrote to Neo4j, so writes to MongoDB
+alone never create the Neo4j driver.
+"""
+import base64
+import binascii
+import json
+import os
+import time
+from flask import Flask, Response, g, has_app_context, request
+from configs import mongodb, neo4j, routing
+
+TOKEN_HEADER = "X-Consistency-Token"
+READ_METHODS = ("GET", "HEAD")
+# How long after a write MongoDB reads stay on the primary
+STICKY_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", str(mongodb.MAX_STALENESS_SECONDS)))
+
+class Neo4jWriteListener(neo4j.QueryListener):
+    """
+    Marks the requests that ran a Neo4j query other than a read.
+    """
+    def succeeded(self, name, query, parameters, summary, duration):
+        if summary.query_type != "r" and has_app_context():
+            g.neo4j_wrote = True
+
+def encode(written_at: float, bookmarks: tuple) -> str:
+    """
+    Encode a consistency token.
+    """
+    payload = json.dumps({"w": written_at, "b": list(bookmarks)}, separators = (",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+def decode(token: str) -> tuple[float, tuple]:
+    """
+    Decode a consistency token, ignoring it if it is malformed.
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return float(payload["w"]), tuple(str(bookmark) for bookmark in payload["b"])
+    except (binascii.Error, ValueError, KeyError, TypeError, UnicodeError):
+        return 0.0, ()
+
+def install(app: Flask):
+    """
+    Route the queries of every request according to its method and token.
+    """
+    neo4j.register(Neo4jWriteListener())
+
+    @app.before_request
+    def set_routing():
+        if request.method not in READ_METHODS:
+            return
+
+        written_at, bookmarks = decode(request.headers.get(TOKEN_HEADER, ""))
+        request.environ["consistency.token"] = routing.current.set(routing.Routing(
+            mongodb_secondary = time.time() - written_at > STICKY_SECONDS,
+            neo4j_read = True,
+            neo4j_bookmarks = bookmarks,
+        ))
+
+    @app.after_request
+    def issue_token(response: Response):
+        if request.method not in READ_METHODS and response.status_code < 400:
+            bookmarks = neo4j.get_bookmarks() if g.get("neo4j_wrote") else ()
+            response.headers[TOKEN_HEADER] = encode(time.time(), bookmarks)
+        return response
+
+    @app.teardown_request
+    def reset_routing(_):
+        token = request.environ.pop("consistency.token", None)
+        if token is not None:
+            routing.current.reset(token)
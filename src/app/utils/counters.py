@@ -0,0 +1,344 @@
+"""
+Module for the follower counters of the artists (`qt_followers`).
+
+By default every follow and unfollow runs its own `$inc` on the artist. With
+`FOLLOWER_COUNTER_BUFFER=true`, the deltas are combined and written in one
+`bulk_write` every `FOLLOWER_COUNTER_FLUSH_SECONDS`, so a burst of follows
+on one artist costs one update instead of one per follow.
+
+Pending deltas are never only in memory:
+
+* With `REDIS_URL` set they live in a Redis hash shared by every worker. A
+  flush renames the hash to a batch, so new deltas go to a fresh hash while
+  the batch is written.
+* Otherwise each worker appends every delta to its own journal file in
+  `FOLLOWER_COUNTER_JOURNAL_DIR`. A flush renames the journal to a batch file
+  before writing it. On start, every worker applies the journals and batches
+  left behind by dead processes, told apart from a later process with the
+  same PID by their start time.
+
+Each batch has an ID, and every artist keeps the IDs of its last applied
+batches, so a batch that is written again after a crash is skipped.
+
+Counts shown by the API are the stored value plus the pending deltas (only
+this worker's, without Redis).
+"""
+import contextlib
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import psutil
+from pymongo import UpdateOne
+from redis.exceptions import RedisError
+from configs import mongodb, redis
+
+logger = logging.getLogger(__name__)
+
+BUFFERED = os.getenv("FOLLOWER_COUNTER_BUFFER", "false").lower() == "true"
+FLUSH_SECONDS = float(os.getenv("FOLLOWER_COUNTER_FLUSH_SECONDS", "1"))
+JOURNAL_DIR = os.getenv("FOLLOWER_COUNTER_JOURNAL_DIR", "counters")
+JOURNAL_FSYNC = os.getenv("FOLLOWER_COUNTER_JOURNAL_FSYNC", "false").lower() == "true"
+# Applied batch IDs kept per artist; a batch is replayed at most this late
+APPLIED_BATCHES = 10
+
+PENDING_KEY = "counters:qt_followers"
+BATCHES_KEY = "counters:qt_followers:batches"
+FLUSH_LOCK_KEY = "counters:qt_followers:flushing"
+
+_lock = threading.Lock()
+_pending: dict[str, int] = {}
+# Batches being written, or left by a failed flush
+_batches: dict[str, dict] = {}
+_journal = None
+_state = {
+    "pid": None,
+    "journal_name": None,
+    "sequence": 0,
+}
+
+def _apply(batch_id: str, deltas: dict):
+    # Writes a batch, skipping the artists that already have it.
+    operations = [
+        UpdateOne(
+            {
+                "_id": artist_id,
+                "counter_batches": {
+                    "$ne": batch_id,
+                },
+            },
+            {
+                "$currentDate": {
+                    "updated_at": True,
+                },
+                "$inc": {
+                    "qt_followers": delta,
+                },
+                "$push": {
+                    "counter_batches": {
+                        "$each": [batch_id],
+                        "$slice": -APPLIED_BATCHES,
+                    },
+                },
+            },
+        )
+        for artist_id, delta in deltas.items()
+        if delta
+    ]
+    if operations:
+        mongodb.get_db().artists.bulk_write(operations, ordered = False)
+
+def _read_journal(path: str) -> dict:
+    deltas = {}
+    with open(path, encoding = "utf-8") as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line of a crashed process may be cut short
+                continue
+            deltas[entry["id"]] = deltas.get(entry["id"], 0) + entry["delta"]
+    return deltas
+
+def _journal_path(name: str, extension: str) -> str:
+    return os.path.join(JOURNAL_DIR, f"{name}.{extension}")
+
+def _open_journal():
+    global _journal
+    _journal = open(_journal_path(_state["journal_name"], "log"), "a", encoding = "utf-8")
+
+def _write_journal(artist_id: str, delta: int):
+    _journal.write(json.dumps({"id": artist_id, "delta": delta}) + "\n")
+    _journal.flush()
+    if JOURNAL_FSYNC:
+        os.fsync(_journal.fileno())
+
+def _owner_alive(name: str) -> bool:
+    # Whether the process that wrote a journal still runs. Journals are named
+    # after the PID and the time the process opened its first one, so a later
+    # process that reused the PID is told apart by its start time.
+    pid, started_ns = (int(part) for part in name.split("-")[:2])
+    if pid == os.getpid():
+        return True
+    try:
+        # Start times are only precise to about a second
+        return psutil.Process(pid).create_time() <= started_ns / 1e9 + 1
+    except psutil.NoSuchProcess:
+        return False
+
+def recover():
+    """
+    Write the journals and batches left behind by dead processes to MongoDB.
+    """
+    for path in sorted(glob.glob(os.path.join(JOURNAL_DIR, "*.log"))
+                       + glob.glob(os.path.join(JOURNAL_DIR, "*.batch"))):
+        name = os.path.basename(path).rsplit(".", 1)[0]
+        if _owner_alive(name):
+            continue
+        # Another worker may recover the same file at once; writing a batch
+        # twice is skipped by its ID, and whichever is last finds it removed
+        with contextlib.suppress(FileNotFoundError):
+            _apply(name, _read_journal(path))
+            os.remove(path)
+            logger.info("Applied the follower counter journal %s of a dead process", name)
+
+def _flush_local():
+    with _lock:
+        if _pending:
+            # The journal becomes the batch file, and a new one takes the deltas
+            _state["sequence"] += 1
+            batch_id = f"{_state['journal_name']}-{_state['sequence']}"
+            _journal.close()
+            os.replace(
+                _journal_path(_state["journal_name"], "log"),
+                _journal_path(batch_id, "batch"),
+            )
+            _open_journal()
+            _batches[batch_id] = dict(_pending)
+            _pending.clear()
+        batches = dict(_batches)
+
+    # Batches of failed flushes are written again, with the same ID
+    for batch_id, deltas in batches.items():
+        _apply(batch_id, deltas)
+        with _lock:
+            del _batches[batch_id]
+        os.remove(_journal_path(batch_id, "batch"))
+
+def _flush_redis():
+    client = redis.get_client()
+    if not client.set(FLUSH_LOCK_KEY, os.getpid(), nx = True, ex = 60):
+        return
+    try:
+        batch_id = uuid.uuid4().hex
+        batch_key = f"{PENDING_KEY}:{batch_id}"
+        # New deltas go to a fresh hash while this batch is written
+        if client.exists(PENDING_KEY):
+            with client.pipeline(transaction = True) as pipeline:
+                pipeline.rename(PENDING_KEY, batch_key)
+                pipeline.sadd(BATCHES_KEY, batch_id)
+                pipeline.execute()
+
+        # Batches of flushes that failed or crashed are written again
+        for pending_batch in client.smembers(BATCHES_KEY):
+            key = f"{PENDING_KEY}:{pending_batch}"
+            deltas = {
+                artist_id: int(delta)
+                for artist_id, delta in client.hgetall(key).items()
+            }
+            _apply(pending_batch, deltas)
+            with client.pipeline(transaction = True) as pipeline:
+                pipeline.delete(key)
+                pipeline.srem(BATCHES_KEY, pending_batch)
+                pipeline.execute()
+    finally:
+        client.delete(FLUSH_LOCK_KEY)
+
+def flush():
+    """
+    Write the pending deltas to MongoDB.
+    """
+    if redis.ENABLED:
+        _flush_redis()
+    else:
+        _flush_local()
+
+def incr_followers(artist_id: str, delta: int, projection: dict | None = None) -> dict | None:
+    """
+    Add to the followers of an artist. With a `projection`, the artist is
+    returned with those fields (None if it does not exist).
+    """
+    if not BUFFERED:
+        update = {
+            "$currentDate": {
+                "updated_at": True,
+            },
+            "$inc": {
+                "qt_followers": delta,
+            },
+        }
+        if projection is None:
+            mongodb.db.artists.update_one(
+                {
+                    "_id": artist_id,
+                },
+                update,
+            )
+            return None
+        return mongodb.db.artists.find_one_and_update(
+            {
+                "_id": artist_id,
+            },
+            update,
+            projection,
+        )
+
+    artist = None
+    if projection is not None:
+        artist = mongodb.db.artists.find_one(
+            {
+                "_id": artist_id,
+            },
+            projection,
+        )
+        if artist is None:
+            return None
+
+    start()
+    if redis.ENABLED:
+        redis.get_client().hincrby(PENDING_KEY, artist_id, delta)
+    else:
+        with _lock:
+            _write_journal(artist_id, delta)
+            _pending[artist_id] = _pending.get(artist_id, 0) + delta
+    return artist
+
+def _journaled() -> list:
+    # The deltas in the journals and batch files of every process.
+    results = []
+    paths = (
+        glob.glob(os.path.join(JOURNAL_DIR, "*.log"))
+        + glob.glob(os.path.join(JOURNAL_DIR, "*.batch"))
+    )
+    for path in paths:
+        # A batch may be written and removed meanwhile
+        with contextlib.suppress(FileNotFoundError):
+            results.append(_read_journal(path))
+    return results
+
+def pending_followers(artist_ids: list | None = None, journals: bool = False) -> dict:
+    """
+    Get the deltas not written yet for each artist (every artist with one if
+    `artist_ids` is None), to add to the stored `qt_followers`. Without Redis,
+    only this worker's deltas are known, unless `journals` is set: then the
+    journals of every process are read instead, as a process that is not a
+    worker must do.
+    """
+    if not BUFFERED or artist_ids == []:
+        return {}
+
+    if redis.ENABLED:
+        try:
+            client = redis.get_client()
+            keys = [PENDING_KEY] + [
+                f"{PENDING_KEY}:{batch}"
+                for batch in client.smembers(BATCHES_KEY)
+            ]
+            with client.pipeline(transaction = False) as pipeline:
+                for key in keys:
+                    if artist_ids is None:
+                        pipeline.hgetall(key)
+                    else:
+                        pipeline.hmget(key, artist_ids)
+                results = pipeline.execute()
+        except RedisError as e:
+            logger.warning("Could not read the pending follower counts: %s", e)
+            return {}
+        if artist_ids is not None:
+            results = [dict(zip(artist_ids, values)) for values in results]
+    elif journals:
+        results = _journaled()
+    else:
+        with _lock:
+            results = [dict(_pending)] + [dict(deltas) for deltas in _batches.values()]
+
+    pending = {}
+    for deltas in results:
+        for artist_id, delta in deltas.items():
+            if delta is not None and (artist_ids is None or artist_id in artist_ids):
+                pending[artist_id] = pending.get(artist_id, 0) + int(delta)
+    return pending
+
+def _run():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            flush()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logger.warning("Could not flush the follower counters: %s", e)
+
+def start():
+    """
+    Start flushing the counters in the background, once per process.
+    """
+    with _lock:
+        if not BUFFERED or _state["pid"] == os.getpid():
+            return
+        _state["pid"] = os.getpid()
+        _state["sequence"] = 0
+        _pending.clear()
+        _batches.clear()
+        if not redis.ENABLED:
+            os.makedirs(JOURNAL_DIR, exist_ok = True)
+            _state["journal_name"] = f"{os.getpid()}-{time.time_ns()}"
+            _open_journal()
+
+    if not redis.ENABLED:
+        try:
+            recover()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logger.warning("Could not recover the follower counter journals: %s", e)
+    threading.Thread(target = _run, name = "counters", daemon = True).start()
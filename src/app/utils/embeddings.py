@@ -0,0 +1,401 @@
+"""
+Module for the low-rank embeddings of users and releases.
+
+`python manage.py embeddings` factorizes the user x release matrix of ratings,
+centered on the mean rating, with a truncated SVD: every user and release gets
+a dense vector of `EMBEDDING_DIMENSIONS`, and the dot product of a user's and
+a release's vectors, plus the mean, estimates the user's rating. The vectors
+are written as a snapshot under `EMBEDDINGS_SNAPSHOT` (see `utils.snapshots`)
+that every worker memory-maps.
+
+An incremental run only projects the users whose documents changed since the
+previous run onto the release vectors, which stay as they were: a user's row
+of the matrix times the release vectors, divided by the singular values, is
+their row of the factorization. New releases wait for the next full run.
+
+Neighbours are found by exact matrix products, a block of vectors at a time,
+or with `EMBEDDINGS_INDEX=ivf` by an inverted-file index: the vectors are
+grouped around k-means centroids when the snapshot is written, and a search
+only scores the groups of its `EMBEDDINGS_PROBES` best centroids.
+"""
+import os
+from datetime import datetime
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import svds
+from configs import mongodb
+from utils import snapshots
+
+PATH = os.getenv("EMBEDDINGS_SNAPSHOT")
+CHECK_SECONDS = float(os.getenv("EMBEDDINGS_CHECK_SECONDS", "5"))
+DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "64"))
+INDEX = os.getenv("EMBEDDINGS_INDEX", "exact")
+PROBES = int(os.getenv("EMBEDDINGS_PROBES", "8"))
+
+# Rows scored per matrix product by exact searches
+BLOCK_SIZE = 65_536
+MAX_CLUSTERS = 4_096
+KMEANS_SAMPLE = 100_000
+KMEANS_ITERATIONS = 10
+
+ARRAYS = (
+    "users",
+    "user_vectors",
+    "user_centroids",
+    "user_clusters",
+    "releases",
+    "release_vectors",
+    "release_centroids",
+    "release_clusters",
+    "singular_values",
+)
+
+def _keys(values) -> np.ndarray:
+    # Keys sorted by their UTF-8 bytes, as searched by `Embeddings`.
+    return np.array(sorted(value.encode("utf-8") for value in values), dtype = np.bytes_)
+
+def _find(keys: np.ndarray, key: str) -> int | None:
+    key = key.encode("utf-8")
+    position = int(np.searchsorted(keys, key))
+    if position < len(keys) and keys[position] == key:
+        return position
+    return None
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis = 1, keepdims = True)
+    return np.divide(vectors, norms, out = np.zeros_like(vectors), where = norms > 0)
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # The nearest centroid of each vector, a block at a time.
+    offsets = (centroids ** 2).sum(axis = 1) / 2
+    return np.concatenate([
+        np.argmax(vectors[start:start + BLOCK_SIZE] @ centroids.T - offsets, axis = 1)
+        for start in range(0, len(vectors), BLOCK_SIZE)
+    ] or [np.zeros(0, dtype = np.int64)]).astype(np.int32)
+
+def _cluster(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Centroids trained by k-means on a sample, and the group of each vector.
+    if INDEX != "ivf" or not len(vectors):
+        return np.zeros((0, vectors.shape[1]), dtype = np.float32), np.zeros(0, dtype = np.int32)
+
+    generator = np.random.default_rng(0)
+    clusters = min(max(int(np.sqrt(len(vectors))), 1), MAX_CLUSTERS)
+    sampled = generator.choice(len(vectors), min(len(vectors), KMEANS_SAMPLE), replace = False)
+    sample = vectors[np.sort(sampled)]
+    centroids = sample[generator.choice(len(sample), clusters, replace = False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assigned = _assign(sample, centroids)
+        members = sparse.csr_matrix(
+            (np.ones(len(sample), dtype = np.float32), (assigned, np.arange(len(sample)))),
+            shape = (clusters, len(sample)),
+        )
+        counts = np.bincount(assigned, minlength = clusters)
+        filled = counts > 0
+        centroids[filled] = (members @ sample)[filled] / counts[filled, None]
+    return centroids, _assign(vectors, centroids)
+
+def _ratings(query: dict, releases: dict | None = None):
+    # The ratings of the users matching `query`, numbering the releases in
+    # `releases`: only the known ones when given, every one otherwise.
+    usernames = []
+    rows = []
+    columns = []
+    values = []
+    known = releases if releases is not None else {}
+    cursor = mongodb.get_db().users.find(
+        query,
+        {
+            "_id": False,
+            "username": True,
+            "ratings.id": True,
+            "ratings.rating": True,
+        },
+    )
+    for user in cursor:
+        rated = False
+        for rating in user.get("ratings") or []:
+            if rating.get("rating") is None:
+                continue
+            if releases is None:
+                column = known.setdefault(rating["id"], len(known))
+            else:
+                column = known.get(rating["id"])
+                if column is None:
+                    continue
+            rows.append(len(usernames))
+            columns.append(column)
+            values.append(rating["rating"])
+            rated = True
+        usernames.append((user["username"], rated))
+    return usernames, known, (
+        np.array(rows, dtype = np.int64),
+        np.array(columns, dtype = np.int64),
+        np.array(values, dtype = np.float32),
+    )
+
+def _train(until) -> tuple[dict, dict]:
+    usernames, releases, (rows, columns, values) = _ratings({})
+    rated = [username for username, has_ratings in usernames if has_ratings]
+    users = _keys(rated)
+    release_keys = _keys(releases)
+
+    # Rows and columns follow the sorted keys
+    user_order = np.empty(len(usernames), dtype = np.int64)
+    for number, (username, _) in enumerate(usernames):
+        position = _find(users, username)
+        user_order[number] = -1 if position is None else position
+    release_order = np.empty(len(releases), dtype = np.int64)
+    for release_id, number in releases.items():
+        release_order[number] = _find(release_keys, release_id)
+
+    dimensions = min(DIMENSIONS, len(users) - 1, len(release_keys) - 1)
+    if dimensions < 1:
+        raise ValueError("There are not enough ratings to train the embeddings")
+
+    mean = float(values.mean())
+    matrix = sparse.csr_matrix(
+        (values - mean, (user_order[rows], release_order[columns])),
+        shape = (len(users), len(release_keys)),
+        dtype = np.float32,
+    )
+    left, singular_values, right = svds(matrix, k = dimensions)
+    order = np.argsort(-singular_values)
+    singular_values = singular_values[order].astype(np.float32)
+    scale = np.sqrt(singular_values)
+    user_vectors = _normalize((left[:, order] * scale).astype(np.float32))
+    release_vectors = (right[order].T * scale).astype(np.float32)
+
+    user_centroids, user_clusters = _cluster(user_vectors)
+    release_centroids, release_clusters = _cluster(release_vectors)
+    arrays = {
+        "users": users,
+        "user_vectors": user_vectors,
+        "user_centroids": user_centroids,
+        "user_clusters": user_clusters,
+        "releases": release_keys,
+        "release_vectors": release_vectors,
+        "release_centroids": release_centroids,
+        "release_clusters": release_clusters,
+        "singular_values": singular_values,
+    }
+    meta = {
+        "mode": "full",
+        "until": until.isoformat(),
+        "mean": mean,
+        "dimensions": dimensions,
+    }
+    return arrays, meta
+
+def _usernames() -> np.ndarray:
+    # Every username in the database, from a scan of the username index (a
+    # distinct could outgrow the 16 MB limit of a reply).
+    cursor = mongodb.get_db().users.find(
+        {},
+        {
+            "_id": False,
+            "username": True,
+        },
+    ).hint([("username", 1)])
+    return np.array([user["username"].encode("utf-8") for user in cursor], dtype = np.bytes_)
+
+def _refresh(build_path: str, until) -> tuple[dict, dict]:
+    arrays, meta = snapshots.load(build_path, ARRAYS)
+    arrays = {name: np.asarray(array) for name, array in arrays.items()}
+    releases = {key.decode("utf-8"): number for number, key in enumerate(arrays["releases"])}
+    usernames, _, (rows, columns, values) = _ratings(
+        {
+            "updated_at": {
+                "$gt": datetime.fromisoformat(meta["until"]),
+                "$lte": until,
+            },
+        },
+        releases,
+    )
+
+    changed = sparse.csr_matrix(
+        (values - meta["mean"], (rows, columns)),
+        shape = (len(usernames), len(releases)),
+        dtype = np.float32,
+    )
+    vectors = _normalize((changed @ arrays["release_vectors"]) / arrays["singular_values"])
+
+    # Changed users are replaced, deleted users and users without known
+    # ratings anymore are dropped, and new ones are added in order
+    users = arrays["users"]
+    keep = np.isin(users, _usernames())
+    deleted = int(len(users) - keep.sum())
+    for username, _ in usernames:
+        position = _find(users, username)
+        if position is not None:
+            keep[position] = False
+    rated = np.array([has_ratings for _, has_ratings in usernames], dtype = bool)
+    added = np.array(
+        [username.encode("utf-8") for username, _ in usernames],
+        dtype = np.bytes_,
+    )[rated]
+    merged = np.concatenate([users[keep], added]) if len(added) else users[keep]
+    order = np.argsort(merged, kind = "stable")
+
+    user_vectors = np.concatenate([arrays["user_vectors"][keep], vectors[rated]])[order]
+    user_clusters = arrays["user_clusters"]
+    if len(arrays["user_centroids"]):
+        added_clusters = _assign(vectors[rated], arrays["user_centroids"])
+        user_clusters = np.concatenate([user_clusters[keep], added_clusters])[order]
+
+    arrays.update({
+        "users": merged[order],
+        "user_vectors": user_vectors,
+        "user_clusters": user_clusters,
+    })
+    return arrays, {
+        **meta,
+        "mode": "incremental",
+        "until": until.isoformat(),
+        "refreshed": len(usernames),
+        "deleted": deleted,
+    }
+
+def train(path: str, incremental: bool = False) -> dict:
+    """
+    Train the embeddings into a new snapshot under `path`, or only refresh the
+    users changed since the current one, and get its metadata. An incremental
+    run without a current snapshot trains from scratch.
+    """
+    # The clock of the server, which sets updated_at with $currentDate
+    until = mongodb.get_db().command("hello")["localTime"]
+    build_path = snapshots.current(path) if incremental else None
+    if build_path is None:
+        arrays, meta = _train(until)
+    else:
+        arrays, meta = _refresh(build_path, until)
+    snapshots.write(path, arrays, meta)
+    return {
+        **meta,
+        "users": len(arrays["users"]),
+        "releases": len(arrays["releases"]),
+    }
+
+class Index:
+    """
+    Nearest neighbours of a query among vectors, by dot product.
+    """
+    def __init__(self, vectors: np.ndarray, centroids: np.ndarray, clusters: np.ndarray):
+        self.vectors = vectors
+        self.centroids = None
+        if INDEX == "ivf" and len(centroids) and len(clusters) == len(vectors):
+            self.centroids = np.asarray(centroids)
+            self.members = np.argsort(clusters, kind = "stable")
+            sizes = np.bincount(clusters, minlength = len(centroids))
+            self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+
+    def _candidates(self, query: np.ndarray):
+        # Every vector, a block at a time, or the groups of the best centroids.
+        if self.centroids is None:
+            for start in range(0, len(self.vectors), BLOCK_SIZE):
+                yield np.arange(start, min(start + BLOCK_SIZE, len(self.vectors)))
+            return
+        scores = self.centroids @ query
+        for cluster in np.argsort(-scores)[:PROBES]:
+            yield self.members[self.offsets[cluster]:self.offsets[cluster + 1]]
+
+    def search(self, query: np.ndarray, k: int, exclude: set) -> list:
+        """
+        Get the positions and scores of the `k` best vectors, best first,
+        leaving out the positions in `exclude`.
+        """
+        wanted = k + len(exclude)
+        best = np.zeros(0, dtype = np.int64)
+        best_scores = np.zeros(0, dtype = np.float32)
+        for positions in self._candidates(query):
+            scores = self.vectors[positions] @ query
+            best = np.concatenate([best, positions])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best) > wanted:
+                top = np.argpartition(-best_scores, wanted - 1)[:wanted]
+                best, best_scores = best[top], best_scores[top]
+
+        order = np.argsort(-best_scores, kind = "stable")
+        return [
+            (int(best[i]), float(best_scores[i]))
+            for i in order
+            if int(best[i]) not in exclude
+        ][:k]
+
+class Embeddings:
+    """
+    A memory-mapped embeddings snapshot.
+    """
+    def __init__(self, path: str):
+        arrays, meta = snapshots.load(path, ARRAYS)
+        self.mean = meta["mean"]
+        self.users = arrays["users"]
+        self.releases = arrays["releases"]
+        self.release_vectors = arrays["release_vectors"]
+        self.singular_values = np.asarray(arrays["singular_values"])
+        self.user_index = Index(
+            arrays["user_vectors"],
+            arrays["user_centroids"],
+            arrays["user_clusters"],
+        )
+        self.release_index = Index(
+            arrays["release_vectors"],
+            arrays["release_centroids"],
+            arrays["release_clusters"],
+        )
+
+    def project(self, ratings: list) -> tuple[np.ndarray | None, set]:
+        """
+        Get the vector of a user from their current ratings, and the positions
+        of the rated releases, or None if no rated release is known.
+        """
+        positions = []
+        values = []
+        for rating in ratings:
+            position = _find(self.releases, rating["id"])
+            if position is not None and rating.get("rating") is not None:
+                positions.append(position)
+                values.append(rating["rating"] - self.mean)
+        if not positions:
+            return None, set()
+        vector = np.asarray(values, dtype = np.float32) @ self.release_vectors[positions]
+        return vector / self.singular_values, set(positions)
+
+    def releases_for(self, ratings: list, k: int) -> list | None:
+        """
+        Get the IDs and estimated ratings of the `k` releases a user would
+        rate highest, out of the ones not rated yet.
+        """
+        vector, rated = self.project(ratings)
+        if vector is None:
+            return None
+        return [
+            (self.releases[position].decode("utf-8"), score + self.mean)
+            for position, score in self.release_index.search(vector, k, rated)
+        ]
+
+    def users_like(self, username: str, ratings: list, k: int) -> list | None:
+        """
+        Get the usernames and cosine similarities of the `k` users whose
+        ratings look the most like a user's.
+        """
+        vector, _ = self.project(ratings)
+        if vector is None:
+            return None
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+        own = _find(self.users, username)
+        exclude = {own} if own is not None else set()
+        return [
+            (self.users[position].decode("utf-8"), score)
+            for position, score in self.user_index.search(vector / norm, k, exclude)
+        ]
+
+_snapshot = snapshots.Mapped(PATH, CHECK_SECONDS, Embeddings)
+
+def get() -> Embeddings | None:
+    """
+    Get the snapshot mapped by the current process, or None without
+    `EMBEDDINGS_SNAPSHOT` or a readable snapshot.
+    """
+    return _snapshot.get()
@@ -0,0 +1,376 @@
+"""
+Module for the columnar snapshots of the catalog and the interactions, for
+analytics.
+
+Each export is a directory with one subdirectory per table, holding the rows
+as numbered NumPy `.npz` chunks of columns, and a `manifest.json`:
+
+* `artists`, `releases`, `tracks` and `users`, from MongoDB;
+* `rated`, `follows`, `friends_with`, `belongs_to` and `released`, the edges
+  of Neo4j, read for the users and artists of each chunk.
+
+String columns are dictionary-encoded per chunk: `<column>.dictionary` holds
+the distinct values and `<column>.codes` the index of each row's value (-1
+for none). Missing integers are -1, missing floats NaN and missing dates NaT.
+
+Documents and their edges are streamed chunk by chunk, so no collection is
+ever held in memory. An incremental export only has the users and artists
+whose `updated_at` changed since the previous export into the same output
+directory, with all their edges, plus the tables `user_ids` and `artist_ids`
+of every current ID so deleted ones can be dropped.
+"""
+import json
+import os
+from datetime import datetime, timezone
+import numpy as np
+from configs import mongodb, neo4j
+
+CHUNK_SIZE = 10_000
+STATE_FILE = "state.json"
+
+TABLES = {
+    "artists": {
+        "id": "string",
+        "name": "string",
+        "popularity": "int",
+        "qt_followers": "int",
+        "updated_at": "datetime",
+    },
+    "releases": {
+        "id": "string",
+        "artist_id": "string",
+        "name": "string",
+        "release_date": "string",
+    },
+    "tracks": {
+        "release_id": "string",
+        "track_number": "int",
+        "name": "string",
+        "duration": "int",
+    },
+    "users": {
+        "username": "string",
+        "name": "string",
+        "qt_friends": "int",
+        "qt_ratings": "int",
+        "qt_follows": "int",
+        "updated_at": "datetime",
+    },
+    "rated": {
+        "username": "string",
+        "release_id": "string",
+        "rating": "float",
+        "created_at": "datetime",
+    },
+    "follows": {
+        "username": "string",
+        "artist_id": "string",
+        "created_at": "datetime",
+    },
+    "friends_with": {
+        "username": "string",
+        "friend": "string",
+        "created_at": "datetime",
+    },
+    "belongs_to": {
+        "artist_id": "string",
+        "genre": "string",
+    },
+    "released": {
+        "artist_id": "string",
+        "release_id": "string",
+    },
+    "artist_ids": {
+        "id": "string",
+    },
+    "user_ids": {
+        "username": "string",
+    },
+}
+
+# Edges of the users and the artists of a chunk, as rows of the edge tables
+USER_EDGES = {
+    "rated": """
+        UNWIND $keys AS key
+        MATCH (u:User {username: key})-[r:RATED]->(rel:Release)
+        RETURN
+            u.username AS username,
+            rel.id AS release_id,
+            r.rating AS rating,
+            r.created_at AS created_at
+    """,
+    "follows": """
+        UNWIND $keys AS key
+        MATCH (u:User {username: key})-[f:FOLLOWS]->(a:Artist)
+        RETURN u.username AS username, a.id AS artist_id, f.created_at AS created_at
+    """,
+    "friends_with": """
+        UNWIND $keys AS key
+        MATCH (u:User {username: key})-[f:FRIENDS_WITH]->(friend:User)
+        RETURN u.username AS username, friend.username AS friend, f.created_at AS created_at
+    """,
+}
+ARTIST_EDGES = {
+    "belongs_to": """
+        UNWIND $keys AS key
+        MATCH (a:Artist {id: key})-[:BELONGS_TO]->(g:Genre)
+        RETURN a.id AS artist_id, g.name AS genre
+    """,
+    "released": """
+        UNWIND $keys AS key
+        MATCH (a:Artist {id: key})-[:RELEASED]->(r:Release)
+        RETURN a.id AS artist_id, r.id AS release_id
+    """,
+}
+
+def _datetime(value):
+    # MongoDB dates are naive UTC; Neo4j ones are driver types with a zone.
+    if value is None:
+        return None
+    if hasattr(value, "to_native"):
+        value = value.to_native()
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo = None)
+    return value
+
+def _encode(column: str, kind: str, values: list) -> dict:
+    match kind:
+        case "string":
+            dictionary = sorted({value for value in values if value is not None})
+            index = {value: code for code, value in enumerate(dictionary)}
+            return {
+                f"{column}.dictionary": np.array(dictionary, dtype = np.str_),
+                f"{column}.codes": np.array(
+                    [index.get(value, -1) for value in values],
+                    dtype = np.int32,
+                ),
+            }
+        case "int":
+            return {
+                column: np.array(
+                    [-1 if value is None else value for value in values],
+                    dtype = np.int64,
+                ),
+            }
+        case "float":
+            return {
+                column: np.array(
+                    [np.nan if value is None else value for value in values],
+                    dtype = np.float64,
+                ),
+            }
+        case "datetime":
+            return {
+                column: np.array(
+                    [_datetime(value) for value in values],
+                    dtype = "datetime64[ms]",
+                ),
+            }
+
+class TableWriter:
+    """
+    Rows of a table, written as a new `.npz` chunk every `chunk_size` rows.
+    """
+    def __init__(self, directory: str, name: str, chunk_size: int):
+        self.directory = os.path.join(directory, name)
+        self.columns = TABLES[name]
+        self.chunk_size = chunk_size
+        self.rows = {column: [] for column in self.columns}
+        self.parts = 0
+        self.count = 0
+        os.makedirs(self.directory, exist_ok = True)
+
+    def append(self, row: dict):
+        """Add a row, writing a chunk when full."""
+        for column, values in self.rows.items():
+            values.append(row.get(column))
+        if len(self.rows[next(iter(self.columns))]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as a chunk."""
+        size = len(self.rows[next(iter(self.columns))])
+        if not size:
+            return
+        arrays = {}
+        for column, kind in self.columns.items():
+            arrays.update(_encode(column, kind, self.rows[column]))
+        np.savez_compressed(os.path.join(self.directory, f"part-{self.parts:05}.npz"), **arrays)
+        self.parts += 1
+        self.count += size
+        self.rows = {column: [] for column in self.columns}
+
+def _chunks(cursor, size: int):
+    chunk = []
+    for document in cursor:
+        chunk.append(document)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _write_edges(writers: dict, queries: dict, keys: list):
+    for table, query in queries.items():
+        for record in neo4j.execute_query(f"export.{table}", query, keys = keys).records:
+            writers[table].append(record.data())
+
+def _export_artists(writers: dict, query: dict, sort: str, chunk_size: int):
+    cursor = mongodb.get_db().artists.find(
+        query,
+        {
+            "name": True,
+            "popularity": True,
+            "qt_followers": True,
+            "updated_at": True,
+            "releases.id": True,
+            "releases.name": True,
+            "releases.release_date": True,
+            "releases.tracks": True,
+        },
+        batch_size = chunk_size,
+    ).sort(sort, 1)
+
+    for chunk in _chunks(cursor, chunk_size):
+        for artist in chunk:
+            writers["artists"].append({
+                "id": artist["_id"],
+                "name": artist.get("name"),
+                "popularity": artist.get("popularity"),
+                "qt_followers": artist.get("qt_followers", 0),
+                "updated_at": artist.get("updated_at"),
+            })
+            for release in artist.get("releases", []):
+                writers["releases"].append({
+                    "id": release["id"],
+                    "artist_id": artist["_id"],
+                    "name": release.get("name"),
+                    "release_date": release.get("release_date"),
+                })
+                for track in release.get("tracks", []):
+                    writers["tracks"].append({
+                        "release_id": release["id"],
+                        "track_number": track.get("track_number"),
+                        "name": track.get("name"),
+                        "duration": track.get("duration"),
+                    })
+        _write_edges(writers, ARTIST_EDGES, [artist["_id"] for artist in chunk])
+
+def _export_users(writers: dict, query: dict, sort: str, chunk_size: int):
+    cursor = mongodb.get_db().users.find(
+        query,
+        {
+            "_id": False,
+            "username": True,
+            "name": True,
+            "updated_at": True,
+            "qt_friends": {
+                "$size": {
+                    "$ifNull": ["$friends", []],
+                },
+            },
+            "qt_ratings": {
+                "$size": {
+                    "$ifNull": ["$ratings", []],
+                },
+            },
+            "qt_follows": {
+                "$size": {
+                    "$ifNull": ["$follows", []],
+                },
+            },
+        },
+        batch_size = chunk_size,
+    ).sort(sort, 1)
+
+    for chunk in _chunks(cursor, chunk_size):
+        for user in chunk:
+            writers["users"].append(user)
+        _write_edges(writers, USER_EDGES, [user["username"] for user in chunk])
+
+def _export_ids(writers: dict, chunk_size: int):
+    artists = mongodb.get_db().artists.find(
+        {},
+        {
+            "_id": True,
+        },
+        batch_size = chunk_size,
+    )
+    for artist in artists:
+        writers["artist_ids"].append({"id": artist["_id"]})
+    users = mongodb.get_db().users.find(
+        {},
+        {
+            "_id": False,
+            "username": True,
+        },
+        batch_size = chunk_size,
+    )
+    for user in users:
+        writers["user_ids"].append(user)
+
+def _read_state(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, STATE_FILE), encoding = "utf-8") as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+
+def _write_json(path: str, data: dict):
+    # Written aside and renamed, so a crash never leaves half a file
+    with open(path + ".tmp", "w", encoding = "utf-8") as json_file:
+        json.dump(data, json_file, indent = 2)
+    os.replace(path + ".tmp", path)
+
+def export(directory: str, incremental: bool = False, chunk_size: int = CHUNK_SIZE) -> dict:
+    """
+    Export a snapshot into a new subdirectory of `directory`, returning its
+    manifest. An incremental export without a previous one is a full export.
+    """
+    state = _read_state(directory)
+    since = datetime.fromisoformat(state["until"]) if incremental and "until" in state else None
+    # The clock of the server, which sets updated_at with $currentDate
+    until = mongodb.get_db().command("hello")["localTime"]
+
+    snapshot = os.path.join(directory, until.strftime("%Y%m%dT%H%M%S"))
+    names = [name for name in TABLES if since is not None or not name.endswith("_ids")]
+    writers = {name: TableWriter(snapshot, name, chunk_size) for name in names}
+
+    if since is None:
+        # Documents changed during the export show up again in the next one
+        query, sort = {}, "_id"
+    else:
+        query = {
+            "updated_at": {
+                "$gt": since,
+                "$lte": until,
+            },
+        }
+        sort = "updated_at"
+
+    _export_artists(writers, query, sort, chunk_size)
+    _export_users(writers, query, sort, chunk_size)
+    if since is not None:
+        _export_ids(writers, chunk_size)
+    for writer in writers.values():
+        writer.flush()
+
+    manifest = {
+        "mode": "full" if since is None else "incremental",
+        "since": since.isoformat() if since else None,
+        "until": until.isoformat(),
+        "tables": {
+            name: {
+                "rows": writer.count,
+                "parts": writer.parts,
+                "columns": writer.columns,
+            }
+            for name, writer in writers.items()
+        },
+    }
+    _write_json(os.path.join(snapshot, "manifest.json"), manifest)
+    _write_json(os.path.join(directory, STATE_FILE), {
+        "until": until.isoformat(),
+        "snapshot": snapshot,
+    })
+    return manifest
@@ -0,0 +1,288 @@
+"""
+Module for the friends activity feed.
+
+Each user has a timeline in the `timelines` collection: the latest
+`FEED_SIZE` ratings and follows of their friends, newest first. A rating or
+follow is pushed to the timelines of the author's friends as it happens
+(fan-out on write), so reading a feed is a single document lookup.
+
+Users with more than `FEED_FANOUT_LIMIT` friends are flagged with
+`fanout_on_read` and skip that push, which would cost one write per friend.
+Their latest activity is instead merged into their friends' feeds when read
+(fan-out on read), from the end of their own `ratings` and `follows` arrays.
+When they drop back to the limit, that recent activity is pushed to their
+friends' timelines before their new events start being pushed.
+"""
+import os
+from datetime import datetime, timezone
+from pymongo import UpdateOne
+from configs import mongodb
+
+FEED_SIZE = int(os.getenv("FEED_SIZE", "200"))
+FANOUT_LIMIT = int(os.getenv("FEED_FANOUT_LIMIT", "500"))
+# Latest ratings and follows taken from a friend on read or on befriending
+RECENT_PER_FRIEND = int(os.getenv("FEED_RECENT_PER_FRIEND", "20"))
+
+def now() -> datetime:
+    """
+    Get the timestamp for a new rating, follow or friendship.
+    """
+    # BSON dates have millisecond precision
+    timestamp = datetime.now(timezone.utc)
+    return timestamp.replace(microsecond = timestamp.microsecond // 1000 * 1000)
+
+def rating_event(username: str, rating: dict) -> dict:
+    """
+    Build the feed event of a rating, as stored in a user's `ratings`.
+    """
+    return {
+        "type": "rating",
+        "username": username,
+        "id": rating["id"],
+        "name": rating["name"],
+        "artist": rating["artist"],
+        "rating": rating["rating"],
+        "created_at": rating["created_at"],
+    }
+
+def follow_event(username: str, follow: dict) -> dict:
+    """
+    Build the feed event of a follow, as stored in a user's `follows`.
+    """
+    return {
+        "type": "follow",
+        "username": username,
+        "id": follow["id"],
+        "name": follow["name"],
+        "created_at": follow["created_at"],
+    }
+
+def recent_events(user: dict) -> list:
+    """
+    Get the latest events of a user document with `username`, `ratings` and
+    `follows`. Ratings and follows from before timestamps existed are skipped.
+    """
+    events = [
+        rating_event(user["username"], rating)
+        for rating in user.get("ratings", [])[-RECENT_PER_FRIEND:]
+        if "created_at" in rating
+    ]
+    events.extend(
+        follow_event(user["username"], follow)
+        for follow in user.get("follows", [])[-RECENT_PER_FRIEND:]
+        if "created_at" in follow
+    )
+    return events
+
+def _push(usernames: list, events: list):
+    # Adds events to the timelines, keeping only the newest FEED_SIZE.
+    if not usernames or not events:
+        return
+    mongodb.db.timelines.bulk_write(
+        [
+            UpdateOne(
+                {
+                    "_id": username,
+                },
+                {
+                    "$push": {
+                        "items": {
+                            "$each": events,
+                            "$sort": {
+                                "created_at": -1,
+                            },
+                            "$slice": FEED_SIZE,
+                        },
+                    },
+                },
+                upsert = True,
+            )
+            for username in usernames
+        ],
+        ordered = False,
+    )
+
+def publish(friends: list, event: dict):
+    """
+    Push an event of a user to their friends' timelines, unless the user's
+    activity is read on demand.
+    """
+    if len(friends) <= FANOUT_LIMIT:
+        _push(friends, [event])
+
+def retract(username: str, friends: list, kind: str, entity_id: str):
+    """
+    Remove the events of a removed rating or follow from the friends' timelines.
+    """
+    if not friends:
+        return
+    mongodb.db.timelines.update_many(
+        {
+            "_id": {
+                "$in": friends,
+            },
+        },
+        {
+            "$pull": {
+                "items": {
+                    "type": kind,
+                    "username": username,
+                    "id": entity_id,
+                },
+            },
+        },
+    )
+
+def set_friend_count(username: str, count: int):
+    """
+    Flag or unflag a user for fan-out on read, after their number of friends
+    changed to `count`. When unflagged, their recent activity, until then
+    merged on read, is pushed to their friends' timelines.
+    """
+    if count == FANOUT_LIMIT + 1:
+        mongodb.db.users.update_one(
+            {
+                "username": username,
+            },
+            {
+                "$set": {
+                    "fanout_on_read": True,
+                },
+            },
+        )
+    elif count == FANOUT_LIMIT:
+        user = mongodb.db.users.find_one_and_update(
+            {
+                "username": username,
+                "fanout_on_read": True,
+            },
+            {
+                "$set": {
+                    "fanout_on_read": False,
+                },
+            },
+            {
+                "username": True,
+                "friends": True,
+                "ratings": {
+                    "$slice": -RECENT_PER_FRIEND,
+                },
+                "follows": {
+                    "$slice": -RECENT_PER_FRIEND,
+                },
+            },
+        )
+        if user:
+            _push(user.get("friends") or [], recent_events(user))
+
+def befriend(user: dict, friend: dict):
+    """
+    Add the recent activity of each new friend to the other's timeline. Both
+    documents must have `username`, `qt_friends`, `ratings` and `follows`, as
+    they are after the friendship.
+    """
+    for reader, author in ((user, friend), (friend, user)):
+        set_friend_count(reader["username"], reader["qt_friends"])
+        if author["qt_friends"] <= FANOUT_LIMIT:
+            _push([reader["username"]], recent_events(author))
+
+def unfriend(username1: str, username2: str):
+    """
+    Remove the events of each former friend from the other's timeline.
+    """
+    for reader, author in ((username1, username2), (username2, username1)):
+        mongodb.db.timelines.update_one(
+            {
+                "_id": reader,
+            },
+            {
+                "$pull": {
+                    "items": {
+                        "username": author,
+                    },
+                },
+            },
+        )
+
+def remove_user(username: str, friends: list):
+    """
+    Remove the timeline of a deleted user and their events from the others.
+    """
+    mongodb.db.timelines.delete_one(
+        {
+            "_id": username,
+        },
+    )
+    if friends:
+        mongodb.db.timelines.update_many(
+            {
+                "_id": {
+                    "$in": friends,
+                },
+            },
+            {
+                "$pull": {
+                    "items": {
+                        "username": username,
+                    },
+                },
+            },
+        )
+
+def sort_key(event: dict) -> tuple:
+    """
+    Get the key that orders the feed, newest first when reversed.
+    """
+    return (event["created_at"].timestamp(), event["username"], event["type"], event["id"])
+
+def read(username: str, before: tuple | None, limit: int) -> tuple[list, tuple | None]:
+    """
+    Get a page of a user's feed, with the events older than `before`, and the
+    sort key of its last event if there are more pages.
+    """
+    timeline = mongodb.db.timelines.find_one(
+        {
+            "_id": username,
+        },
+        {
+            "items": True,
+        },
+    )
+    events = timeline["items"] if timeline else []
+
+    # The friends whose activity is not pushed, through a partial index
+    events.extend(
+        event
+        for friend in mongodb.db.users.find(
+            {
+                "fanout_on_read": True,
+                "friends": username,
+            },
+            {
+                "username": True,
+                "ratings": {
+                    "$slice": -RECENT_PER_FRIEND,
+                },
+                "follows": {
+                    "$slice": -RECENT_PER_FRIEND,
+                },
+            },
+        )
+        for event in recent_events(friend)
+    )
+
+    for event in events:
+        if event["created_at"].tzinfo is None:
+            event["created_at"] = event["created_at"].replace(tzinfo = timezone.utc)
+
+    # A user flagged after their events were pushed shows up both ways
+    unique = {}
+    for event in events:
+        unique[sort_key(event)] = event
+    keys = sorted(unique, reverse = True)
+    if before is not None:
+        keys = [key for key in keys if key < before]
+
+    page = keys[:limit]
+    next_key = page[-1] if len(keys) > limit else None
+    return [unique[key] for key in page], next_key
@@ -0,0 +1,309 @@
+"""
+Module for the in-process existence filters of users, artists and releases.
+
+Each filter is a Bloom filter: it answers "definitely absent" or "maybe
+present". `helper.exists` trusts the first answer and skips the database, so
+lookups of IDs that do not exist (scrapers, stale links, typos) end at once.
+
+The filters are built in the background from a projection scan of MongoDB and
+rebuilt every `FILTER_REBUILD_SECONDS`, picking up ingestion done outside the
+API. New users are added as they register; with `REDIS_URL` set, every worker
+is told through Redis pub/sub. Deleted users cannot be removed from a Bloom
+filter, so they stay "maybe present" until the next rebuild and fall back to
+the database. After an ingestion, `python manage.py filters` makes every
+worker rebuild at once.
+
+Without Redis a user registered in one worker would be "definitely absent" in
+the others, so the filters are off by default unless Redis is configured.
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from redis.exceptions import RedisError
+from configs import mongodb, redis, routing
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("EXISTENCE_FILTERS", "true" if redis.ENABLED else "false").lower() == "true"
+ERROR_RATE = float(os.getenv("FILTER_ERROR_RATE", "0.01"))
+# Headroom over the estimated number of items, for growth between rebuilds
+# and for the estimate being off
+CAPACITY_FACTOR = float(os.getenv("FILTER_CAPACITY_FACTOR", "1.5"))
+REBUILD_SECONDS = float(os.getenv("FILTER_REBUILD_SECONDS", "3600"))
+CHANNEL = "filters:added"
+BATCH_SIZE = 10_000
+
+KINDS = ("user", "artist", "release")
+
+class BloomFilter:
+    """
+    Bloom filter sized for a number of items and a false-positive rate.
+    """
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        # Double hashing: the k positions come from two 64-bit hashes.
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size = 16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, item: str):
+        """Add an item."""
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    @property
+    def memory_bytes(self) -> int:
+        """Size of the bit array."""
+        return len(self.bits)
+
+    @property
+    def false_positive_rate(self) -> float:
+        """Estimated false-positive rate for the items added so far."""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+_lock = threading.Lock()
+_rebuild = threading.Event()
+_filters: dict[str, BloomFilter] = {}
+# Items added while a rebuild scans MongoDB, replayed on the new filters
+_pending: dict[str, list] | None = None
+_state = {
+    "pid": None,
+    "built_at": None,
+}
+
+def _scan(kind: str):
+    # Streams the IDs of a kind, projecting nothing else.
+    db = mongodb.get_db()
+    match kind:
+        case "user":
+            users = db.users.find(
+                {},
+                {
+                    "_id": False,
+                    "username": True,
+                },
+                batch_size = BATCH_SIZE,
+            )
+            for user in users:
+                yield user["username"]
+        case "artist":
+            artists = db.artists.find(
+                {},
+                {
+                    "_id": True,
+                },
+                batch_size = BATCH_SIZE,
+            )
+            for artist in artists:
+                yield artist["_id"]
+        case "release":
+            artists = db.artists.find(
+                {},
+                {
+                    "_id": False,
+                    "releases.id": True,
+                },
+                batch_size = BATCH_SIZE,
+            )
+            for artist in artists:
+                for release in artist.get("releases", []):
+                    yield release["id"]
+
+def _count(kind: str) -> int:
+    # The number of items of a kind, from the collection metadata or, for
+    # releases, counted by the server, to size a filter before the scan.
+    db = mongodb.get_db()
+    match kind:
+        case "user":
+            return db.users.estimated_document_count()
+        case "artist":
+            return db.artists.estimated_document_count()
+        case "release":
+            result = list(db.artists.aggregate([
+                {
+                    "$group": {
+                        "_id": None,
+                        "count": {
+                            "$sum": {
+                                "$size": {
+                                    "$ifNull": ["$releases", []],
+                                },
+                            },
+                        },
+                    },
+                },
+            ]))
+            return result[0]["count"] if result else 0
+
+def _report_metrics():
+    for kind, bloom in _filters.items():
+        metrics.FILTER_ITEMS.labels(kind).set(bloom.count)
+        metrics.FILTER_MEMORY.labels(kind).set(bloom.memory_bytes)
+        metrics.FILTER_FALSE_POSITIVE_RATE.labels(kind).set(bloom.false_positive_rate)
+
+def build():
+    """
+    Build every filter from a scan of MongoDB and swap them in.
+    """
+    global _pending
+    with _lock:
+        _pending = {kind: [] for kind in KINDS}
+
+    try:
+        # Items are added as the scan streams them, never held in a list
+        filters = {}
+        for kind in KINDS:
+            bloom = BloomFilter(int(_count(kind) * CAPACITY_FACTOR), ERROR_RATE)
+            for item in _scan(kind):
+                bloom.add(item)
+            filters[kind] = bloom
+
+        with _lock:
+            for kind, added in _pending.items():
+                for item in added:
+                    filters[kind].add(item)
+            _filters.clear()
+            _filters.update(filters)
+            _state["built_at"] = time.time()
+    finally:
+        with _lock:
+            _pending = None
+
+    _report_metrics()
+    logger.info(
+        "Built existence filters: %s",
+        ", ".join(
+            f"{kind} {bloom.count} items in {bloom.memory_bytes} bytes"
+            for kind, bloom in _filters.items()
+        ),
+    )
+
+def _add_local(kind: str, item: str):
+    with _lock:
+        if _pending is not None:
+            _pending[kind].append(item)
+        bloom = _filters.get(kind)
+        if bloom is not None:
+            bloom.add(item)
+
+def request_rebuild():
+    """
+    Make every worker rebuild its filters now, as after an ingestion.
+    """
+    redis.get_client().publish(CHANNEL, "rebuild::")
+
+def add(kind: str, item: str):
+    """
+    Add a new item to the filters of every worker.
+    """
+    if not ENABLED:
+        return
+    _add_local(kind, item)
+    if redis.ENABLED:
+        try:
+            redis.get_client().publish(CHANNEL, f"{kind}:{os.getpid()}:{item}")
+        except RedisError as e:
+            logger.warning("Could not publish %s %s to the other workers: %s", kind, item, e)
+
+def might_exist(kind: str, item: str) -> bool:
+    """
+    Check if an item might exist; False means it definitely does not. Always
+    True while the filters are off or not built yet, and for requests that
+    read their own writes.
+    """
+    if not ENABLED or not routing.current.get().mongodb_secondary:
+        return True
+    bloom = _filters.get(kind)
+    if bloom is None:
+        return True
+
+    found = item in bloom
+    metrics.FILTER_CHECKS.labels(kind, "maybe" if found else "absent").inc()
+    return found
+
+def _subscribe():
+    # Applies the items added by the other workers, reconnecting on errors.
+    lost = False
+    while True:
+        try:
+            pubsub = redis.get_client().pubsub(ignore_subscribe_messages = True)
+            pubsub.subscribe(CHANNEL)
+            if lost:
+                # Items added while disconnected were missed
+                _rebuild.set()
+                lost = False
+            for message in pubsub.listen():
+                kind, pid, item = message["data"].split(":", 2)
+                if kind == "rebuild":
+                    _rebuild.set()
+                elif kind in KINDS and pid != str(os.getpid()):
+                    _add_local(kind, item)
+        except RedisError as e:
+            logger.warning("Filter subscription lost, disabling the filters until rebuilt: %s", e)
+            with _lock:
+                _filters.clear()
+            lost = True
+            time.sleep(1)
+
+def _refresh():
+    while True:
+        try:
+            build()
+            _rebuild.wait(REBUILD_SECONDS)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logger.warning("Could not build the existence filters: %s", e)
+            _rebuild.wait(min(REBUILD_SECONDS, 30))
+        _rebuild.clear()
+
+def start():
+    """
+    Start building and refreshing the filters in the background, once per
+    process.
+    """
+    with _lock:
+        if not ENABLED or _state["pid"] == os.getpid():
+            return
+        _state["pid"] = os.getpid()
+        _filters.clear()
+
+    if redis.ENABLED:
+        threading.Thread(target = _subscribe, name = "filters-subscribe", daemon = True).start()
+    threading.Thread(target = _refresh, name = "filters-refresh", daemon = True).start()
+
+def report() -> dict:
+    """
+    Get the size and estimated false-positive rate of each filter.
+    """
+    return {
+        "enabled": ENABLED,
+        "built_at": _state["built_at"],
+        "error_rate": ERROR_RATE,
+        "filters": {
+            kind: {
+                "items": bloom.count,
+                "memory_bytes": bloom.memory_bytes,
+                "hashes": bloom.hashes,
+                "false_positive_rate": round(bloom.false_positive_rate, 6),
+            }
+            for kind, bloom in _filters.items()
+        },
+    }
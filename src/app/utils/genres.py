@@ -0,0 +1,82 @@
+"""
+Module for maintaining what the genre browse routes read.
+
+Each genre's artists are served by the multikey indexes on `artists.genres`
+plus popularity or followers (see `configs/indexes.py`), which MongoDB keeps up
+to date by itself. Popularity only comes from Neo4j, so it is copied to the
+artist documents, and the list of genres with their artist counts is
+materialized in the `genres` collection.
+"""
+from pymongo import UpdateOne
+from configs import mongodb, neo4j
+
+BATCH_SIZE = 1_000
+
+def backfill_popularity() -> int:
+    """
+    Copy the popularity of every artist from Neo4j to MongoDB, returning the
+    number of artists updated. Artists missing from Neo4j get 0.
+    """
+    popularity = {
+        record["id"]: record["popularity"] or 0
+        for record in neo4j.driver.execute_query(
+            "MATCH (a:Artist) RETURN a.id AS id, a.popularity AS popularity"
+        ).records
+    }
+
+    updated = 0
+    operations = []
+    artists = mongodb.get_db().artists.find(
+        {},
+        {
+            "popularity": True,
+        },
+    )
+    for artist in artists:
+        value = popularity.get(artist["_id"], 0)
+        if artist.get("popularity") == value:
+            continue
+        operations.append(UpdateOne(
+            {
+                "_id": artist["_id"],
+            },
+            {
+                "$currentDate": {
+                    "updated_at": True,
+                },
+                "$set": {
+                    "popularity": value,
+                },
+            },
+        ))
+        if len(operations) == BATCH_SIZE:
+            result = mongodb.get_db().artists.bulk_write(operations, ordered = False)
+            updated += result.modified_count
+            operations = []
+    if operations:
+        result = mongodb.get_db().artists.bulk_write(operations, ordered = False)
+        updated += result.modified_count
+    return updated
+
+def rebuild() -> int:
+    """
+    Replace the `genres` collection with every genre and its number of
+    artists, returning the number of genres.
+    """
+    mongodb.get_db().artists.aggregate([
+        {
+            "$unwind": "$genres",
+        },
+        {
+            "$group": {
+                "_id": "$genres",
+                "qt_artists": {
+                    "$sum": 1,
+                },
+            },
+        },
+        {
+            "$out": "genres",
+        },
+    ])
+    return mongodb.get_db().genres.count_documents({})
@@ -1,32 +1,28 @@
 """
 Module for the helper functions of the app.
 """
+import base64
+import binascii
+import json
+from flask import request
 from configs import mongodb, neo4j
+from utils import filters, loaders
 
 def exists(entity: str, *identifiers: str) -> bool:
     """
-    Check if an entity exists in the database.
+    Check if an entity exists in the database. Users and artists are read
+    through the request's loaders, so a later lookup of the same one costs
+    nothing. Users, artists and releases that the existence filters rule out
+    are not looked up.
     """
     match entity:
-        case "user":
-            return mongodb.db.users.find_one(
-                {
-                    "username": identifiers[0],
-                },
-                {
-                    "_id": True,
-                },
-            ) is not None
-        case "artist":
-            return mongodb.db.artists.find_one(
-                {
-                    "_id": identifiers[0],
-                },
-                {
-                    "_id": True,
-                },
-            ) is not None
+        case "user" | "artist":
+            return loaders.load(entity, identifiers[0]) is not None
         case "release":
+            # Reading a release's summary takes an aggregation, so only the
+            # match is checked
+            if not filters.might_exist("release", identifiers[0]):
+                return False
             return mongodb.db.artists.find_one(
                 {
                     "releases.id": identifiers[0],
@@ -36,7 +32,8 @@ def exists(entity: str, *identifiers: str) -> bool:
                 },
             ) is not None
         case "rating":
-            return neo4j.driver.execute_query(
+            return neo4j.execute_query(
+                "helper.rating_exists",
                 """
                 RETURN EXISTS(
                     (:User {username: $username})-[:RATED]->(:Release {id: $release_id})
@@ -46,7 +43,8 @@ def exists(entity: str, *identifiers: str) -> bool:
                 release_id = identifiers[1],
             )[0][0]["exists"]
         case "follow":
-            return neo4j.driver.execute_query(
+            return neo4j.execute_query(
+                "helper.follow_exists",
                 """
                 RETURN EXISTS(
                     (:User {username: $username})-[:FOLLOWS]->(:Artist {id: $artist_id})
@@ -56,7 +54,8 @@ def exists(entity: str, *identifiers: str) -> bool:
                 artist_id = identifiers[1],
             )[0][0]["exists"]
         case "friendship":
-            return neo4j.driver.execute_query(
+            return neo4j.execute_query(
+                "helper.friendship_exists",
                 """
                 RETURN EXISTS(
                     (:User {username: $username1})-[:FRIENDS_WITH]-(:User {username: $username2})
@@ -66,7 +65,8 @@ def exists(entity: str, *identifiers: str) -> bool:
                 username2 = identifiers[1],
             )[0][0]["exists"]
         case "genre":
-            return neo4j.driver.execute_query(
+            return neo4j.execute_query(
+                "helper.genre_exists",
                 """
                 MATCH (g:Genre {name: $genre})
                 RETURN COUNT(g) > 0 AS exists
@@ -75,3 +75,62 @@ def exists(entity: str, *identifiers: str) -> bool:
             )[0][0]["exists"]
         case _:
             raise ValueError(f"Unknown entity type: {entity}")
+
+def parse_limit(default: int = 10, maximum: int = 100, parameter: str = "limit") -> int | None:
+    """
+    Get the `limit` query parameter (or another one, such as a per-section
+    limit), or None if it is invalid.
+    """
+    limit = request.args.get(parameter, default, type = int)
+    if limit is None or not 1 <= limit <= maximum:
+        return None
+    return limit
+
+def _names(parameter: str) -> list | None:
+    value = request.args.get(parameter)
+    if value is None:
+        return None
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+def parse_fields(
+    fields: tuple,
+    embedded: tuple = (),
+    default: tuple = (),
+) -> tuple[set | None, str | None]:
+    """
+    Get the fields selected with the `fields` and `include` query parameters,
+    out of the plain `fields` and the `embedded` lists. Without either, every
+    plain field and the `default` lists are selected; with only `include`,
+    every plain field and the listed lists.
+
+    Returns the selected fields, or None and the name of the invalid
+    parameter.
+    """
+    requested = _names("fields")
+    include = _names("include")
+    if requested is not None and not set(requested) <= set(fields) | set(embedded):
+        return None, "fields"
+    if include is not None and not set(include) <= set(embedded):
+        return None, "include"
+
+    if requested is None and include is None:
+        return set(fields) | set(default), None
+    selected = set(fields) if requested is None else set(requested)
+    return selected | set(include or ()), None
+
+def encode_cursor(*values) -> str:
+    """
+    Encode the sort keys of the last item of a page as an opaque cursor.
+    """
+    payload = json.dumps(values, separators = (",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> list | None:
+    """
+    Decode a cursor made by `encode_cursor`, or None if it is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (binascii.Error, ValueError, UnicodeError):
+        return None
+    return values if isinstance(values, list) else None
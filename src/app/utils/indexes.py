@@ -0,0 +1,127 @@
+"""
+Module for comparing the live databases against the index spec and applying it.
+"""
+import logging
+from configs import mongodb, neo4j
+from configs.indexes import MONGODB_INDEXES, NEO4J_SCHEMA
+
+logger = logging.getLogger(__name__)
+
+def _mongodb_status(spec: dict, live: dict) -> str:
+    for index in live.values():
+        if list(index["key"]) == list(spec["keys"]):
+            if (
+                bool(index.get("unique")) == bool(spec.get("unique"))
+                and index.get("partialFilterExpression") == spec.get("partial")
+            ):
+                return "ok"
+            return "conflict"
+    return "missing"
+
+def _neo4j_status(spec: dict, constraints: list, indexes: list) -> str:
+    schema = (spec["label"], spec["property"])
+    if spec["kind"] == "constraint":
+        for constraint in constraints:
+            if "UNIQUENESS" not in constraint["type"]:
+                continue
+            if (constraint["labelsOrTypes"][0], constraint["properties"][0]) == schema:
+                return "ok"
+        return "missing"
+
+    for index in indexes:
+        if index["type"] != "RANGE" or len(index["properties"] or []) != 1:
+            continue
+        if (index["labelsOrTypes"][0], index["properties"][0]) == schema:
+            return "ok"
+    return "missing"
+
+def diff() -> list:
+    """
+    Get the status of every entry of the spec: "ok", "missing" or "conflict",
+    the last meaning an index exists on the same keys with other options.
+    """
+    entries = []
+    live_mongodb = {}
+    for spec in MONGODB_INDEXES:
+        collection = spec["collection"]
+        if collection not in live_mongodb:
+            live_mongodb[collection] = mongodb.db[collection].index_information()
+        entries.append({
+            "database": "mongodb",
+            "spec": spec,
+            "status": _mongodb_status(spec, live_mongodb[collection]),
+        })
+
+    constraints = neo4j.driver.execute_query(
+        "SHOW CONSTRAINTS YIELD name, type, labelsOrTypes, properties"
+    ).records
+    indexes = neo4j.driver.execute_query(
+        "SHOW INDEXES YIELD name, type, labelsOrTypes, properties"
+    ).records
+    for spec in NEO4J_SCHEMA:
+        entries.append({
+            "database": "neo4j",
+            "spec": spec,
+            "status": _neo4j_status(spec, constraints, indexes),
+        })
+
+    return entries
+
+def describe(entry: dict) -> str:
+    """
+    Describe an entry of the spec in one line.
+    """
+    spec = entry["spec"]
+    if entry["database"] == "mongodb":
+        keys = ", ".join(f"{field}: {direction}" for field, direction in spec["keys"])
+        unique = " unique" if spec.get("unique") else ""
+        partial = f" where {spec['partial']}" if "partial" in spec else ""
+        return f"mongodb {spec['collection']} {{{keys}}}{unique}{partial}"
+    return f"neo4j {spec['kind']} :{spec['label']}({spec['property']})"
+
+def apply(entries: list) -> list:
+    """
+    Create the missing entries, returning the ones created. Conflicting
+    indexes are left for a human to drop, since that could lock a collection.
+    """
+    created = []
+    for entry in entries:
+        if entry["status"] != "missing":
+            continue
+
+        spec = entry["spec"]
+        if entry["database"] == "mongodb":
+            options = {}
+            if "partial" in spec:
+                options["partialFilterExpression"] = spec["partial"]
+            mongodb.db[spec["collection"]].create_index(
+                spec["keys"],
+                name = spec["name"],
+                unique = spec.get("unique", False),
+                **options,
+            )
+        elif spec["kind"] == "constraint":
+            neo4j.driver.execute_query(
+                f"CREATE CONSTRAINT {spec['name']} IF NOT EXISTS "
+                f"FOR (n:{spec['label']}) REQUIRE n.{spec['property']} IS UNIQUE"
+            )
+        else:
+            neo4j.driver.execute_query(
+                f"CREATE INDEX {spec['name']} IF NOT EXISTS "
+                f"FOR (n:{spec['label']}) ON (n.{spec['property']})"
+            )
+        created.append(entry)
+
+    return created
+
+def warn_missing():
+    """
+    Log a warning for every entry of the spec that the databases lack.
+    """
+    for entry in diff():
+        if entry["status"] != "ok":
+            logger.warning(
+                "Index %s is %s, run `python manage.py indexes --apply`",
+                describe(entry),
+                entry["status"],
+            )
@@ -0,0 +1,174 @@
+"""
+Module for loading users, artists and releases once per request.
+
+Each request gets a loader per kind of entity, kept on Flask's `g`. Keys
+given to `prime` wait until a document is actually needed, and then every
+waiting key is read with a single `$in` query on its collection. Documents
+read, and keys found missing, are kept until the request ends, so checking
+that a user exists and reading its name later costs one query.
+
+The documents are summaries (see `FIELDS`), read once: they are shared by the
+whole request and must not be modified, and they do not reflect the request's
+own writes.
+"""
+import threading
+from flask import g, has_app_context
+from configs import mongodb
+from utils import filters
+
+# The fields of the summary of each kind of entity
+FIELDS = {
+    "user": ("username", "name", "bio"),
+    "artist": ("id", "name", "bio", "genres"),
+    "release": ("id", "name", "artist", "artist_id", "genres"),
+}
+
+def _users(usernames: list) -> dict:
+    return {
+        user["username"]: user
+        for user in mongodb.db.users.find(
+            {
+                "username": {"$in": usernames},
+            },
+            {
+                "_id": False,
+                "username": True,
+                "name": {
+                    "$ifNull": ["$name", None],
+                },
+                "bio": {
+                    "$ifNull": ["$bio", None],
+                },
+            },
+        )
+    }
+
+def _artists(artist_ids: list) -> dict:
+    return {
+        artist["id"]: artist
+        for artist in mongodb.db.artists.find(
+            {
+                "_id": {"$in": artist_ids},
+            },
+            {
+                "_id": False,
+                "id": "$_id",
+                "name": True,
+                "bio": {
+                    "$ifNull": ["$bio", None],
+                },
+                "genres": True,
+            },
+        )
+    }
+
+def _releases(release_ids: list) -> dict:
+    return {
+        release["id"]: release
+        for release in mongodb.db.artists.aggregate([
+            {
+                "$match": {
+                    "releases.id": {"$in": release_ids},
+                },
+            },
+            {
+                "$unwind": "$releases",
+            },
+            {
+                "$match": {
+                    "releases.id": {"$in": release_ids},
+                },
+            },
+            {
+                "$project": {
+                    "_id": False,
+                    "id": "$releases.id",
+                    "name": "$releases.name",
+                    "artist": "$name",
+                    "artist_id": "$_id",
+                    "genres": True,
+                },
+            },
+        ])
+    }
+
+FETCHERS = {
+    "user": _users,
+    "artist": _artists,
+    "release": _releases,
+}
+
+class Loader:
+    """
+    The documents of one kind of entity read by a request, by key.
+    """
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._documents = {}
+        self._pending = set()
+
+    def prime(self, *keys: str):
+        """
+        Queue keys to be read with the next ones that are loaded.
+        """
+        with self._lock:
+            self._pending.update(key for key in keys if key not in self._documents)
+
+    def load_many(self, keys) -> dict:
+        """
+        Get the documents of `keys` by key, None for the missing ones, reading
+        the ones not loaded yet, with the queued keys, in one query.
+        """
+        keys = list(dict.fromkeys(keys))
+        with self._lock:
+            self._pending.update(key for key in keys if key not in self._documents)
+            if self._pending:
+                # Keys the existence filters rule out are not looked up
+                wanted = sorted(key for key in self._pending if filters.might_exist(self.kind, key))
+                found = FETCHERS[self.kind](wanted) if wanted else {}
+                for key in self._pending:
+                    self._documents[key] = found.get(key)
+                self._pending.clear()
+            return {key: self._documents[key] for key in keys}
+
+    def load(self, key: str) -> dict | None:
+        """
+        Get the document of `key`, or None if it does not exist.
+        """
+        return self.load_many((key,))[key]
+
+_lock = threading.Lock()
+
+def get(kind: str) -> Loader:
+    """
+    Get the loader of a kind of entity for the current request. Outside of
+    one, every call gets a new loader.
+    """
+    if not has_app_context():
+        return Loader(kind)
+    # Parts of the request run concurrently share `g`
+    with _lock:
+        loaders = g.setdefault("loaders", {})
+        if kind not in loaders:
+            loaders[kind] = Loader(kind)
+        return loaders[kind]
+
+def prime(kind: str, *keys: str):
+    """
+    Queue keys of a kind of entity to be read with the next ones loaded.
+    """
+    get(kind).prime(*keys)
+
+def load(kind: str, key: str) -> dict | None:
+    """
+    Get the summary of an entity, or None if it does not exist.
+    """
+    return get(kind).load(key)
+
+def load_many(kind: str, keys) -> dict:
+    """
+    Get the summaries of entities of one kind by key, None for the missing
+    ones.
+    """
+    return get(kind).load_many(keys)
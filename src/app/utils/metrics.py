@@ -0,0 +1,281 @@
+"""
+Module for the Prometheus metrics of the app.
+
+When running under Gunicorn, set `PROMETHEUS_MULTIPROC_DIR` so every worker
+writes its samples to a shared directory and `/metrics` aggregates them.
+"""
+import os
+import time
+from flask import Flask, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from pymongo import monitoring
+from configs import mongodb, neo4j
+
+# Database calls are much shorter than requests, so they get finer buckets.
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests handled, by route.",
+    ["endpoint", "method", "status"],
+)
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency, by route.",
+    ["endpoint", "method"],
+    buckets = REQUEST_BUCKETS,
+)
+
+MONGODB_COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds",
+    "MongoDB command latency, by collection and operation.",
+    ["collection", "command"],
+    buckets = QUERY_BUCKETS,
+)
+MONGODB_COMMAND_FAILURES = Counter(
+    "mongodb_command_failures_total",
+    "MongoDB commands that failed, by collection and operation.",
+    ["collection", "command"],
+)
+MONGODB_POOL_OPEN = Gauge(
+    "mongodb_pool_open_connections",
+    "Connections open in the MongoDB pools.",
+    multiprocess_mode = "livesum",
+)
+MONGODB_POOL_CHECKED_OUT = Gauge(
+    "mongodb_pool_checked_out_connections",
+    "Connections of the MongoDB pools in use by an operation.",
+    multiprocess_mode = "livesum",
+)
+MONGODB_POOL_MAX = Gauge(
+    "mongodb_pool_max_connections",
+    "Maximum size of the MongoDB pool of each server.",
+    multiprocess_mode = "livesum",
+)
+
+NEO4J_QUERY_DURATION = Histogram(
+    "neo4j_query_duration_seconds",
+    "Neo4j query latency measured by the client, by query name.",
+    ["query"],
+    buckets = QUERY_BUCKETS,
+)
+NEO4J_QUERY_AVAILABLE_AFTER = Histogram(
+    "neo4j_query_result_available_after_seconds",
+    "Time until the server had the first record ready, by query name.",
+    ["query"],
+    buckets = QUERY_BUCKETS,
+)
+NEO4J_QUERY_CONSUMED_AFTER = Histogram(
+    "neo4j_query_result_consumed_after_seconds",
+    "Time the server took to stream all records, by query name.",
+    ["query"],
+    buckets = QUERY_BUCKETS,
+)
+NEO4J_QUERY_FAILURES = Counter(
+    "neo4j_query_failures_total",
+    "Neo4j queries that failed, by query name.",
+    ["query"],
+)
+NEO4J_QUERIES_IN_FLIGHT = Gauge(
+    "neo4j_queries_in_flight",
+    "Neo4j queries started and not finished yet.",
+    multiprocess_mode = "livesum",
+)
+# Set by each worker, so the sum over the live workers is the total capacity
+NEO4J_POOL_MAX = Gauge(
+    "neo4j_pool_max_connections",
+    "Maximum size of the Neo4j pools of the live workers, summed.",
+    multiprocess_mode = "livesum",
+)
+
+SINGLEFLIGHT_CALLS = Counter(
+    "singleflight_calls_total",
+    "Reads through the singleflight layer, by name and outcome: led (ran the "
+    "query), coalesced (waited for a call in the same process) or shared "
+    "(got the result of a call in another process).",
+    ["name", "outcome"],
+)
+
+FILTER_CHECKS = Counter(
+    "existence_filter_checks_total",
+    "Existence checks answered by the filters, by kind and answer.",
+    ["kind", "answer"],
+)
+FILTER_ITEMS = Gauge(
+    "existence_filter_items",
+    "Items added to the existence filter of each worker.",
+    ["kind"],
+    multiprocess_mode = "livemax",
+)
+FILTER_MEMORY = Gauge(
+    "existence_filter_memory_bytes",
+    "Size of the bit array of the existence filter of each worker.",
+    ["kind"],
+    multiprocess_mode = "livemax",
+)
+FILTER_FALSE_POSITIVE_RATE = Gauge(
+    "existence_filter_false_positive_rate",
+    "Estimated false-positive rate of the existence filter of each worker.",
+    ["kind"],
+    multiprocess_mode = "livemax",
+)
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Records the latency of every MongoDB command.
+    """
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        command = event.command
+        if event.command_name == "getMore":
+            collection = command.get("collection")
+        else:
+            collection = command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+
+        self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGODB_COMMAND_DURATION.labels(
+            collection,
+            event.command_name,
+        ).observe(event.duration_micros / 1_000_000)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGODB_COMMAND_DURATION.labels(
+            collection,
+            event.command_name,
+        ).observe(event.duration_micros / 1_000_000)
+        MONGODB_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """
+    Tracks how many MongoDB connections are open and in use.
+    """
+    def __init__(self):
+        self._max_sizes = {}
+
+    def pool_created(self, event):
+        max_size = event.options.get("maxPoolSize", mongodb.MAX_POOL_SIZE)
+        self._max_sizes[event.address] = max_size
+        MONGODB_POOL_MAX.inc(max_size)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        MONGODB_POOL_MAX.dec(self._max_sizes.pop(event.address, 0))
+
+    def connection_created(self, event):
+        MONGODB_POOL_OPEN.inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGODB_POOL_OPEN.dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def connection_checked_out(self, event):
+        MONGODB_POOL_CHECKED_OUT.inc()
+
+    def connection_checked_in(self, event):
+        MONGODB_POOL_CHECKED_OUT.dec()
+
+class Neo4jQueryListener(neo4j.QueryListener):
+    """
+    Records the client and server side timings of every Neo4j query.
+    """
+    def started(self, name, query, parameters):
+        NEO4J_QUERIES_IN_FLIGHT.inc()
+
+    def succeeded(self, name, query, parameters, summary, duration):
+        NEO4J_QUERIES_IN_FLIGHT.dec()
+        NEO4J_QUERY_DURATION.labels(name).observe(duration)
+        if summary.result_available_after is not None:
+            NEO4J_QUERY_AVAILABLE_AFTER.labels(name).observe(
+                summary.result_available_after / 1000
+            )
+        if summary.result_consumed_after is not None:
+            NEO4J_QUERY_CONSUMED_AFTER.labels(name).observe(
+                summary.result_consumed_after / 1000
+            )
+
+    def failed(self, name, query, parameters, error, duration):
+        NEO4J_QUERIES_IN_FLIGHT.dec()
+        NEO4J_QUERY_DURATION.labels(name).observe(duration)
+        NEO4J_QUERY_FAILURES.labels(name).inc()
+
+def start_worker():
+    """
+    Set the gauges that describe the current worker process.
+    """
+    NEO4J_POOL_MAX.set(neo4j.MAX_POOL_SIZE)
+
+def install(app: Flask):
+    """
+    Start recording the request and database metrics of the app.
+
+    Must run before the first database access, since MongoDB listeners only
+    apply to clients created after they are registered.
+    """
+    monitoring.register(MongoCommandListener())
+    monitoring.register(MongoPoolListener())
+    neo4j.register(Neo4jQueryListener())
+    # Under Gunicorn with shared samples this runs in the master; each
+    # worker sets its own in `start_worker`
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        start_worker()
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return response
+
+        endpoint = request.endpoint or "unmatched"
+        REQUEST_DURATION.labels(endpoint, request.method).observe(
+            time.perf_counter() - start
+        )
+        REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+
+        return response
+
+def render() -> tuple[bytes, str]:
+    """
+    Render the metrics of every worker in the Prometheus text format.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,301 @@
+"""
+Module for the recommendations by personalized PageRank over the whole graph.
+
+A random walk from the user that follows FRIENDS_WITH, FOLLOWS, RATED,
+BELONGS_TO and RELEASED edges, in either direction, and jumps back to the user
+with probability `GRAPH_RESTART` at each step, ends most often on the artists
+and releases closest to the user by every signal at once.
+
+The ranks come from power iteration with the graph's sparse adjacency matrix,
+restricted at each step to the frontier: the nodes still holding more than
+`GRAPH_TOLERANCE` of walk per unit of degree, which pass it on to their
+neighbours. A walk from one user only reaches a small part of the graph with
+any weight, so a step costs the edges of that part, not of the whole graph.
+
+`python manage.py graph` reads the edges from Neo4j into a snapshot under
+`GRAPH_SNAPSHOT`: one directory of NumPy arrays per build, with the adjacency
+matrix in CSR form and the sorted keys of each kind of node, and a `current`
+link to the latest one. Every worker memory-maps it, like the catalog, and
+checks the link every `GRAPH_CHECK_SECONDS`.
+
+The recommendations of each user are cached for `GRAPH_CACHE_SECONDS`, in
+Redis when enabled, and until the next snapshot.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from redis.exceptions import RedisError
+from scipy import sparse
+from configs import neo4j, redis
+from utils import singleflight, snapshots
+
+logger = logging.getLogger(__name__)
+
+PATH = os.getenv("GRAPH_SNAPSHOT")
+CHECK_SECONDS = float(os.getenv("GRAPH_CHECK_SECONDS", "5"))
+RESTART = float(os.getenv("GRAPH_RESTART", "0.15"))
+TOLERANCE = float(os.getenv("GRAPH_TOLERANCE", "0.00001"))
+CACHE_SECONDS = int(os.getenv("GRAPH_CACHE_SECONDS", "600"))
+CACHE_SIZE = int(os.getenv("GRAPH_CACHE_SIZE", "10000"))
+
+# Recommendations kept per kind for each user, with room for the ones the
+# user followed or rated since the snapshot, which the routes leave out
+TOP = 20
+# Most steps of a walk; the frontier usually runs out long before
+ITERATIONS = 100
+KINDS = ("users", "artists", "releases", "genres")
+
+# Edges between two kinds of nodes, with their weights. Friendships are read
+# once per pair, whichever way they were created. Ratings of 0 are kept as
+# edges of weight 0: the walk never takes them, but `Graph.top` still finds
+# the release among the user's neighbours and leaves it out.
+EDGES = {
+    "friends_with": ("users", "users", """
+        MATCH (u:User)-[:FRIENDS_WITH]-(f:User)
+        WHERE u.username < f.username
+        RETURN u.username AS source, f.username AS target, 1.0 AS weight
+    """),
+    "follows": ("users", "artists", """
+        MATCH (u:User)-[:FOLLOWS]->(a:Artist)
+        RETURN u.username AS source, a.id AS target, 1.0 AS weight
+    """),
+    "rated": ("users", "releases", """
+        MATCH (u:User)-[r:RATED]->(rel:Release)
+        RETURN u.username AS source, rel.id AS target, coalesce(r.rating, 0) / 10.0 AS weight
+    """),
+    "belongs_to": ("artists", "genres", """
+        MATCH (a:Artist)-[:BELONGS_TO]->(g:Genre)
+        RETURN a.id AS source, g.name AS target, 1.0 AS weight
+    """),
+    "released": ("artists", "releases", """
+        MATCH (a:Artist)-[:RELEASED]->(r:Release)
+        RETURN a.id AS source, r.id AS target, 1.0 AS weight
+    """),
+}
+
+def build(path: str) -> dict:
+    """
+    Read the graph from Neo4j into a new snapshot under `path`, make it the
+    current one, and get the number of nodes of each kind and of edges.
+    """
+    numbers = {kind: {} for kind in KINDS}
+    sources = {name: [] for name in EDGES}
+    targets = {name: [] for name in EDGES}
+    weights = {name: [] for name in EDGES}
+
+    with neo4j.driver.session() as session:
+        for name, (source_kind, target_kind, query) in EDGES.items():
+            source_numbers = numbers[source_kind]
+            target_numbers = numbers[target_kind]
+            for record in session.run(query):
+                source = source_numbers.setdefault(record["source"], len(source_numbers))
+                target = target_numbers.setdefault(record["target"], len(target_numbers))
+                sources[name].append(source)
+                targets[name].append(target)
+                weights[name].append(record["weight"])
+
+    # Nodes are numbered kind after kind, each kind sorted by key, so a key
+    # is found by binary search and a kind is a range of numbers.
+    keys = {}
+    renumber = {}
+    offsets = {}
+    total = 0
+    for kind in KINDS:
+        ordered = sorted(numbers[kind], key = lambda key: key.encode("utf-8"))
+        keys[kind] = np.array([key.encode("utf-8") for key in ordered], dtype = np.bytes_)
+        renumber[kind] = np.empty(len(ordered), dtype = np.int64)
+        renumber[kind][[numbers[kind][key] for key in ordered]] = np.arange(len(ordered)) + total
+        offsets[kind] = total
+        total += len(ordered)
+
+    rows = []
+    columns = []
+    data = []
+    for name, (source_kind, target_kind, _) in EDGES.items():
+        source = renumber[source_kind][np.array(sources[name], dtype = np.int64)]
+        target = renumber[target_kind][np.array(targets[name], dtype = np.int64)]
+        weight = np.array(weights[name], dtype = np.float32)
+        # Walks go both ways
+        rows.extend((source, target))
+        columns.extend((target, source))
+        data.extend((weight, weight))
+
+    matrix = sparse.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))),
+        shape = (total, total),
+        dtype = np.float32,
+    )
+    matrix.sum_duplicates()
+
+    snapshots.write(path, {
+        **keys,
+        "indptr": matrix.indptr,
+        "indices": matrix.indices,
+        "data": matrix.data,
+        "degree": np.asarray(matrix.sum(axis = 1), dtype = np.float32).ravel(),
+    })
+
+    return {
+        **{kind: len(keys[kind]) for kind in KINDS},
+        "edges": sum(len(weights[name]) for name in EDGES),
+    }
+
+class Graph:
+    """
+    A memory-mapped graph snapshot.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        arrays, _ = snapshots.load(path, (*KINDS, "indptr", "indices", "data", "degree"))
+        self.keys = {kind: arrays[kind] for kind in KINDS}
+        self.offsets = {}
+        total = 0
+        for kind in KINDS:
+            self.offsets[kind] = total
+            total += len(self.keys[kind])
+        self.matrix = sparse.csr_matrix(
+            (arrays["data"], arrays["indices"], arrays["indptr"]),
+            shape = (total, total),
+            copy = False,
+        )
+        self.degree = np.asarray(arrays["degree"])
+        self.inverse_degree = np.divide(
+            1,
+            self.degree,
+            out = np.zeros_like(self.degree),
+            where = self.degree > 0,
+        )
+
+    def node(self, kind: str, key: str) -> int | None:
+        """Get the number of a node, or None if it is not in the graph."""
+        keys = self.keys[kind]
+        key = key.encode("utf-8")
+        position = int(np.searchsorted(keys, key))
+        if position < len(keys) and keys[position] == key:
+            return self.offsets[kind] + position
+        return None
+
+    def rank(self, node: int) -> np.ndarray:
+        """
+        Get the personalized PageRank of every node from `node`.
+        """
+        threshold = TOLERANCE * self.degree
+        ranks = np.zeros(self.matrix.shape[0], dtype = np.float32)
+        walks = np.zeros(self.matrix.shape[0], dtype = np.float32)
+        walks[node] = 1
+        frontier = np.array([node])
+        for _ in range(ITERATIONS):
+            if not len(frontier):
+                break
+            passed = walks[frontier]
+            walks[frontier] = 0
+            ranks[frontier] += RESTART * passed
+
+            # The edges of the frontier, with the neighbours renumbered
+            # from 0 so the product only spans the nodes it reaches
+            edges = self.matrix[frontier]
+            reached, columns = np.unique(edges.indices, return_inverse = True)
+            edges = sparse.csr_matrix(
+                (edges.data, columns, edges.indptr),
+                shape = (len(frontier), len(reached)),
+            )
+            walks[reached] += edges.T @ ((1 - RESTART) * passed * self.inverse_degree[frontier])
+            frontier = reached[walks[reached] > threshold[reached]]
+        return ranks
+
+    def top(self, node: int, ranks: np.ndarray, kind: str) -> list:
+        """
+        Get the best ranked nodes of a kind, best first, with their ranks,
+        leaving out the neighbours of `node`.
+        """
+        start = self.offsets[kind]
+        scores = np.array(ranks[start:start + len(self.keys[kind])])
+        indptr = self.matrix.indptr
+        neighbours = np.asarray(self.matrix.indices[indptr[node]:indptr[node + 1]])
+        neighbours = neighbours[(neighbours >= start) & (neighbours < start + len(scores))] - start
+        scores[neighbours] = 0
+
+        best = np.flatnonzero(scores)
+        if len(best) > TOP:
+            best = best[np.argpartition(-scores[best], TOP - 1)[:TOP]]
+        best = best[np.argsort(-scores[best], kind = "stable")]
+        return [
+            {
+                "id": self.keys[kind][position].decode("utf-8"),
+                "score": float(scores[position]),
+            }
+            for position in best
+        ]
+
+_lock = threading.Lock()
+_cache = OrderedDict()
+_snapshot = snapshots.Mapped(PATH, CHECK_SECONDS, Graph)
+
+def get() -> Graph | None:
+    """
+    Get the snapshot mapped by the current process, mapping the new one if it
+    changed, or None without `GRAPH_SNAPSHOT` or a readable snapshot.
+    """
+    return _snapshot.get()
+
+def _cached(key: str) -> dict | None:
+    if redis.ENABLED:
+        try:
+            value = redis.client.get(key)
+        except RedisError as e:
+            logger.warning("Could not read the cached graph recommendations: %s", e)
+            return None
+        return json.loads(value) if value is not None else None
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        _cache.move_to_end(key)
+        return entry[1]
+
+def _store(key: str, recommendations: dict):
+    if redis.ENABLED:
+        try:
+            redis.client.set(key, json.dumps(recommendations), ex = CACHE_SECONDS)
+        except RedisError as e:
+            logger.warning("Could not cache the graph recommendations: %s", e)
+        return
+    with _lock:
+        _cache[key] = (time.monotonic() + CACHE_SECONDS, recommendations)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last = False)
+
+def recommend(username: str) -> dict | None:
+    """
+    Get the best ranked artists and releases for a user that they do not
+    follow or rate yet, or None if the user is not in the graph. Raises
+    LookupError without a graph snapshot.
+    """
+    graph = get()
+    if graph is None:
+        raise LookupError("There is no graph snapshot")
+
+    key = f"pagerank:{os.path.basename(graph.path)}:{username}"
+    recommendations = _cached(key)
+    if recommendations is not None:
+        return recommendations
+
+    node = graph.node("users", username)
+    if node is None:
+        return None
+
+    def rank():
+        ranks = graph.rank(node)
+        return {
+            "artists": graph.top(node, ranks, "artists"),
+            "releases": graph.top(node, ranks, "releases"),
+        }
+
+    recommendations = singleflight.do("pagerank.recommend", key, rank)
+    _store(key, recommendations)
+    return recommendations
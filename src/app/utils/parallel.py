@@ -0,0 +1,64 @@
+"""
+Module for running the independent parts of a request concurrently.
+
+Each part runs in a thread of a pool shared by the process, inside a copy of
+the request's context, so the routing of its reads (see `configs.routing`),
+its trace and Flask's `request` all carry over.
+"""
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("PARALLEL_WORKERS", "16"))
+
+_lock = threading.Lock()
+_state = {
+    "pid": None,
+    "executors": {},
+}
+
+def executor(name: str, workers: int) -> ThreadPoolExecutor:
+    """
+    Get the thread pool `name` of the current process, creating it with
+    `workers` threads. Work that waits on another pool must not share it, or
+    a full pool could wait on itself.
+    """
+    # One set of pools per process; the threads of a forked parent do not
+    # exist here.
+    with _lock:
+        if _state["pid"] != os.getpid():
+            _state["executors"] = {}
+            _state["pid"] = os.getpid()
+        if name not in _state["executors"]:
+            _state["executors"][name] = ThreadPoolExecutor(
+                max_workers = workers,
+                thread_name_prefix = name,
+            )
+        return _state["executors"][name]
+
+def run(parts: dict, required: tuple = ()) -> dict:
+    """
+    Call every function of `parts` concurrently and get their results by
+    name. A part that fails gets None and is logged, unless it is `required`,
+    in which case its exception is raised.
+    """
+    pool = executor("parallel", WORKERS)
+    futures = {
+        name: pool.submit(contextvars.copy_context().run, function)
+        for name, function in parts.items()
+    }
+
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            if name in required:
+                raise
+            logger.warning("Part %s of the request failed: %s", name, e)
+            results[name] = None
+    return results
@@ -0,0 +1,397 @@
+"""
+Module for checking, and optionally repairing, what MongoDB and Neo4j disagree
+on.
+
+The routes write MongoDB first and Neo4j second, so a crash in between leaves
+a user's `friends`, `ratings` and `follows` without their `FRIENDS_WITH`,
+`RATED` and `FOLLOWS` edges, or the other way around. MongoDB is the source
+of truth: a repair makes Neo4j match it. Artist `qt_followers` are checked
+against the number of users following each artist in MongoDB.
+
+Both stores are streamed in chunks of `chunk_size`, sorted by username (or
+artist ID): each MongoDB chunk gives a key range, and the Neo4j users in that
+range are read with one query. Chunks are diffed by a pool of threads, with
+a bounded number in flight, so memory does not grow with the number of users.
+
+Writes keep happening during a check, so a repair first reads the users with
+discrepancies again and only fixes what still differs.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateOne
+from configs import mongodb, neo4j
+from utils import counters
+
+CHUNK_SIZE = 1_000
+
+NEO4J_USERS_QUERY = """
+MATCH (u:User)
+WHERE {conditions}
+RETURN
+    u.username AS username,
+    [(u)-[:FRIENDS_WITH]->(f:User) | f.username] AS friends,
+    [(u)-[r:RATED]->(rel:Release) | [rel.id, r.rating]] AS ratings,
+    [(u)-[:FOLLOWS]->(a:Artist) | a.id] AS follows
+ORDER BY username
+"""
+
+def _mongodb_user(user: dict) -> dict:
+    return {
+        "friends": set(user.get("friends", [])),
+        "ratings": {rating["id"]: rating for rating in user.get("ratings", [])},
+        "follows": {follow["id"]: follow for follow in user.get("follows", [])},
+    }
+
+def _neo4j_users(after: str | None, until: str | None, usernames: list | None = None) -> dict:
+    # Only the bounds that apply, so the range stays an index seek
+    conditions = ["u.username IS NOT NULL"]
+    if after is not None:
+        conditions.append("u.username > $after")
+    if until is not None:
+        conditions.append("u.username <= $until")
+    if usernames is not None:
+        conditions.append("u.username IN $usernames")
+
+    records = neo4j.execute_query(
+        "reconcile.users",
+        NEO4J_USERS_QUERY.format(conditions = " AND ".join(conditions)),
+        after = after,
+        until = until,
+        usernames = usernames,
+    ).records
+    return {
+        record["username"]: {
+            "friends": set(record["friends"]),
+            "ratings": dict(record["ratings"]),
+            "follows": set(record["follows"]),
+        }
+        for record in records
+    }
+
+def _diff(username: str, mongodb_user: dict | None, neo4j_user: dict | None) -> list:
+    # The discrepancies of one user, each with what a repair does.
+    if mongodb_user is None:
+        return [{"kind": "user_missing_in_mongodb", "username": username}]
+
+    found = []
+    if neo4j_user is None:
+        # Created by the repair, then given all of its edges
+        found.append({"kind": "user_missing_in_neo4j", "username": username})
+        neo4j_user = {"friends": set(), "ratings": {}, "follows": set()}
+
+    for friend in mongodb_user["friends"] - neo4j_user["friends"]:
+        found.append({"kind": "friend_missing_in_neo4j", "username": username, "id": friend})
+    for friend in neo4j_user["friends"] - mongodb_user["friends"]:
+        found.append({"kind": "friend_missing_in_mongodb", "username": username, "id": friend})
+
+    for release_id, rating in mongodb_user["ratings"].items():
+        if release_id not in neo4j_user["ratings"]:
+            found.append({
+                "kind": "rating_missing_in_neo4j",
+                "username": username,
+                "id": release_id,
+            })
+        elif float(neo4j_user["ratings"][release_id] or 0) != float(rating["rating"]):
+            found.append({"kind": "rating_differs", "username": username, "id": release_id})
+    for release_id in neo4j_user["ratings"].keys() - mongodb_user["ratings"].keys():
+        found.append({"kind": "rating_missing_in_mongodb", "username": username, "id": release_id})
+
+    for artist_id in mongodb_user["follows"].keys() - neo4j_user["follows"]:
+        found.append({"kind": "follow_missing_in_neo4j", "username": username, "id": artist_id})
+    for artist_id in neo4j_user["follows"] - mongodb_user["follows"].keys():
+        found.append({"kind": "follow_missing_in_mongodb", "username": username, "id": artist_id})
+    return found
+
+def _diff_range(mongodb_users: dict, after: str | None, until: str | None) -> list:
+    neo4j_users = _neo4j_users(after, until)
+    found = []
+    for username in sorted(mongodb_users.keys() | neo4j_users.keys()):
+        found.extend(_diff(username, mongodb_users.get(username), neo4j_users.get(username)))
+    return found
+
+def _recheck(found: list) -> tuple[list, dict]:
+    # Reads the users again, keeping only what still differs.
+    usernames = sorted({item["username"] for item in found})
+    mongodb_users = {
+        user["username"]: _mongodb_user(user)
+        for user in mongodb.get_db().users.find(
+            {
+                "username": {
+                    "$in": usernames,
+                },
+            },
+            {
+                "username": True,
+                "friends": True,
+                "ratings": True,
+                "follows": True,
+            },
+        )
+    }
+    neo4j_users = _neo4j_users(None, None, usernames)
+
+    still = set()
+    for username in usernames:
+        for item in _diff(username, mongodb_users.get(username), neo4j_users.get(username)):
+            still.add((item["kind"], item["username"], item.get("id")))
+    return [
+        item
+        for item in found
+        if (item["kind"], item["username"], item.get("id")) in still
+    ], mongodb_users
+
+def _rows(found: list, kind: str) -> list:
+    return [item for item in found if item["kind"] == kind]
+
+def _repair_users(found: list):
+    # Makes Neo4j match MongoDB, with one query per kind of discrepancy.
+    found, mongodb_users = _recheck(found)
+
+    queries = {
+        "user_missing_in_neo4j": """
+            UNWIND $rows AS row
+            MERGE (:User {username: row.username})
+        """,
+        "user_missing_in_mongodb": """
+            UNWIND $rows AS row
+            MATCH (u:User {username: row.username})
+            DETACH DELETE u
+        """,
+        "friend_missing_in_mongodb": """
+            UNWIND $rows AS row
+            MATCH (:User {username: row.username})-[f:FRIENDS_WITH]->(:User {username: row.id})
+            DELETE f
+        """,
+        "rating_missing_in_mongodb": """
+            UNWIND $rows AS row
+            MATCH (:User {username: row.username})-[r:RATED]->(:Release {id: row.id})
+            DELETE r
+        """,
+        "follow_missing_in_mongodb": """
+            UNWIND $rows AS row
+            MATCH (:User {username: row.username})-[f:FOLLOWS]->(:Artist {id: row.id})
+            DELETE f
+        """,
+    }
+    for kind, query in queries.items():
+        rows = _rows(found, kind)
+        if rows:
+            neo4j.execute_query(f"reconcile.{kind}", query, rows = rows)
+
+    friends = [
+        {
+            "username": item["username"],
+            "id": item["id"],
+        }
+        for item in _rows(found, "friend_missing_in_neo4j")
+    ]
+    if friends:
+        neo4j.execute_query(
+            "reconcile.friend_missing_in_neo4j",
+            """
+            UNWIND $rows AS row
+            MATCH (u1:User {username: row.username})
+            MATCH (u2:User {username: row.id})
+            MERGE (u1)-[:FRIENDS_WITH]->(u2)
+            """,
+            rows = friends,
+        )
+
+    ratings = [
+        {
+            "username": item["username"],
+            "id": item["id"],
+            "rating": mongodb_users[item["username"]]["ratings"][item["id"]]["rating"],
+            "created_at": mongodb_users[item["username"]]["ratings"][item["id"]].get("created_at"),
+        }
+        for item in _rows(found, "rating_missing_in_neo4j") + _rows(found, "rating_differs")
+    ]
+    if ratings:
+        neo4j.execute_query(
+            "reconcile.rating_missing_in_neo4j",
+            """
+            UNWIND $rows AS row
+            MATCH (u:User {username: row.username})
+            MATCH (r:Release {id: row.id})
+            MERGE (u)-[rel:RATED]->(r)
+            SET rel.rating = row.rating
+            SET rel.created_at = coalesce(rel.created_at, row.created_at)
+            """,
+            rows = ratings,
+        )
+
+    follows = [
+        {
+            "username": item["username"],
+            "id": item["id"],
+            "created_at": mongodb_users[item["username"]]["follows"][item["id"]].get("created_at"),
+        }
+        for item in _rows(found, "follow_missing_in_neo4j")
+    ]
+    if follows:
+        neo4j.execute_query(
+            "reconcile.follow_missing_in_neo4j",
+            """
+            UNWIND $rows AS row
+            MATCH (u:User {username: row.username})
+            MATCH (a:Artist {id: row.id})
+            MERGE (u)-[f:FOLLOWS]->(a)
+            ON CREATE SET f.created_at = row.created_at
+            """,
+            rows = follows,
+        )
+    return found
+
+def _chunks(cursor, key: str, chunk_size: int):
+    # Groups a sorted cursor into chunks, with the key range each one covers.
+    after = None
+    chunk = []
+    for document in cursor:
+        chunk.append(document)
+        if len(chunk) == chunk_size:
+            yield chunk, after, chunk[-1][key]
+            after = chunk[-1][key]
+            chunk = []
+    # The last range is open, for what only Neo4j has past the last document
+    yield chunk, after, None
+
+def _run(chunks, check, on_found, workers: int):
+    # Checks the chunks in parallel, reporting the results in order.
+    pending = deque()
+    with ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "reconcile") as executor:
+        for chunk in chunks:
+            pending.append(executor.submit(check, *chunk))
+            # Bounds the chunks held in memory
+            if len(pending) >= workers * 2:
+                on_found(pending.popleft().result())
+        while pending:
+            on_found(pending.popleft().result())
+
+def check_users(on_found, repair: bool = False, chunk_size: int = CHUNK_SIZE, workers: int = 4):
+    """
+    Compare the friends, ratings and follows of every user in MongoDB with
+    their edges in Neo4j, calling `on_found` with each chunk's discrepancies.
+    With `repair`, Neo4j is made to match MongoDB, and `on_found` gets what
+    was repaired.
+    """
+    cursor = mongodb.get_db().users.find(
+        {},
+        {
+            "_id": False,
+            "username": True,
+            "friends": True,
+            "ratings.id": True,
+            "ratings.rating": True,
+            "follows.id": True,
+        },
+        batch_size = chunk_size,
+    ).sort("username", 1)
+
+    def check(chunk, after, until):
+        found = _diff_range(
+            {user["username"]: _mongodb_user(user) for user in chunk},
+            after,
+            until,
+        )
+        if repair and found:
+            found = _repair_users(found)
+        return found
+
+    _run(_chunks(cursor, "username", chunk_size), check, on_found, workers)
+
+def check_followers(on_found, repair: bool = False, chunk_size: int = CHUNK_SIZE, workers: int = 4):
+    """
+    Compare the `qt_followers` of every artist with the number of users
+    following it in MongoDB (plus the pending follower counts, read from the
+    workers' journals without Redis), calling `on_found` with each chunk's
+    discrepancies. With `repair`, the stored count is corrected.
+    """
+    cursor = mongodb.get_db().artists.find(
+        {},
+        {
+            "qt_followers": True,
+        },
+        batch_size = chunk_size,
+    ).sort("_id", 1)
+
+    def count(artist_ids: list) -> dict:
+        # Through the follows_id index, only for the artists of the chunk
+        return {
+            row["_id"]: row["count"]
+            for row in mongodb.get_db().users.aggregate([
+                {
+                    "$match": {
+                        "follows.id": {
+                            "$in": artist_ids,
+                        },
+                    },
+                },
+                {
+                    "$unwind": "$follows",
+                },
+                {
+                    "$match": {
+                        "follows.id": {
+                            "$in": artist_ids,
+                        },
+                    },
+                },
+                {
+                    "$group": {
+                        "_id": "$follows.id",
+                        "count": {
+                            "$sum": 1,
+                        },
+                    },
+                },
+            ])
+        }
+
+    def check(chunk, after, until):
+        artist_ids = [artist["_id"] for artist in chunk]
+        if not artist_ids:
+            return []
+        followers = count(artist_ids)
+        pending = counters.pending_followers(artist_ids, journals = True)
+
+        found = []
+        for artist in chunk:
+            stored = artist.get("qt_followers", 0) + pending.get(artist["_id"], 0)
+            actual = followers.get(artist["_id"], 0)
+            if stored != actual:
+                found.append({
+                    "kind": "qt_followers_differs",
+                    "id": artist["_id"],
+                    "stored": stored,
+                    "actual": actual,
+                })
+
+        if repair and found:
+            # Counted again right before the fix, for follows made meanwhile
+            artist_ids = [item["id"] for item in found]
+            followers = count(artist_ids)
+            pending = counters.pending_followers(artist_ids, journals = True)
+            for item in found:
+                item["actual"] = followers.get(item["id"], 0)
+            mongodb.get_db().artists.bulk_write(
+                [
+                    UpdateOne(
+                        {
+                            "_id": item["id"],
+                        },
+                        {
+                            "$currentDate": {
+                                "updated_at": True,
+                            },
+                            "$set": {
+                                "qt_followers": item["actual"] - pending.get(item["id"], 0),
+                            },
+                        },
+                    )
+                    for item in found
+                ],
+                ordered = False,
+            )
+        return found
+
+    _run(_chunks(cursor, "_id", chunk_size), check, on_found, workers)
@@ -0,0 +1,241 @@
+"""
+Module for the similar artists of each artist.
+
+Two artists are similar when they share genres and followers: the score is a
+blend of the Jaccard index of their genres (`SIMILAR_GENRE_WEIGHT`) and the
+cosine of their follower sets, that is, the followers in common over the
+geometric mean of their numbers of followers. The `SIMILAR_ARTISTS` best of
+each artist are stored on its document, so reading them costs one lookup.
+
+Both terms come from sparse matrix products, computed a block of artists at a
+time: memory grows with the block size times the artists sharing a genre or
+a follower with it, never with the square of the catalog.
+
+Follows and unfollows queue the artists whose followers changed, along with
+the other artists their user follows, whose co-followers changed too. An
+incremental run only recomputes the queued artists; a full run recomputes
+all of them.
+"""
+import os
+import numpy as np
+from scipy import sparse
+from pymongo import DeleteOne, UpdateOne
+from configs import mongodb
+
+K = int(os.getenv("SIMILAR_ARTISTS", "20"))
+GENRE_WEIGHT = float(os.getenv("SIMILAR_GENRE_WEIGHT", "0.3"))
+BLOCK_SIZE = 256
+BATCH_SIZE = 1_000
+
+def mark(artist_ids):
+    """
+    Queue artists for the next incremental run.
+    """
+    artist_ids = set(artist_ids)
+    if not artist_ids:
+        return
+    mongodb.db.similar_queue.bulk_write(
+        [
+            UpdateOne(
+                {
+                    "_id": artist_id,
+                },
+                {
+                    "$currentDate": {
+                        "queued_at": True,
+                    },
+                },
+                upsert = True,
+            )
+            for artist_id in sorted(artist_ids)
+        ],
+        ordered = False,
+    )
+
+def _matrix(rows: list, columns: list, shape: tuple) -> sparse.csr_matrix:
+    # A 0/1 matrix with a one at every (row, column), repeated or not.
+    matrix = sparse.csr_matrix(
+        (
+            np.ones(len(rows), dtype = np.float32),
+            (np.array(rows, dtype = np.int64), np.array(columns, dtype = np.int64)),
+        ),
+        shape = shape,
+    )
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+def _load() -> tuple:
+    # The artists with their current neighbours, and the artist x genre and
+    # user x artist matrices.
+    ids = []
+    names = []
+    current = []
+    genre_rows = []
+    genre_columns = []
+    genre_numbers = {}
+    artists = mongodb.get_db().artists.find(
+        {},
+        {
+            "name": True,
+            "genres": True,
+            "similar": True,
+        },
+    )
+    for artist in artists:
+        for genre in artist.get("genres") or []:
+            genre_rows.append(len(ids))
+            genre_columns.append(genre_numbers.setdefault(genre, len(genre_numbers)))
+        ids.append(artist["_id"])
+        names.append(artist.get("name"))
+        current.append(artist.get("similar"))
+    numbers = {artist_id: number for number, artist_id in enumerate(ids)}
+
+    follow_rows = []
+    follow_columns = []
+    users = 0
+    users_cursor = mongodb.get_db().users.find(
+        {},
+        {
+            "_id": False,
+            "follows.id": True,
+        },
+    )
+    for user in users_cursor:
+        for follow in user.get("follows") or []:
+            number = numbers.get(follow["id"])
+            if number is not None:
+                follow_rows.append(users)
+                follow_columns.append(number)
+        users += 1
+
+    genres = _matrix(genre_rows, genre_columns, (len(ids), len(genre_numbers)))
+    follows = _matrix(follow_rows, follow_columns, (users, len(ids)))
+    return ids, names, current, numbers, genres, follows
+
+def _scores(rows: np.ndarray, matrices: dict) -> sparse.csr_matrix:
+    # The similarity of the artists `rows` to every artist, one row each.
+    genre_counts = matrices["genre_counts"]
+    follower_counts = matrices["follower_counts"]
+
+    shared = (matrices["genres"][rows] @ matrices["genres_t"]).tocoo()
+    union = genre_counts[rows[shared.row]] + genre_counts[shared.col] - shared.data
+    jaccard = shared.data / union
+
+    common = (matrices["follows_t"][rows] @ matrices["follows"]).tocoo()
+    cosine = common.data / np.sqrt(follower_counts[rows[common.row]] * follower_counts[common.col])
+
+    data = np.concatenate([GENRE_WEIGHT * jaccard, (1 - GENRE_WEIGHT) * cosine])
+    block_rows = np.concatenate([shared.row, common.row])
+    columns = np.concatenate([shared.col, common.col])
+    # An artist is not similar to itself
+    others = columns != rows[block_rows]
+
+    scores = sparse.csr_matrix(
+        (data[others], (block_rows[others], columns[others])),
+        shape = (len(rows), matrices["genres"].shape[0]),
+    )
+    scores.sum_duplicates()
+    return scores
+
+def _top(scores: sparse.csr_matrix, row: int) -> tuple[np.ndarray, np.ndarray]:
+    # The K best columns of a row, best first, ties broken by column.
+    start, end = scores.indptr[row], scores.indptr[row + 1]
+    columns = scores.indices[start:end]
+    data = scores.data[start:end]
+    if len(data) > K:
+        best = np.argpartition(-data, K - 1)[:K]
+        columns, data = columns[best], data[best]
+    order = np.lexsort((columns, -data))
+    return columns[order], data[order]
+
+def rebuild(incremental: bool = False) -> dict:
+    """
+    Recompute the similar artists of every artist, or only of the queued ones,
+    and get the number of artists computed and of artists whose list changed.
+    """
+    queue = {
+        entry["_id"]: entry["queued_at"]
+        for entry in mongodb.get_db().similar_queue.find()
+    }
+    if incremental and not queue:
+        return {
+            "computed": 0,
+            "updated": 0,
+        }
+
+    ids, names, current, numbers, genres, follows = _load()
+    if incremental:
+        rows = np.array(
+            sorted(numbers[artist_id] for artist_id in queue if artist_id in numbers),
+            dtype = np.int64,
+        )
+    else:
+        rows = np.arange(len(ids), dtype = np.int64)
+    follows_t = follows.T.tocsr()
+    matrices = {
+        "genres": genres,
+        "genres_t": genres.T.tocsr(),
+        "follows": follows,
+        "follows_t": follows_t,
+        "genre_counts": np.asarray(genres.sum(axis = 1)).ravel(),
+        "follower_counts": np.asarray(follows_t.sum(axis = 1)).ravel(),
+    }
+
+    updated = 0
+    operations = []
+    for block_start in range(0, len(rows), BLOCK_SIZE):
+        block = rows[block_start:block_start + BLOCK_SIZE]
+        scores = _scores(block, matrices)
+        for position, number in enumerate(block):
+            columns, data = _top(scores, position)
+            neighbours = [
+                {
+                    "id": ids[column],
+                    "name": names[column],
+                    "score": round(float(score), 4),
+                }
+                for column, score in zip(columns, data)
+            ]
+            if neighbours == current[number]:
+                continue
+            operations.append(UpdateOne(
+                {
+                    "_id": ids[number],
+                },
+                {
+                    "$currentDate": {
+                        "updated_at": True,
+                    },
+                    "$set": {
+                        "similar": neighbours,
+                    },
+                },
+            ))
+            if len(operations) == BATCH_SIZE:
+                result = mongodb.get_db().artists.bulk_write(operations, ordered = False)
+                updated += result.modified_count
+                operations = []
+    if operations:
+        result = mongodb.get_db().artists.bulk_write(operations, ordered = False)
+        updated += result.modified_count
+
+    # Artists queued again while this ran stay queued
+    if queue:
+        mongodb.get_db().similar_queue.bulk_write(
+            [
+                DeleteOne(
+                    {
+                        "_id": artist_id,
+                        "queued_at": queued_at,
+                    },
+                )
+                for artist_id, queued_at in queue.items()
+            ],
+            ordered = False,
+        )
+
+    return {
+        "computed": len(rows),
+        "updated": updated,
+    }
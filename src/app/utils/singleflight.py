@@ -0,0 +1,152 @@
+"""
+Module for coalescing identical concurrent reads (singleflight).
+
+While a read is in flight, identical reads wait for it and get its result
+instead of running the same query again. Within a process this covers every
+thread; with `REDIS_URL` set, a lock in Redis also lets the workers share one
+call, passing the result through Redis. Nothing is kept after the call ends,
+so this is not a cache: a read that starts later always runs its own query.
+
+Callers share the same result object, so they must not modify it. A result
+only goes through Redis when it comes back from JSON with the same values and
+types; otherwise the waiting workers run their own call.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from bson import json_util
+from bson.json_util import JSONMode, JSONOptions
+from redis.exceptions import RedisError
+from configs import redis, routing
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+CROSS_PROCESS = redis.ENABLED and os.getenv("SINGLEFLIGHT_REDIS", "true").lower() == "true"
+# Longest time a call holds the Redis lock, and others wait for it
+LOCK_TTL_MS = int(os.getenv("SINGLEFLIGHT_LOCK_TTL_MS", "5000"))
+POLL_SECONDS = float(os.getenv("SINGLEFLIGHT_POLL_MS", "5")) / 1000
+
+# Plain JSON numbers and naive UTC datetimes, as the MongoDB client returns them
+JSON_OPTIONS = JSONOptions(json_mode = JSONMode.RELAXED, tz_aware = False)
+
+# Deletes the lock only if it still belongs to the call releasing it
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+_lock = threading.Lock()
+_calls: dict[str, _Call] = {}
+
+def _same(value, other) -> bool:
+    # Whether two values are equal and of the same types all the way down.
+    if type(value) is not type(other):
+        return False
+    if isinstance(value, dict):
+        return value.keys() == other.keys() and all(
+            _same(value[key], other[key]) for key in value
+        )
+    if isinstance(value, (list, tuple)):
+        return len(value) == len(other) and all(
+            _same(item, other_item) for item, other_item in zip(value, other)
+        )
+    return value == other
+
+def _serialize(result, name: str) -> str | None:
+    # The result as JSON, or None when it cannot be shared as is.
+    try:
+        serialized = json_util.dumps(result, json_options = JSON_OPTIONS)
+        if _same(json_util.loads(serialized, json_options = JSON_OPTIONS), result):
+            return serialized
+        logger.warning("Result of %s changes through JSON, not sharing it", name)
+    except (TypeError, ValueError, OverflowError) as e:
+        logger.warning("Result of %s cannot be serialized, not sharing it: %s", name, e)
+    return None
+
+def _run_shared(key: str, function, name: str):
+    # Runs the function under a Redis lock, or waits for the process holding
+    # it to publish its result.
+    client = redis.get_client()
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    lock_key = f"singleflight:lock:{digest}"
+    flight = uuid.uuid4().hex
+
+    if client.set(lock_key, flight, nx = True, px = LOCK_TTL_MS):
+        metrics.SINGLEFLIGHT_CALLS.labels(name, "led").inc()
+        try:
+            result = function()
+            serialized = _serialize(result, name)
+            if serialized is not None:
+                client.set(f"singleflight:result:{flight}", serialized, px = LOCK_TTL_MS)
+            return result
+        finally:
+            client.eval(RELEASE_SCRIPT, 1, lock_key, flight)
+
+    leader = client.get(lock_key)
+    deadline = time.monotonic() + LOCK_TTL_MS / 1000
+    while leader is not None and time.monotonic() < deadline:
+        shared = client.get(f"singleflight:result:{leader}")
+        if shared is not None:
+            metrics.SINGLEFLIGHT_CALLS.labels(name, "shared").inc()
+            return json_util.loads(shared, json_options = JSON_OPTIONS)
+        if client.get(lock_key) != leader:
+            # The other call failed, or a new one started after it ended
+            break
+        time.sleep(POLL_SECONDS)
+
+    metrics.SINGLEFLIGHT_CALLS.labels(name, "led").inc()
+    return function()
+
+def _run(key: str, function, name: str):
+    if CROSS_PROCESS:
+        try:
+            return _run_shared(key, function, name)
+        except RedisError as e:
+            logger.warning("Singleflight lock unavailable, running %s alone: %s", name, e)
+    metrics.SINGLEFLIGHT_CALLS.labels(name, "led").inc()
+    return function()
+
+def do(name: str, key: str, function):
+    """
+    Call `function`, or wait for an identical call already in flight and
+    return its result. `name` labels the metrics, and `key` identifies the
+    call's arguments.
+    """
+    # Reads with another routing, such as a read-your-writes token, may see
+    # other data, so they never share a call.
+    key = f"{name}:{key}:{routing.current.get()}"
+    with _lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+
+    if not leader:
+        metrics.SINGLEFLIGHT_CALLS.labels(name, "coalesced").inc()
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = _run(key, function, name)
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            del _calls[key]
+        call.done.set()
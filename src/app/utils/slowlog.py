@@ -0,0 +1,227 @@
+"""
+Module for the slow query log.
+
+Any MongoDB `find`/`aggregate` or Cypher query slower than `SLOW_QUERY_MS` is
+logged with its parameters. With `SLOW_QUERY_FILE` set, the first time a query
+shape is slow, its plan is captured in the background (`explain` for MongoDB,
+`PROFILE` for read-only Cypher and `EXPLAIN` for the rest) and appended to it.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import monitoring
+from configs import mongodb, neo4j
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_QUERY_FILE = os.getenv("SLOW_QUERY_FILE")
+
+MONGODB_COMMANDS = ("find", "aggregate")
+# Session and API fields the driver adds, which `explain` must not receive
+MONGODB_DRIVER_FIELDS = (
+    "lsid", "$db", "$clusterTime", "$readPreference", "txnNumber",
+    "apiVersion", "apiStrict", "apiDeprecationErrors",
+)
+MONGODB_SCAN_STAGES = ("COLLSCAN",)
+NEO4J_SCAN_OPERATORS = (
+    "AllNodesScan", "NodeByLabelScan",
+    "DirectedAllRelationshipsScan", "UndirectedAllRelationshipsScan",
+)
+
+_executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "slowlog")
+_lock = threading.Lock()
+_file_lock = threading.Lock()
+_shapes = {}
+
+def shape(value):
+    """
+    Replace the literal values of a MongoDB command with placeholders, keeping
+    operators and field paths, so equivalent queries share the same shape.
+    """
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [shape(item) for item in value]
+    if isinstance(value, str) and value.startswith("$"):
+        return value
+    return "?"
+
+def _record(key: tuple, entry: dict) -> bool:
+    # Returns whether the shape is new, meaning its plan must be captured.
+    with _lock:
+        known = _shapes.get(key)
+        if known is None:
+            _shapes[key] = {
+                "count": 1,
+                "max_ms": entry["duration_ms"],
+            }
+            return True
+
+        known["count"] += 1
+        known["max_ms"] = max(known["max_ms"], entry["duration_ms"])
+        return False
+
+def _write(entry: dict):
+    with _file_lock:
+        with open(SLOW_QUERY_FILE, "a", encoding = "utf-8") as slow_file:
+            slow_file.write(json.dumps(entry, default = str) + "\n")
+
+def _find_stages(plan, names: tuple, key: str) -> list:
+    # Walks the plan tree, collecting the stages that scan whole collections.
+    found = []
+    if isinstance(plan, dict):
+        # Neo4j suffixes its operators with the runtime, as in "AllNodesScan@neo4j"
+        if str(plan.get(key)).split("@", maxsplit = 1)[0] in names:
+            found.append(plan[key])
+        for item in plan.values():
+            found.extend(_find_stages(item, names, key))
+    elif isinstance(plan, (list, tuple)):
+        for item in plan:
+            found.extend(_find_stages(item, names, key))
+    return found
+
+def _explain_mongodb(entry: dict, database: str, command: dict):
+    try:
+        plan = mongodb.get_unversioned_client()[database].command(
+            {
+                "explain": command,
+                "verbosity": "executionStats",
+            },
+        )
+        plan.pop("$clusterTime", None)
+        plan.pop("operationTime", None)
+        entry["plan"] = plan
+        entry["scans"] = _find_stages(plan, MONGODB_SCAN_STAGES, "stage")
+    except Exception as e: # pylint: disable=broad-exception-caught
+        entry["plan_error"] = str(e)
+    _write(entry)
+
+def _plan_to_dict(plan) -> dict | None:
+    if plan is None:
+        return None
+    return {
+        "operator": plan.get("operatorType"),
+        "arguments": plan.get("args", {}),
+        "db_hits": plan.get("dbHits"),
+        "rows": plan.get("rows"),
+        "children": [_plan_to_dict(child) for child in plan.get("children", [])],
+    }
+
+def _explain_neo4j(entry: dict, query: str, parameters: dict, query_type: str):
+    # PROFILE runs the query again, so it is only used on read-only queries.
+    mode = "PROFILE" if query_type == "r" else "EXPLAIN"
+    try:
+        summary = neo4j.get_driver().execute_query(
+            f"{mode} {query}",
+            parameters,
+        ).summary
+        plan = _plan_to_dict(summary.profile if mode == "PROFILE" else summary.plan)
+        entry["plan_mode"] = mode
+        entry["plan"] = plan
+        entry["scans"] = _find_stages(plan, NEO4J_SCAN_OPERATORS, "operator")
+    except Exception as e: # pylint: disable=broad-exception-caught
+        entry["plan_error"] = str(e)
+    _write(entry)
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Logs the slow `find` and `aggregate` commands.
+    """
+    def __init__(self):
+        self._commands = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name in MONGODB_COMMANDS:
+            self._commands[(event.connection_id, event.request_id)] = (
+                event.database_name,
+                event.command,
+            )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        started = self._commands.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+
+        duration_ms = event.duration_micros / 1000
+        if duration_ms < SLOW_QUERY_MS:
+            return
+
+        database, command = started
+        command = {
+            key: value
+            for key, value in command.items()
+            if key not in MONGODB_DRIVER_FIELDS
+        }
+        collection = command.get(event.command_name)
+        if event.command_name == "aggregate":
+            query_shape = shape(command.get("pipeline"))
+        else:
+            query_shape = shape({
+                "filter": command.get("filter"),
+                "sort": command.get("sort"),
+            })
+        entry = {
+            "timestamp": time.time(),
+            "database": "mongodb",
+            "collection": collection,
+            "operation": event.command_name,
+            "duration_ms": round(duration_ms, 3),
+            "shape": query_shape,
+            "command": command,
+        }
+        logger.warning(
+            "Slow MongoDB %s on %s (%.1f ms): %s",
+            event.command_name,
+            collection,
+            duration_ms,
+            json.dumps(command, default = str),
+        )
+
+        key = ("mongodb", collection, event.command_name, json.dumps(query_shape, sort_keys = True))
+        if _record(key, entry) and SLOW_QUERY_FILE:
+            _executor.submit(_explain_mongodb, entry, database, command)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._commands.pop((event.connection_id, event.request_id), None)
+
+class Neo4jQueryListener(neo4j.QueryListener):
+    """
+    Logs the slow Cypher queries.
+    """
+    def succeeded(self, name, query, parameters, summary, duration):
+        duration_ms = duration * 1000
+        if duration_ms < SLOW_QUERY_MS:
+            return
+
+        normalized = re.sub(r"\s+", " ", query).strip()
+        entry = {
+            "timestamp": time.time(),
+            "database": "neo4j",
+            "query_name": name,
+            "duration_ms": round(duration_ms, 3),
+            "available_after_ms": summary.result_available_after,
+            "consumed_after_ms": summary.result_consumed_after,
+            "query": normalized,
+            "parameters": parameters,
+        }
+        logger.warning(
+            "Slow Cypher query %s (%.1f ms) with %s",
+            name,
+            duration_ms,
+            json.dumps(parameters, default = str),
+        )
+
+        if _record(("neo4j", name, normalized), entry) and SLOW_QUERY_FILE:
+            _executor.submit(_explain_neo4j, entry, query, parameters, summary.query_type)
+
+def install():
+    """
+    Start logging the slow queries of both databases.
+    """
+    monitoring.register(MongoCommandListener())
+    neo4j.register(Neo4jQueryListener())
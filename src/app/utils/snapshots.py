@@ -0,0 +1,114 @@
+"""
+Module for the versioned snapshots of NumPy arrays that the workers map.
+
+Each build is a new directory of `.npy` files, plus a `meta.json`, under the
+snapshot path, and a `current` link points to the latest one. The link is
+replaced atomically, so a worker maps either the old build or the new one.
+Older builds are removed, except the one before the current, which workers
+may still be mapping.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CURRENT = "current"
+META_FILE = "meta.json"
+# Builds kept besides the current one, for workers still mapping them
+KEEP_BUILDS = 1
+
+def _prune(path: str):
+    # Removes the oldest builds. Workers still mapping one keep its pages.
+    current = os.path.realpath(os.path.join(path, CURRENT))
+    builds = sorted(
+        entry.path
+        for entry in os.scandir(path)
+        if entry.is_dir(follow_symlinks = False) and entry.path != current
+    )
+    for build_path in builds[:max(len(builds) - KEEP_BUILDS, 0)]:
+        shutil.rmtree(build_path, ignore_errors = True)
+
+def write(path: str, arrays: dict, meta: dict | None = None) -> str:
+    """
+    Write the arrays as a new build under `path`, make it the current one,
+    and get its directory.
+    """
+    os.makedirs(path, exist_ok = True)
+    build_path = os.path.join(path, datetime.now().strftime("%Y%m%dT%H%M%S%f"))
+    os.makedirs(build_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(build_path, f"{name}.npy"), array)
+    with open(os.path.join(build_path, META_FILE), "w", encoding = "utf-8") as meta_file:
+        json.dump(meta or {}, meta_file, indent = 2)
+
+    link = os.path.join(path, f"{CURRENT}.tmp")
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(build_path), link)
+    os.replace(link, os.path.join(path, CURRENT))
+    _prune(path)
+    return build_path
+
+def current(path: str) -> str | None:
+    """
+    Get the directory of the current build under `path`, if there is one.
+    """
+    build_path = os.path.realpath(os.path.join(path, CURRENT))
+    return build_path if os.path.isdir(build_path) else None
+
+def load(build_path: str, names: tuple) -> tuple[dict, dict]:
+    """
+    Map the arrays of a build read-only, and read its metadata.
+    """
+    arrays = {
+        name: np.load(os.path.join(build_path, f"{name}.npy"), mmap_mode = "r")
+        for name in names
+    }
+    with open(os.path.join(build_path, META_FILE), encoding = "utf-8") as meta_file:
+        return arrays, json.load(meta_file)
+
+class Mapped:
+    """
+    The current build of a snapshot, opened by `open_build` in each process
+    and opened again when the `current` link changes, checked at most every
+    `check_seconds`.
+    """
+    def __init__(self, path: str | None, check_seconds: float, open_build):
+        self.path = path
+        self.check_seconds = check_seconds
+        self.open_build = open_build
+        self._lock = threading.Lock()
+        self._build = None
+        self._build_path = None
+        self._checked_at = 0.0
+
+    def get(self):
+        """
+        Get the opened build, or None without a path or a readable build.
+        """
+        if not self.path:
+            return None
+        now = time.monotonic()
+        if now - self._checked_at < self.check_seconds:
+            return self._build
+
+        with self._lock:
+            if now - self._checked_at < self.check_seconds:
+                return self._build
+            self._checked_at = now
+            try:
+                build_path = current(self.path)
+                if build_path is None:
+                    self._build, self._build_path = None, None
+                elif build_path != self._build_path:
+                    self._build, self._build_path = self.open_build(build_path), build_path
+            except (OSError, ValueError) as e:
+                logger.warning("Could not map the snapshot in %s: %s", self.path, e)
+                self._build, self._build_path = None, None
+            return self._build
@@ -0,0 +1,216 @@
+"""
+Module for the per-request tracing of the app.
+
+Every request collects a span for each database call and for the JSON
+serialization, and returns their totals in the `Server-Timing` header. A
+sample of the traces is appended to a JSONL file, and admins can profile a
+single request with `?profile=1`.
+"""
+import contextvars
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from flask import Flask, Response, request
+from flask.json.provider import DefaultJSONProvider
+from pymongo import monitoring
+from configs import neo4j
+
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_LINES = int(os.getenv("PROFILE_LINES", "50"))
+
+class Trace:
+    """
+    Spans collected while handling a single request.
+    """
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def add(self, kind: str, name: str, duration: float, **attributes):
+        """
+        Add a span that has just finished after `duration` seconds.
+        """
+        end = time.perf_counter()
+        self.spans.append({
+            "kind": kind,
+            "name": name,
+            "start_ms": round((end - duration - self.start) * 1000, 3),
+            "duration_ms": round(duration * 1000, 3),
+            **attributes,
+        })
+
+    def server_timing(self, total: float) -> str:
+        """
+        Summarize the spans by kind in the `Server-Timing` header format.
+        """
+        kinds = {}
+        for span in self.spans:
+            count, duration = kinds.get(span["kind"], (0, 0.0))
+            kinds[span["kind"]] = (count + 1, duration + span["duration_ms"])
+
+        total_ms = total * 1000
+        entries = [
+            f'{kind};desc="{count} call{"s" if count > 1 else ""}";dur={duration:.1f}'
+            for kind, (count, duration) in kinds.items()
+        ]
+        python_ms = max(total_ms - sum(duration for _, duration in kinds.values()), 0)
+        entries.append(f"python;dur={python_ms:.1f}")
+        entries.append(f"total;dur={total_ms:.1f}")
+
+        return ", ".join(entries)
+
+current: contextvars.ContextVar[Trace | None] = contextvars.ContextVar(
+    "trace",
+    default = None,
+)
+
+def add_span(kind: str, name: str, duration: float, **attributes):
+    """
+    Add a span to the trace of the current request, if there is one.
+    """
+    trace = current.get()
+    if trace is not None:
+        trace.add(kind, name, duration, **attributes)
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Adds a span for every MongoDB command issued while handling a request.
+    """
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if current.get() is None:
+            return
+        collection = event.command.get(
+            "collection" if event.command_name == "getMore" else event.command_name
+        )
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finish(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._finish(event, error = True)
+
+    def _finish(self, event, **attributes):
+        collection = self._collections.pop((event.connection_id, event.request_id), None)
+        if collection is None:
+            return
+        add_span(
+            "mongodb",
+            f"{collection}.{event.command_name}" if collection else event.command_name,
+            event.duration_micros / 1_000_000,
+            **attributes,
+        )
+
+class Neo4jQueryListener(neo4j.QueryListener):
+    """
+    Adds a span for every Neo4j query run while handling a request.
+    """
+    def succeeded(self, name, query, parameters, summary, duration):
+        add_span(
+            "neo4j",
+            name,
+            duration,
+            available_after_ms = summary.result_available_after,
+            consumed_after_ms = summary.result_consumed_after,
+        )
+
+    def failed(self, name, query, parameters, error, duration):
+        add_span("neo4j", name, duration, error = True)
+
+class TracedJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider that adds a span for every serialization.
+    """
+    def dumps(self, obj, **kwargs) -> str:
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            add_span("serialization", "json", time.perf_counter() - start)
+
+_file_lock = threading.Lock()
+
+def _write(record: dict):
+    line = json.dumps(record, default = str) + "\n"
+    with _file_lock:
+        with open(TRACE_FILE, "a", encoding = "utf-8") as trace_file:
+            trace_file.write(line)
+
+def _is_admin() -> bool:
+    token = request.headers.get("X-Admin-Token")
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def install(app: Flask):
+    """
+    Start tracing every request of the app.
+    """
+    monitoring.register(MongoCommandListener())
+    neo4j.register(Neo4jQueryListener())
+
+    provider = TracedJSONProvider(app)
+    provider.sort_keys = app.json.sort_keys
+    app.json = provider
+
+    @app.before_request
+    def start_trace():
+        request.environ["tracing.token"] = current.set(Trace())
+
+        if request.args.get("profile") == "1" and _is_admin():
+            profiler = cProfile.Profile()
+            request.environ["tracing.profiler"] = profiler
+            profiler.enable()
+
+    @app.after_request
+    def finish_trace(response: Response):
+        trace = current.get()
+        if trace is None:
+            return response
+        total = time.perf_counter() - trace.start
+
+        profiler = request.environ.pop("tracing.profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            report = io.StringIO()
+            pstats.Stats(profiler, stream = report).sort_stats("cumulative").print_stats(
+                PROFILE_LINES
+            )
+            response = Response(report.getvalue(), status = 200, content_type = "text/plain")
+
+        response.headers["Server-Timing"] = trace.server_timing(total)
+        response.headers["X-Trace-Id"] = trace.id
+
+        if TRACE_FILE and random.random() < TRACE_SAMPLE_RATE:
+            _write({
+                "trace_id": trace.id,
+                "timestamp": time.time(),
+                "pid": os.getpid(),
+                "method": request.method,
+                "path": request.full_path.rstrip("?"),
+                "endpoint": request.endpoint,
+                "status": response.status_code,
+                "duration_ms": round(total * 1000, 3),
+                "spans": trace.spans,
+            })
+
+        return response
+
+    @app.teardown_request
+    def reset_trace(_):
+        token = request.environ.pop("tracing.token", None)
+        if token is not None:
+            current.reset(token)
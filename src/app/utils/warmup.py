@@ -0,0 +1,142 @@
+"""
+Module for the background warm-up of the database connections.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import psutil
+from configs import mongodb, neo4j
+from routes import recs
+from utils import counters, filters, indexes
+
+logger = logging.getLogger(__name__)
+
+CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "4"))
+RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", "5"))
+
+_lock = threading.Lock()
+_state = {
+    "pid": None,
+    "started_at": None,
+    "finished_at": None,
+    "error": None,
+}
+
+def start():
+    """
+    Start the warm-up in a background thread, once per process.
+    """
+    with _lock:
+        if _state["pid"] == os.getpid():
+            return
+        _state.update(
+            pid = os.getpid(),
+            started_at = time.time(),
+            finished_at = None,
+            error = None,
+        )
+
+    threading.Thread(target = _run, name = "warmup", daemon = True).start()
+    filters.start()
+    counters.start()
+
+def is_warm() -> bool:
+    """
+    Check if the warm-up of the current process has finished.
+    """
+    return _state["pid"] == os.getpid() and _state["finished_at"] is not None
+
+def report() -> dict:
+    """
+    Get the warm-up status and startup timings of the current process.
+    """
+    process_start = psutil.Process().create_time()
+    started_at = _state["started_at"]
+    finished_at = _state["finished_at"]
+
+    return {
+        "warm": is_warm(),
+        "error": _state["error"],
+        "warmup_seconds": (
+            round(finished_at - started_at, 3) if finished_at else None
+        ),
+        "startup_seconds": (
+            round(finished_at - process_start, 3) if finished_at else None
+        ),
+        "uptime_seconds": round(time.time() - process_start, 3),
+    }
+
+def _run():
+    # Aura may be unreachable when the worker boots, so the warm-up keeps
+    # retrying instead of blocking or crashing the process.
+    while True:
+        try:
+            _open_connections()
+            _prime_query_plans()
+            break
+        except Exception as e: # pylint: disable=broad-exception-caught
+            _state["error"] = str(e)
+            logger.warning("Warm-up failed, retrying in %ss: %s", RETRY_INTERVAL, e)
+            time.sleep(RETRY_INTERVAL)
+
+    _state["finished_at"] = time.time()
+    _state["error"] = None
+    timings = report()
+    logger.info(
+        "Warm-up finished in %.3fs, worker ready %.3fs after start",
+        timings["warmup_seconds"],
+        timings["startup_seconds"],
+    )
+
+    # A missing index is only worth a warning, so it never holds back
+    # readiness
+    try:
+        indexes.warn_missing()
+    except Exception as e: # pylint: disable=broad-exception-caught
+        logger.warning("Could not check the indexes: %s", e)
+
+def _open_connections():
+    # Concurrent round trips force each pool to open that many connections.
+    with ThreadPoolExecutor(max_workers = CONNECTIONS) as executor:
+        tuple(executor.map(
+            lambda _: mongodb.client.admin.command("ping"),
+            range(CONNECTIONS),
+        ))
+        tuple(executor.map(
+            lambda _: neo4j.driver.execute_query("RETURN 1"),
+            range(CONNECTIONS),
+        ))
+
+def _prime_query_plans():
+    for query in recs.QUERIES:
+        neo4j.driver.execute_query(
+            "EXPLAIN " + query,
+            username = "",
+            genre = "",
+            release_id = "",
+        )
+
+def ping() -> dict:
+    """
+    Check if both databases are reachable right now.
+    """
+    checks = {}
+    for name, check in (
+        ("mongodb", lambda: mongodb.client.admin.command("ping")),
+        ("neo4j", lambda: neo4j.driver.verify_connectivity()),
+    ):
+        start_time = time.perf_counter()
+        try:
+            check()
+            checks[name] = {
+                "ok": True,
+                "latency_ms": round((time.perf_counter() - start_time) * 1000, 1),
+            }
+        except Exception as e: # pylint: disable=broad-exception-caught
+            checks[name] = {
+                "ok": False,
+                "error": str(e),
+            }
+    return checks
@@ -0,0 +1,585 @@
+"""
+Replays a weighted mix of every API route from many concurrent clients.
+
+Request parameters are drawn from the manifest written by `seed.py`. The report
+has the throughput and latency percentiles of each endpoint, and can be saved
+as a baseline that later runs are compared against.
+
+With `--workers`, the script starts the API itself with each number of
+workers in turn, runs the mix against it, and adds how the total throughput
+scales with the number of workers to the report.
+
+Usage:
+    python src/bench/loadtest.py --url http://127.0.0.1:8000 --clients 32 --duration 60 \\
+        --output report.json --baseline baseline.json
+    python src/bench/loadtest.py --clients 64 --duration 60 --workers 1 2 4 8
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+import requests
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+# Time for a freshly started API to answer its readiness check
+STARTUP_SECONDS = 60
+
+# Each operation is (weight, function). An operation may issue more than one
+# request, e.g. a rating followed by its removal, so the dataset stays stable.
+OPERATIONS = {}
+
+def operation(weight: int):
+    """
+    Register a function as an operation of the workload mix.
+    """
+    def register(function):
+        OPERATIONS[function.__name__] = (weight, function)
+        return function
+    return register
+
+class Client:
+    """
+    One simulated client, recording the latency of every request it makes.
+    """
+    def __init__(self, url: str, manifest: dict, rng: random.Random, results: dict):
+        self.url = url.rstrip("/")
+        self.manifest = manifest
+        self.rng = rng
+        self.results = results
+        self.session = requests.Session()
+
+    def request(self, endpoint: str, method: str, path: str, **kwargs) -> int:
+        """
+        Make a request and record it under the endpoint template.
+        """
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url + path, timeout = 30, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            status = 0
+        latency = time.perf_counter() - start
+
+        self.results[f"{method} {endpoint}"].append((latency, status))
+        return status
+
+    def artist(self) -> str:
+        """Pick a random artist ID."""
+        return self.rng.choice(self.manifest["artists"])
+
+    def release(self) -> str:
+        """Pick a random release ID."""
+        return self.rng.choice(self.manifest["releases"])
+
+    def user(self) -> str:
+        """Pick a random username."""
+        return self.rng.choice(self.manifest["users"])
+
+    def genre(self) -> str:
+        """Pick a random genre."""
+        return self.rng.choice(self.manifest["genres"])
+
+@operation(20)
+def get_artist(client: Client):
+    """Fetch an artist."""
+    client.request("/v1/artists/<artist_id>", "GET", f"/v1/artists/{client.artist()}")
+
+@operation(5)
+def get_artist_tracks(client: Client):
+    """Fetch an artist's tracks."""
+    client.request("/v1/artists/<artist_id>/tracks", "GET", f"/v1/artists/{client.artist()}/tracks")
+
+@operation(15)
+def get_release(client: Client):
+    """Fetch a release."""
+    client.request("/v1/releases/<release_id>", "GET", f"/v1/releases/{client.release()}")
+
+@operation(5)
+def get_release_ratings(client: Client):
+    """Fetch a release's ratings."""
+    client.request(
+        "/v1/releases/<release_id>/ratings",
+        "GET",
+        f"/v1/releases/{client.release()}/ratings",
+    )
+
+@operation(10)
+def get_user(client: Client):
+    """Fetch a user."""
+    client.request("/v1/users/<username>", "GET", f"/v1/users/{client.user()}")
+
+@operation(3)
+def get_user_friends(client: Client):
+    """Fetch a user's friends."""
+    client.request("/v1/users/<username>/friends", "GET", f"/v1/users/{client.user()}/friends")
+
+@operation(3)
+def get_user_ratings(client: Client):
+    """Fetch a user's ratings."""
+    client.request("/v1/users/<username>/ratings", "GET", f"/v1/users/{client.user()}/ratings")
+
+@operation(3)
+def get_user_follows(client: Client):
+    """Fetch a user's follows."""
+    client.request("/v1/users/<username>/follows", "GET", f"/v1/users/{client.user()}/follows")
+
+@operation(4)
+def get_user_feed(client: Client):
+    """Fetch a user's feed."""
+    client.request("/v1/users/<username>/feed", "GET", f"/v1/users/{client.user()}/feed")
+
+@operation(5)
+def rate_and_unrate(client: Client):
+    """Rate a release, then remove the rating."""
+    username = client.user()
+    release_id = client.release()
+    status = client.request(
+        "/v1/users/<username>/ratings",
+        "POST",
+        f"/v1/users/{username}/ratings",
+        json = {"id": release_id, "rating": client.rng.randint(0, 10)},
+    )
+    if status == 201:
+        client.request(
+            "/v1/users/<username>/ratings/<release_id>",
+            "DELETE",
+            f"/v1/users/{username}/ratings/{release_id}",
+        )
+
+@operation(5)
+def follow_and_unfollow(client: Client):
+    """Follow an artist, then unfollow it."""
+    username = client.user()
+    artist_id = client.artist()
+    status = client.request(
+        "/v1/users/<username>/follows",
+        "POST",
+        f"/v1/users/{username}/follows",
+        json = {"id": artist_id},
+    )
+    if status == 201:
+        client.request(
+            "/v1/users/<username>/follows/<artist_id>",
+            "DELETE",
+            f"/v1/users/{username}/follows/{artist_id}",
+        )
+
+@operation(3)
+def befriend_and_unfriend(client: Client):
+    """Befriend a user, then unfriend them."""
+    username = client.user()
+    friend_username = client.user()
+    if username == friend_username:
+        return
+    status = client.request(
+        "/v1/users/<username>/friends",
+        "POST",
+        f"/v1/users/{username}/friends",
+        json = {"username": friend_username},
+    )
+    if status == 201:
+        client.request(
+            "/v1/users/<username>/friends/<friend_username>",
+            "DELETE",
+            f"/v1/users/{username}/friends/{friend_username}",
+        )
+
+@operation(1)
+def register_and_delete(client: Client):
+    """Register a user, update it and delete it."""
+    username = f"bench-{client.rng.getrandbits(64):016x}"
+    status = client.request(
+        "/v1/users",
+        "POST",
+        "/v1/users",
+        json = {"username": username, "password": "bench"},
+    )
+    if status == 201:
+        client.request(
+            "/v1/users/<username>",
+            "PATCH",
+            f"/v1/users/{username}",
+            json = {"bio": "bench"},
+        )
+        client.request("/v1/users/<username>", "DELETE", f"/v1/users/{username}")
+
+@operation(4)
+def get_artist_recs(client: Client):
+    """Fetch artist recommendations."""
+    client.request("/v1/recs/<username>/artists", "GET", f"/v1/recs/{client.user()}/artists")
+
+@operation(4)
+def get_release_recs(client: Client):
+    """Fetch release recommendations."""
+    client.request(
+        "/v1/recs/<username>/releases/friends",
+        "GET",
+        f"/v1/recs/{client.user()}/releases/friends",
+    )
+
+@operation(3)
+def get_friend_recs_by_genre(client: Client):
+    """Fetch friend recommendations by genre."""
+    client.request(
+        "/v1/recs/<username>/friends?by=genre",
+        "GET",
+        f"/v1/recs/{client.user()}/friends?by=genre",
+    )
+
+@operation(3)
+def get_friend_recs_by_reviews(client: Client):
+    """Fetch friend recommendations by reviews."""
+    client.request(
+        "/v1/recs/<username>/friends?by=reviews",
+        "GET",
+        f"/v1/recs/{client.user()}/friends?by=reviews",
+    )
+
+@operation(3)
+def get_user_dashboard(client: Client):
+    """Fetch a user's dashboard."""
+    client.request("/v1/users/<username>/dashboard", "GET", f"/v1/users/{client.user()}/dashboard")
+
+@operation(2)
+def post_batch(client: Client):
+    """Fetch an artist, a release and a user in one batch."""
+    client.request(
+        "/v1/batch",
+        "POST",
+        "/v1/batch",
+        json = {
+            "requests": [
+                {"path": f"/v1/artists/{client.artist()}"},
+                {"path": f"/v1/releases/{client.release()}"},
+                {"path": f"/v1/users/{client.user()}"},
+            ],
+        },
+    )
+
+@operation(4)
+def get_similar_artists(client: Client):
+    """Fetch an artist's similar artists."""
+    client.request(
+        "/v1/artists/<artist_id>/similar",
+        "GET",
+        f"/v1/artists/{client.artist()}/similar",
+    )
+
+@operation(2)
+def get_artist_recs_by_graph(client: Client):
+    """Fetch artist recommendations from the graph."""
+    client.request(
+        "/v1/recs/<username>/artists?by=graph",
+        "GET",
+        f"/v1/recs/{client.user()}/artists?by=graph",
+    )
+
+@operation(2)
+def get_release_recs_by_graph(client: Client):
+    """Fetch release recommendations from the graph."""
+    client.request(
+        "/v1/recs/<username>/releases/friends?by=graph",
+        "GET",
+        f"/v1/recs/{client.user()}/releases/friends?by=graph",
+    )
+
+@operation(2)
+def get_releases_for_you(client: Client):
+    """Fetch release recommendations from the embeddings."""
+    client.request(
+        "/v1/recs/<username>/releases/for-you",
+        "GET",
+        f"/v1/recs/{client.user()}/releases/for-you",
+    )
+
+@operation(2)
+def get_users_like_you(client: Client):
+    """Fetch the users with the most similar tastes."""
+    client.request(
+        "/v1/recs/<username>/users/like-you",
+        "GET",
+        f"/v1/recs/{client.user()}/users/like-you",
+    )
+
+@operation(3)
+def get_artists_chart(client: Client):
+    """Fetch the most followed artists."""
+    client.request("/v1/charts/artists", "GET", "/v1/charts/artists")
+
+@operation(3)
+def get_releases_chart(client: Client):
+    """Fetch the highest rated releases."""
+    client.request("/v1/charts/releases", "GET", "/v1/charts/releases")
+
+@operation(2)
+def get_genre_artists_chart(client: Client):
+    """Fetch the most followed artists of a genre."""
+    client.request(
+        "/v1/charts/artists?genre=<genre>",
+        "GET",
+        "/v1/charts/artists",
+        params = {"genre": client.genre()},
+    )
+
+@operation(2)
+def get_genre_releases_chart(client: Client):
+    """Fetch the highest rated releases of a genre."""
+    client.request(
+        "/v1/charts/releases?genre=<genre>",
+        "GET",
+        "/v1/charts/releases",
+        params = {"genre": client.genre()},
+    )
+
+@operation(2)
+def get_genres(client: Client):
+    """List the genres."""
+    client.request("/v1/genres", "GET", "/v1/genres")
+
+@operation(4)
+def get_genre_artists(client: Client):
+    """List a genre's artists, by popularity or followers."""
+    sort = client.rng.choice(("popularity", "followers"))
+    client.request(
+        f"/v1/genres/<name>/artists?sort={sort}",
+        "GET",
+        f"/v1/genres/{client.genre()}/artists?sort={sort}",
+    )
+
+def run(url: str, manifest: dict, clients: int, duration: float, seed: int) -> dict:
+    """
+    Run the workload and get the raw latencies and statuses per endpoint.
+    """
+    names = list(OPERATIONS)
+    weights = [OPERATIONS[name][0] for name in names]
+    deadline = time.perf_counter() + duration
+    results_per_client = []
+
+    def simulate(index: int):
+        rng = random.Random(seed + index)
+        results = defaultdict(list)
+        results_per_client.append(results)
+        client = Client(url, manifest, rng, results)
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            OPERATIONS[name][1](client)
+
+    threads = [
+        threading.Thread(target = simulate, args = (index,))
+        for index in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    merged = defaultdict(list)
+    for results in results_per_client:
+        for endpoint, samples in results.items():
+            merged[endpoint].extend(samples)
+    return merged
+
+@contextlib.contextmanager
+def serve(url: str, workers: int):
+    """
+    Run the API with Gunicorn and a number of workers, bound to the address of
+    `url`, until the block ends.
+    """
+    address = urlsplit(url)
+    environment = dict(
+        os.environ,
+        WEB_CONCURRENCY = str(workers),
+        BIND = f"{address.hostname}:{address.port or 80}",
+        ACCESS_LOG = "/dev/null",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"],
+        cwd = APP_DIRECTORY,
+        env = environment,
+    )
+    try:
+        deadline = time.monotonic() + STARTUP_SECONDS
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f"the API exited with code {server.returncode}")
+            try:
+                if requests.get(url.rstrip("/") + "/readyz", timeout = 5).status_code == 200:
+                    break
+            except requests.RequestException:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"the API was not ready after {STARTUP_SECONDS} seconds")
+            time.sleep(0.5)
+        yield
+    finally:
+        server.terminate()
+        server.wait()
+
+def sweep(
+    url: str,
+    manifest: dict,
+    clients: int,
+    duration: float,
+    seed: int,
+    workers: list,
+) -> tuple[dict, list]:
+    """
+    Run the workload against the API with each number of workers, and get the
+    report of the largest one and the total throughput of each.
+    """
+    scaling = []
+    report = None
+    for count in sorted(workers):
+        with serve(url, count):
+            report = summarize(run(url, manifest, clients, duration, seed), duration)
+        scaling.append({
+            "workers": count,
+            "requests": report["requests"],
+            "throughput": report["throughput"],
+            "errors": sum(endpoint["errors"] for endpoint in report["endpoints"].values()),
+        })
+
+    # Relative to the fewest workers
+    first = scaling[0]["throughput"]
+    for entry in scaling:
+        entry["speedup"] = round(entry["throughput"] / first, 2) if first else None
+    return report, scaling
+
+def percentile(ordered: list, fraction: float) -> float:
+    """
+    Get a percentile of an already sorted list, by nearest rank.
+    """
+    index = min(int(fraction * len(ordered)), len(ordered) - 1)
+    return ordered[index]
+
+def summarize(results: dict, duration: float) -> dict:
+    """
+    Compute the throughput and latency percentiles of each endpoint.
+    """
+    endpoints = {}
+    for endpoint, samples in sorted(results.items()):
+        latencies = sorted(latency for latency, _ in samples)
+        statuses = defaultdict(int)
+        for _, status in samples:
+            statuses[str(status)] += 1
+
+        endpoints[endpoint] = {
+            "requests": len(samples),
+            "throughput": round(len(samples) / duration, 2),
+            "errors": sum(1 for _, status in samples if status == 0 or status >= 500),
+            "statuses": dict(statuses),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        }
+
+    total = sum(endpoint["requests"] for endpoint in endpoints.values())
+    return {
+        "duration_seconds": duration,
+        "requests": total,
+        "throughput": round(total / duration, 2),
+        "endpoints": endpoints,
+    }
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    List the endpoints whose p95 latency or throughput regressed beyond the
+    tolerance, relative to the baseline.
+    """
+    regressions = []
+    for endpoint, current in report["endpoints"].items():
+        previous = baseline["endpoints"].get(endpoint)
+        if previous is None:
+            continue
+
+        if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{endpoint}: p95 {previous['p95_ms']} ms -> {current['p95_ms']} ms"
+            )
+        if current["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{endpoint}: throughput {previous['throughput']}/s -> {current['throughput']}/s"
+            )
+        if current["errors"] > previous["errors"]:
+            regressions.append(
+                f"{endpoint}: errors {previous['errors']} -> {current['errors']}"
+            )
+    return regressions
+
+def main():
+    """
+    Run the load test from the command line.
+    """
+    parser = argparse.ArgumentParser(description = __doc__.split("\n\n", maxsplit = 1)[0])
+    parser.add_argument("--url", default = "http://127.0.0.1:8000")
+    parser.add_argument("--manifest", default = "bench_manifest.json")
+    parser.add_argument("--clients", type = int, default = 32)
+    parser.add_argument("--duration", type = float, default = 60)
+    parser.add_argument("--seed", type = int, default = 42)
+    parser.add_argument("--output", default = "bench_report.json")
+    parser.add_argument("--baseline", help = "report to compare against")
+    parser.add_argument("--save-baseline", help = "also write the report to this path")
+    parser.add_argument("--tolerance", type = float, default = 0.15)
+    parser.add_argument(
+        "--workers",
+        type = int,
+        nargs = "+",
+        help = "start the API with each of these numbers of workers and compare them",
+    )
+    args = parser.parse_args()
+
+    with open(args.manifest, encoding = "utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if args.workers:
+        report, scaling = sweep(
+            args.url,
+            manifest,
+            args.clients,
+            args.duration,
+            args.seed,
+            args.workers,
+        )
+        report["workers"] = scaling
+    else:
+        results = run(args.url, manifest, args.clients, args.duration, args.seed)
+        report = summarize(results, args.duration)
+    report["clients"] = args.clients
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, "w", encoding = "utf-8") as report_file:
+            json.dump(report, report_file, indent = 2)
+
+    print(f"{report['requests']} requests, {report['throughput']} req/s")
+    for endpoint, stats in report["endpoints"].items():
+        print(
+            f"{endpoint:60} {stats['throughput']:>8}/s  "
+            f"p50 {stats['p50_ms']:>8} ms  p95 {stats['p95_ms']:>8} ms  "
+            f"p99 {stats['p99_ms']:>8} ms  "
+            f"errors {stats['errors']}"
+        )
+    for entry in report.get("workers", []):
+        print(
+            f"{entry['workers']:>3} workers: {entry['throughput']:>8} req/s  "
+            f"speedup {entry['speedup']}  errors {entry['errors']}"
+        )
+
+    if args.baseline:
+        with open(args.baseline, encoding = "utf-8") as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+if __name__ == "__main__":
+    main()
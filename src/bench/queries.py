@@ -0,0 +1,344 @@
+"""
+Compares alternative strategies for the hot queries at growing data sizes.
+
+For each dataset size, the databases are seeded with `seed.py`'s generator and
+every variant of every query runs against the same random parameters. The
+report has each variant's latency plus the work the database did: documents
+and keys examined for MongoDB, db hits for Neo4j.
+
+Usage:
+    python src/bench/queries.py --base-scale 0.1 --factors 1 10 100 --output queries.json
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+import pymongo
+from neo4j import GraphDatabase
+import seed
+
+def artist_average_reduce(artist_id: str) -> list:
+    """Current `get_artist`: concatenates every ratings array with `$reduce`."""
+    return [
+        {"$match": {"_id": artist_id}},
+        {"$addFields": {"allRatings": {"$reduce": {
+            "input": "$releases",
+            "initialValue": [],
+            "in": {"$concatArrays": ["$$value", "$$this.ratings"]},
+        }}}},
+        {"$project": {"_id": False, "id": "$_id", "average_rating": {"$cond": {
+            "if": {"$gt": [{"$size": "$allRatings"}, 0]},
+            "then": {"$avg": "$allRatings.rating"},
+            "else": None,
+        }}}},
+    ]
+
+def artist_average_unwind(artist_id: str) -> list:
+    """Unwinds releases and ratings, then averages with `$group`."""
+    return [
+        {"$match": {"_id": artist_id}},
+        {"$unwind": {"path": "$releases", "preserveNullAndEmptyArrays": True}},
+        {"$unwind": {"path": "$releases.ratings", "preserveNullAndEmptyArrays": True}},
+        {"$group": {"_id": "$_id", "average_rating": {"$avg": "$releases.ratings.rating"}}},
+        {"$project": {"_id": False, "id": "$_id", "average_rating": True}},
+    ]
+
+def artist_average_counters(artist_id: str) -> list:
+    """Reads counters kept on the artist document by the writes."""
+    return [
+        {"$match": {"_id": artist_id}},
+        {"$project": {"_id": False, "id": "$_id", "average_rating": {"$cond": {
+            "if": {"$gt": ["$rating_count", 0]},
+            "then": {"$divide": ["$rating_sum", "$rating_count"]},
+            "else": None,
+        }}}},
+    ]
+
+def release_unwind(release_id: str) -> list:
+    """Current `get_release`: unwinds every release of the artist."""
+    return [
+        {"$match": {"releases.id": release_id}},
+        {"$unwind": "$releases"},
+        {"$match": {"releases.id": release_id}},
+        {"$project": {
+            "_id": False,
+            "id": "$releases.id",
+            "name": "$releases.name",
+            "rating_average": {"$avg": "$releases.ratings.rating"},
+            "tracks": "$releases.tracks",
+        }},
+    ]
+
+def release_filter(release_id: str) -> list:
+    """Picks the release with `$filter`, without multiplying documents."""
+    return [
+        {"$match": {"releases.id": release_id}},
+        {"$project": {"_id": False, "release": {"$first": {"$filter": {
+            "input": "$releases",
+            "cond": {"$eq": ["$$this.id", release_id]},
+        }}}}},
+        {"$project": {
+            "id": "$release.id",
+            "name": "$release.name",
+            "rating_average": {"$avg": "$release.ratings.rating"},
+            "tracks": "$release.tracks",
+        }},
+    ]
+
+ARTIST_RECS_NOT_EXISTS = """
+MATCH (a:Artist)-[:BELONGS_TO]->(g:Genre {name: $genre})
+WHERE NOT EXISTS {
+    MATCH (u:User {username: $username})-[:FOLLOWS]->(a)
+}
+ORDER BY a.popularity DESC
+LIMIT 10
+RETURN a.id AS id
+"""
+
+ARTIST_RECS_OPTIONAL_MATCH = """
+MATCH (u:User {username: $username})
+MATCH (a:Artist)-[:BELONGS_TO]->(g:Genre {name: $genre})
+OPTIONAL MATCH (u)-[f:FOLLOWS]->(a)
+WITH a, f
+WHERE f IS NULL
+ORDER BY a.popularity DESC
+LIMIT 10
+RETURN a.id AS id
+"""
+
+ARTIST_RECS_PATTERN = """
+MATCH (u:User {username: $username})
+MATCH (a:Artist)-[:BELONGS_TO]->(g:Genre {name: $genre})
+WHERE NOT (u)-[:FOLLOWS]->(a)
+ORDER BY a.popularity DESC
+LIMIT 10
+RETURN a.id AS id
+"""
+
+RATERS_NOT_EXISTS = """
+MATCH (u:User)-[r:RATED]->(rel:Release)
+WHERE rel.id = $release_id
+AND r.rating >= 6
+AND NOT EXISTS {
+    MATCH (:User {username: $username})-[:FRIENDS_WITH]-(u)
+}
+AND u.username <> $username
+RETURN u.username AS username, r.rating AS rating
+ORDER BY r.rating DESC
+LIMIT 10
+"""
+
+RATERS_OPTIONAL_MATCH = """
+MATCH (me:User {username: $username})
+MATCH (u:User)-[r:RATED]->(:Release {id: $release_id})
+WHERE r.rating >= 6 AND u <> me
+OPTIONAL MATCH (me)-[f:FRIENDS_WITH]-(u)
+WITH u, r, f
+WHERE f IS NULL
+RETURN u.username AS username, r.rating AS rating
+ORDER BY r.rating DESC
+LIMIT 10
+"""
+
+# Query -> variant -> (database, query builder or Cypher, parameter picker)
+VARIANTS = {
+    "artist_average": {
+        "reduce (current)": ("mongodb", artist_average_reduce, "artist"),
+        "unwind+group": ("mongodb", artist_average_unwind, "artist"),
+        "stored counters": ("mongodb", artist_average_counters, "artist"),
+    },
+    "release": {
+        "unwind (current)": ("mongodb", release_unwind, "release"),
+        "filter": ("mongodb", release_filter, "release"),
+    },
+    "artist_recs": {
+        "not exists (current)": ("neo4j", ARTIST_RECS_NOT_EXISTS, "user_genre"),
+        "optional match": ("neo4j", ARTIST_RECS_OPTIONAL_MATCH, "user_genre"),
+        "pattern predicate": ("neo4j", ARTIST_RECS_PATTERN, "user_genre"),
+    },
+    "release_raters": {
+        "not exists (current)": ("neo4j", RATERS_NOT_EXISTS, "user_release"),
+        "optional match": ("neo4j", RATERS_OPTIONAL_MATCH, "user_release"),
+    },
+}
+
+def store_rating_counters(db):
+    """
+    Compute the counters read by the "stored counters" variant.
+    """
+    db.artists.update_many({}, [
+        {"$set": {
+            "rating_count": {"$sum": {"$map": {
+                "input": "$releases",
+                "in": {"$size": "$$this.ratings"},
+            }}},
+            "rating_sum": {"$sum": {"$map": {
+                "input": "$releases",
+                "in": {"$sum": "$$this.ratings.rating"},
+            }}},
+        }},
+    ])
+
+def pick_parameters(kind: str, data: dict, rng: random.Random) -> dict:
+    """
+    Pick random parameters of a kind from the generated dataset.
+    """
+    artist = rng.choice(data["artists"])
+    match kind:
+        case "artist":
+            return {"artist_id": artist["_id"]}
+        case "release":
+            return {"release_id": rng.choice(artist["releases"])["id"]}
+        case "user_genre":
+            return {
+                "username": rng.choice(data["users"])["username"],
+                "genre": rng.choice(artist["genres"]),
+            }
+        case "user_release":
+            return {
+                "username": rng.choice(data["users"])["username"],
+                "release_id": rng.choice(artist["releases"])["id"],
+            }
+    raise ValueError(f"Unknown parameter kind: {kind}")
+
+def find_key(document, key: str):
+    """
+    Find the first value of a key anywhere inside an explain output.
+    """
+    if isinstance(document, dict):
+        if key in document:
+            return document[key]
+        document = list(document.values())
+    if isinstance(document, list):
+        for item in document:
+            found = find_key(item, key)
+            if found is not None:
+                return found
+    return None
+
+def sum_db_hits(plan: dict) -> int:
+    """
+    Sum the db hits of every operator of a profiled plan.
+    """
+    return plan.get("dbHits", 0) + sum(sum_db_hits(child) for child in plan.get("children", []))
+
+def measure_mongodb(db, builder, parameters: list) -> dict:
+    """
+    Time a pipeline over all parameters, and explain it with the first ones.
+    """
+    latencies = []
+    for params in parameters:
+        pipeline = builder(**params)
+        start = time.perf_counter()
+        tuple(db.artists.aggregate(pipeline))
+        latencies.append(time.perf_counter() - start)
+
+    explain = db.command(
+        "explain",
+        {"aggregate": "artists", "pipeline": builder(**parameters[0]), "cursor": {}},
+        verbosity = "executionStats",
+    )
+    return {
+        "latencies": latencies,
+        "docs_examined": find_key(explain, "totalDocsExamined"),
+        "keys_examined": find_key(explain, "totalKeysExamined"),
+    }
+
+def measure_neo4j(driver, query: str, parameters: list) -> dict:
+    """
+    Time a query over all parameters, and profile it with the first ones.
+    """
+    latencies = []
+    for params in parameters:
+        start = time.perf_counter()
+        driver.execute_query(query, params)
+        latencies.append(time.perf_counter() - start)
+
+    summary = driver.execute_query("PROFILE " + query, parameters[0]).summary
+    return {
+        "latencies": latencies,
+        "db_hits": sum_db_hits(summary.profile),
+    }
+
+def run(args) -> list:
+    """
+    Seed every dataset size and measure every variant against it.
+    """
+    db = pymongo.MongoClient(args.mongodb_uri)[args.mongodb_database]
+    auth = (args.neo4j_username, args.neo4j_password)
+    rows = []
+
+    with GraphDatabase.driver(args.neo4j_uri, auth = auth) as driver:
+        for factor in args.factors:
+            scale = args.base_scale * factor
+            data = seed.generate(scale, args.seed)
+            seed.seed_mongodb(args.mongodb_uri, args.mongodb_database, data)
+            seed.seed_neo4j(args.neo4j_uri, auth, data)
+            store_rating_counters(db)
+
+            for query, variants in VARIANTS.items():
+                rng = random.Random(args.seed)
+                kind = next(iter(variants.values()))[2]
+                parameters = [pick_parameters(kind, data, rng) for _ in range(args.iterations)]
+
+                for variant, (database, definition, _) in variants.items():
+                    if database == "mongodb":
+                        result = measure_mongodb(db, definition, parameters)
+                    else:
+                        result = measure_neo4j(driver, definition, parameters)
+
+                    latencies = sorted(result.pop("latencies"))
+                    rows.append({
+                        "query": query,
+                        "variant": variant,
+                        "scale": f"{factor}x",
+                        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+                        "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 3),
+                        **result,
+                    })
+    return rows
+
+def print_table(rows: list):
+    """
+    Print the comparison table, one line per query, variant and size.
+    """
+    header = (
+        f"{'query':16} {'variant':22} {'scale':>6} "
+        f"{'p50 ms':>9} {'p95 ms':>9} "
+        f"{'docs':>8} {'keys':>8} {'db hits':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(
+            f"{row['query']:16} {row['variant']:22} {row['scale']:>6} "
+            f"{row['p50_ms']:>9} {row['p95_ms']:>9} "
+            f"{str(row.get('docs_examined', '-')):>8} {str(row.get('keys_examined', '-')):>8} "
+            f"{str(row.get('db_hits', '-')):>9}"
+        )
+
+def main():
+    """
+    Run the micro-benchmarks from the command line.
+    """
+    parser = argparse.ArgumentParser(description = __doc__.split("\n\n", maxsplit = 1)[0])
+    parser.add_argument("--base-scale", type = float, default = 0.1)
+    parser.add_argument("--factors", type = int, nargs = "+", default = [1, 10, 100])
+    parser.add_argument("--iterations", type = int, default = 200)
+    parser.add_argument("--seed", type = int, default = 42)
+    parser.add_argument("--mongodb-uri", default = "mongodb://localhost:27017")
+    parser.add_argument("--mongodb-database", default = "music_catalog_bench")
+    parser.add_argument("--neo4j-uri", default = "bolt://localhost:7687")
+    parser.add_argument("--neo4j-username", default = "neo4j")
+    parser.add_argument("--neo4j-password", default = "password")
+    parser.add_argument("--output", default = "bench_queries.json")
+    args = parser.parse_args()
+
+    rows = run(args)
+    print_table(rows)
+    with open(args.output, "w", encoding = "utf-8") as output_file:
+        json.dump(rows, output_file, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Seeds local MongoDB and Neo4j instances with a synthetic music catalog.
+
+The data follows the same model as the population notebook, so every route of
+the API works against it. The generator is seeded, so the same `--scale` and
+`--seed` always produce the same dataset.
+
+Usage:
+    python src/bench/seed.py --scale 1 --manifest bench_manifest.json
+"""
+import argparse
+import json
+import random
+import string
+import time
+import pymongo
+from neo4j import GraphDatabase
+
+# Entities per unit of scale
+ARTISTS = 200
+USERS = 1_000
+GENRES = 40
+RELEASES_PER_ARTIST = (1, 8)
+TRACKS_PER_RELEASE = (4, 14)
+FRIENDS_PER_USER = (0, 20)
+FOLLOWS_PER_USER = (0, 15)
+RATINGS_PER_USER = (0, 30)
+
+BATCH_SIZE = 1_000
+
+def random_id(rng: random.Random) -> str:
+    """
+    Generate an ID in the same format as Spotify's.
+    """
+    return "".join(rng.choices(string.ascii_letters + string.digits, k = 22))
+
+def generate(scale: float, seed: int) -> dict:
+    """
+    Generate the whole dataset, already consistent between both databases.
+    """
+    rng = random.Random(seed)
+    genres = [f"genre-{i}" for i in range(GENRES)]
+
+    artists = []
+    releases = {}
+    for i in range(int(ARTISTS * scale)):
+        artist = {
+            "_id": random_id(rng),
+            "name": f"Artist {i}",
+            "genres": rng.sample(genres, rng.randint(1, 3)),
+            "bio": " ".join(rng.choices(string.ascii_lowercase, k = 200)),
+            "qt_followers": 0,
+            "releases": [],
+            "popularity": rng.randint(0, 100),
+        }
+        for j in range(rng.randint(*RELEASES_PER_ARTIST)):
+            release = {
+                "id": random_id(rng),
+                "name": f"Release {i}.{j}",
+                "release_date": (
+                    f"{rng.randint(1960, 2025)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}"
+                ),
+                "tracks": [
+                    {
+                        "track_number": k + 1,
+                        "name": f"Track {i}.{j}.{k}",
+                        "duration": rng.randint(60_000, 600_000),
+                    }
+                    for k in range(rng.randint(*TRACKS_PER_RELEASE))
+                ],
+                "ratings": [],
+            }
+            artist["releases"].append(release)
+            releases[release["id"]] = (artist, release)
+        artists.append(artist)
+
+    usernames = [f"user{i}" for i in range(int(USERS * scale))]
+    users = {
+        username: {
+            "username": username,
+            "password": "0" * 64,
+            "name": f"User {username[4:]}",
+            "friends": [],
+            "ratings": [],
+            "follows": [],
+        }
+        for username in usernames
+    }
+    release_ids = list(releases)
+
+    friendships = set()
+    for username in usernames:
+        for friend in rng.sample(usernames, min(rng.randint(*FRIENDS_PER_USER), len(usernames))):
+            if friend != username:
+                friendships.add(tuple(sorted((username, friend))))
+    friendships = sorted(friendships)
+    for username1, username2 in friendships:
+        users[username1]["friends"].append(username2)
+        users[username2]["friends"].append(username1)
+
+    follows = []
+    ratings = []
+    for username, user in users.items():
+        for artist in rng.sample(artists, min(rng.randint(*FOLLOWS_PER_USER), len(artists))):
+            artist["qt_followers"] += 1
+            user["follows"].append({"id": artist["_id"], "name": artist["name"]})
+            follows.append({"username": username, "artist_id": artist["_id"]})
+
+        rated_count = min(rng.randint(*RATINGS_PER_USER), len(release_ids))
+        for release_id in rng.sample(release_ids, rated_count):
+            artist, release = releases[release_id]
+            rating = rng.randint(0, 10)
+            release["ratings"].append({"username": username, "rating": rating})
+            user["ratings"].append({
+                "id": release_id,
+                "artist": artist["name"],
+                "name": release["name"],
+                "rating": rating,
+            })
+            ratings.append({"username": username, "release_id": release_id, "rating": rating})
+
+    return {
+        "artists": artists,
+        "users": list(users.values()),
+        "friendships": [{"username1": u1, "username2": u2} for u1, u2 in friendships],
+        "follows": follows,
+        "ratings": ratings,
+    }
+
+def batches(items: list):
+    """
+    Split a list in batches of `BATCH_SIZE`.
+    """
+    for start in range(0, len(items), BATCH_SIZE):
+        yield items[start:start + BATCH_SIZE]
+
+def seed_mongodb(uri: str, database: str, data: dict):
+    """
+    Replace the collections of the database with the generated documents.
+    """
+    db = pymongo.MongoClient(uri)[database]
+    db.artists.drop()
+    db.users.drop()
+    db.genres.drop()
+
+    db.artists.create_index("releases.id", unique = True)
+    db.users.create_index("username", unique = True)
+    db.artists.create_index([("genres", 1), ("popularity", -1), ("_id", 1)])
+    db.artists.create_index([("genres", 1), ("qt_followers", -1), ("_id", 1)])
+
+    for batch in batches(data["artists"]):
+        db.artists.insert_many(batch, ordered = False)
+    for batch in batches(data["users"]):
+        db.users.insert_many(batch, ordered = False)
+
+    db.artists.aggregate([
+        {"$unwind": "$genres"},
+        {"$group": {"_id": "$genres", "qt_artists": {"$sum": 1}}},
+        {"$out": "genres"},
+    ])
+
+def seed_neo4j(uri: str, auth: tuple, data: dict):
+    """
+    Replace the graph with the generated nodes and relationships.
+    """
+    with GraphDatabase.driver(uri, auth = auth) as driver:
+        # CALL IN TRANSACTIONS needs an auto-commit transaction
+        with driver.session() as session:
+            session.run("MATCH (n) CALL { WITH n DETACH DELETE n } IN TRANSACTIONS").consume()
+        constraints = (("Artist", "id"), ("Genre", "name"), ("Release", "id"), ("User", "username"))
+        for label, key in constraints:
+            driver.execute_query(
+                f"CREATE CONSTRAINT IF NOT EXISTS FOR (n:{label}) REQUIRE n.{key} IS UNIQUE"
+            )
+
+        for batch in batches(data["artists"]):
+            driver.execute_query(
+                """
+                UNWIND $artists AS artist
+                MERGE (a:Artist {id: artist.id})
+                SET a.popularity = artist.popularity
+                WITH a, artist
+                UNWIND artist.genres AS genre
+                MERGE (g:Genre {name: genre})
+                MERGE (a)-[:BELONGS_TO]->(g)
+                """,
+                artists = [
+                    {"id": a["_id"], "popularity": a["popularity"], "genres": a["genres"]}
+                    for a in batch
+                ],
+            )
+            driver.execute_query(
+                """
+                UNWIND $releases AS release
+                MATCH (a:Artist {id: release.artist_id})
+                MERGE (r:Release {id: release.id})
+                MERGE (a)-[:RELEASED]->(r)
+                """,
+                releases = [
+                    {"artist_id": a["_id"], "id": r["id"]}
+                    for a in batch
+                    for r in a["releases"]
+                ],
+            )
+
+        for batch in batches(data["users"]):
+            driver.execute_query(
+                "UNWIND $usernames AS username MERGE (:User {username: username})",
+                usernames = [user["username"] for user in batch],
+            )
+        for batch in batches(data["friendships"]):
+            driver.execute_query(
+                """
+                UNWIND $friendships AS f
+                MATCH (u1:User {username: f.username1})
+                MATCH (u2:User {username: f.username2})
+                MERGE (u1)-[:FRIENDS_WITH]->(u2)
+                MERGE (u1)<-[:FRIENDS_WITH]-(u2)
+                """,
+                friendships = batch,
+            )
+        for batch in batches(data["follows"]):
+            driver.execute_query(
+                """
+                UNWIND $follows AS f
+                MATCH (u:User {username: f.username})
+                MATCH (a:Artist {id: f.artist_id})
+                MERGE (u)-[:FOLLOWS]->(a)
+                """,
+                follows = batch,
+            )
+        for batch in batches(data["ratings"]):
+            driver.execute_query(
+                """
+                UNWIND $ratings AS r
+                MATCH (u:User {username: r.username})
+                MATCH (rel:Release {id: r.release_id})
+                MERGE (u)-[rated:RATED]->(rel)
+                SET rated.rating = r.rating
+                """,
+                ratings = batch,
+            )
+
+def manifest(data: dict) -> dict:
+    """
+    Get the IDs the load test picks its request parameters from.
+    """
+    return {
+        "artists": [artist["_id"] for artist in data["artists"]],
+        "releases": [
+            release["id"]
+            for artist in data["artists"]
+            for release in artist["releases"]
+        ],
+        "users": [user["username"] for user in data["users"]],
+        "genres": sorted({genre for artist in data["artists"] for genre in artist["genres"]}),
+    }
+
+def main():
+    """
+    Seed both databases from the command line.
+    """
+    parser = argparse.ArgumentParser(description = __doc__.split("\n\n", maxsplit = 1)[0])
+    parser.add_argument("--scale", type = float, default = 1.0)
+    parser.add_argument("--seed", type = int, default = 42)
+    parser.add_argument("--mongodb-uri", default = "mongodb://localhost:27017")
+    parser.add_argument("--mongodb-database", default = "music_catalog")
+    parser.add_argument("--neo4j-uri", default = "bolt://localhost:7687")
+    parser.add_argument("--neo4j-username", default = "neo4j")
+    parser.add_argument("--neo4j-password", default = "password")
+    parser.add_argument("--manifest", default = "bench_manifest.json")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    data = generate(args.scale, args.seed)
+    print(
+        f"Generated {len(data['artists'])} artists, {len(data['users'])} users, "
+        f"{len(data['friendships'])} friendships, {len(data['follows'])} follows "
+        f"and {len(data['ratings'])} ratings in {time.perf_counter() - start:.1f}s"
+    )
+
+    start = time.perf_counter()
+    seed_mongodb(args.mongodb_uri, args.mongodb_database, data)
+    print(f"Seeded MongoDB in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    seed_neo4j(args.neo4j_uri, (args.neo4j_username, args.neo4j_password), data)
+    print(f"Seeded Neo4j in {time.perf_counter() - start:.1f}s")
+
+    with open(args.manifest, "w", encoding = "utf-8") as manifest_file:
+        json.dump(manifest(data), manifest_file)
+    print(f"Wrote manifest to {args.manifest}")
+
+if __name__ == "__main__":
+    main()